@@ -0,0 +1,210 @@
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+from app.pipeline import preprocessing as prs
+from app.pipeline import filtering as ftr
+from app.recommenders.implicit_models import ALSRecommender, BPRRecommender, DEFAULT_BLOCK_SIZE
+from app.benchmarks.synthetic_data import generate_raw_data
+
+STAGES = ('preprocessing', 'partitioning', 'fitting', 'recommendation', 'serialization')
+
+
+class StageTimer:
+    """
+    Collects wall time and the peak of memory allocated by Python and NumPy (tracemalloc) per benchmark stage. A
+    stage can be measured several times, e.g. once per region: the seconds are summed and the peak is the maximum.
+    """
+
+    def __init__(self, trace_memory: bool = True):
+        self.trace_memory = trace_memory
+        self.stages = dict()
+
+    @contextmanager
+    def measure(self, stage: str):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = None
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            result = self.stages.setdefault(stage, {'seconds': 0.0, 'calls': 0, 'peak_memory_mb': None})
+            result['seconds'] = round(result['seconds'] + seconds, 4)
+            result['calls'] += 1
+            if peak is not None:
+                result['peak_memory_mb'] = round(max(result['peak_memory_mb'] or 0, peak / 2 ** 20), 2)
+
+    def add(self, stage: str, **values) -> None:
+        self.stages.setdefault(stage, {'seconds': 0.0, 'calls': 0, 'peak_memory_mb': None}).update(values)
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(
+        raw_directory: str,
+        output_directory: str,
+        recommender_name: str = 'als',
+        iterations: int = 15,
+        factors: int = 64,
+        chunksize: Optional[int] = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        output_file_type: str = 'json',
+        trace_memory: bool = True
+) -> Dict[str, Any]:
+    """
+    Runs the pipeline stages on raw tables generated by synthetic_data.generate_raw_data: preprocessing of the raw
+    tables, partitioning of the user-event table by regions, fitting of a recommender per region, recommendation for
+    all users of a region and serialization of the recommendations.
+
+    :return: a report with the parameters, environment and the measurements of every stage
+    """
+    raw_directory = Path(raw_directory)
+    timer = StageTimer(trace_memory)
+
+    with timer.measure('preprocessing'):
+        user_event_df = prs.get_user_event_dataframe(str(raw_directory / 'clicks.csv'), chunksize=chunksize)
+        users_df = prs.get_user_dataframe(
+            str(raw_directory / 'users.txt'),
+            str(raw_directory / 'region.txt'),
+            str(raw_directory / 'RegionRussia.csv')
+        )
+        events_df = prs.get_events_dataframe(str(raw_directory / 'events.csv'),
+                                             str(raw_directory / 'organizations.csv'))
+    timer.add('preprocessing', rows=len(user_event_df))
+
+    with timer.measure('partitioning'):
+        partitions = list(ftr.partition_user_event_df(user_event_df, users_df, events_df))
+    timer.add('partitioning', partitions=len(partitions))
+
+    num_of_users, num_of_recommendations = 0, 0
+    for (user_region, event_region), partition in partitions:
+        with timer.measure('fitting'):
+            user_item_df = ftr.numerate_user_event_df(partition).rename(columns={
+                'event_id': 'item_id',
+                'event_num': 'item_num',
+                'clicks_count': 'rating'
+            })
+            if recommender_name == 'als':
+                recommender = ALSRecommender(factors=factors, iterations=iterations, confidence='alpha',
+                                             alpha_value=15)
+            else:
+                recommender = BPRRecommender(factors=factors, iterations=iterations)
+            recommender.fit(user_item_df, show_progress=False)
+        with timer.measure('recommendation'):
+            user_nums, _, _ = recommender.get_all_recommendation_batched(block_size=block_size)
+        num_of_users += recommender.model.user_factors.shape[0]
+        num_of_recommendations += len(user_nums)
+        with timer.measure('serialization'):
+            file_name = f'{output_directory}/user_{user_region}_event_{event_region}_rec'
+            if output_file_type == 'json':
+                recommender.to_json(file_name, block_size=block_size)
+            elif output_file_type == 'csv':
+                recommender.to_csv(file_name, block_size=block_size)
+            else:
+                recommender.to_binary(file_name, block_size=block_size)
+    timer.add('fitting', users=num_of_users, nnz=sum(len(partition) for _, partition in partitions))
+    timer.add('recommendation', recommendations=num_of_recommendations)
+
+    stages = timer.stages
+    for stage, rows in (('fitting', num_of_users), ('recommendation', num_of_users)):
+        if stage in stages and stages[stage]['seconds'] > 0:
+            stages[stage]['users_per_second'] = round(rows / stages[stage]['seconds'], 1)
+
+    return {
+        'created': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'git_commit': get_git_commit(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__
+        },
+        'params': {
+            'recommender': recommender_name,
+            'iterations': iterations,
+            'factors': factors,
+            'chunksize': chunksize,
+            'block_size': block_size,
+            'output_file_type': output_file_type,
+            'trace_memory': trace_memory
+        },
+        'stages': {stage: stages[stage] for stage in STAGES if stage in stages}
+    }
+
+
+parser = argparse.ArgumentParser(
+    prog='run_benchmarks',
+    description='Timing and memory profiling of the pipeline stages on synthetic data.'
+)
+
+parser.add_argument('report_file', type=str, help='a .json file for the benchmark report.')
+parser.add_argument('-num_of_clicks', type=int, nargs='+', default=[10_000, 100_000],
+                    help='scales of the synthetic clicks table, a report entry is made for every scale.',
+                    action='store')
+parser.add_argument('-raw_directory', type=str,
+                    help='a directory with already generated raw tables; used instead of -num_of_clicks.',
+                    action='store')
+parser.add_argument('-recommender', type=str, default='als', choices=['als', 'bpr'], action='store')
+parser.add_argument('-iterations', type=int, default=15, action='store')
+parser.add_argument('-factors', type=int, default=64, action='store')
+parser.add_argument('-chunksize', type=int, help='a number of rows of the clicks file read at once.',
+                    action='store')
+parser.add_argument('-block_size', type=int, default=DEFAULT_BLOCK_SIZE, action='store')
+parser.add_argument('-output_file_type', type=str, default='json', choices=['json', 'csv', 'bin'], action='store')
+parser.add_argument('-no_memory', help='do not trace memory allocations; tracing slows down Python code.',
+                    action='store_true')
+parser.add_argument('-random_state', type=int, default=0, action='store')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print('INFO: running benchmarks ...')
+
+    options = dict(
+        recommender_name=args.recommender,
+        iterations=args.iterations,
+        factors=args.factors,
+        chunksize=args.chunksize,
+        block_size=args.block_size,
+        output_file_type=args.output_file_type,
+        trace_memory=not args.no_memory
+    )
+    reports = list()
+    with tempfile.TemporaryDirectory() as work_directory:
+        if args.raw_directory is not None:
+            report = run_benchmark(args.raw_directory, work_directory, **options)
+            reports.append({'raw_directory': args.raw_directory, **report})
+        else:
+            for num_of_clicks in args.num_of_clicks:
+                raw_directory = Path(work_directory) / f'raw_{num_of_clicks}'
+                output_directory = Path(work_directory) / f'rec_{num_of_clicks}'
+                output_directory.mkdir()
+                generate_raw_data(str(raw_directory), num_of_clicks, random_state=args.random_state)
+                report = run_benchmark(str(raw_directory), str(output_directory), **options)
+                reports.append({'num_of_clicks': num_of_clicks, **report})
+                for file_name in raw_directory.iterdir():
+                    file_name.unlink()
+                print(f'INFO: {num_of_clicks} clicks: ' + ', '.join(
+                    f'{stage} {result["seconds"]} s' for stage, result in report['stages'].items()))
+
+    with open(args.report_file, 'w') as json_file:
+        json.dump(reports, json_file, indent=2, ensure_ascii=False)
@@ -0,0 +1,169 @@
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Dict, Optional
+
+from app.pipeline.preprocessing import EVENT_REGION_NUMBERS, DOWNLOAD_DATE
+
+CATEGORIES = ['Театр', 'Музей', 'Концертный зал', 'Библиотека', 'Кинотеатр', 'Дом культуры']
+
+RAW_FILE_NAMES = {
+    'clicks_file': 'clicks.csv',
+    'all_events_file': 'events.csv',
+    'current_events_file': 'future_events.csv',
+    'organizations_file': 'organizations.csv',
+    'users_file': 'users.txt',
+    'regions_file': 'region.txt',
+    'regions_codes': 'RegionRussia.csv'
+}
+
+
+def get_region_names(num_of_regions: int) -> Dict[int, str]:
+    """
+    :return: the first num_of_regions region codes of EVENT_REGION_NUMBERS with one name per code
+    """
+    region_names = dict()
+    for region_name, region_code in EVENT_REGION_NUMBERS.items():
+        if region_code not in region_names:
+            region_names[region_code] = region_name
+        if len(region_names) == num_of_regions:
+            break
+    return region_names
+
+
+def generate_raw_data(
+        output_directory: str,
+        num_of_clicks: int,
+        num_of_users: Optional[int] = None,
+        num_of_events: Optional[int] = None,
+        num_of_regions: int = 10,
+        future_share: float = 0.3,
+        home_region_share: float = 0.9,
+        zipf_exponent: float = 1.1,
+        chunksize: int = 1_000_000,
+        random_state: int = 0
+) -> Dict[str, str]:
+    """
+    Generates raw tables in the schemas read by prepare_dataframes.py. Users click events of their own region with
+    probability home_region_share, events are chosen by a Zipf-like popularity inside a region and click times are
+    spread over the month before DOWNLOAD_DATE. The clicks table is written chunk by chunk, so tens of millions of
+    clicks can be generated with bounded memory.
+
+    :param num_of_clicks: number of rows of the clicks table
+    :param num_of_users: number of users, num_of_clicks / 20 if None
+    :param num_of_events: number of events, num_of_clicks / 500 (at least 100) if None
+    :param future_share: share of the events listed in the future events table
+    :return: the file names by the names of the prepare_dataframes.py arguments
+    """
+    random_state = np.random.RandomState(random_state)
+    output_directory = Path(output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    file_names = {name: str(output_directory / file_name) for name, file_name in RAW_FILE_NAMES.items()}
+
+    num_of_users = num_of_users or max(num_of_clicks // 20, 10)
+    num_of_events = num_of_events or max(num_of_clicks // 500, 100)
+    num_of_organizations = max(num_of_events // 5, 1)
+    region_names = get_region_names(num_of_regions)
+    region_codes = np.array(list(region_names))
+
+    pd.DataFrame({
+        'Наименование субъекта': list(region_names.values()),
+        'Код ГИБДД': region_codes
+    }).to_csv(file_names['regions_codes'], index=False)
+
+    user_ids = pd.Series(np.arange(num_of_users)).map('u{:015x}'.format).values
+    user_regions = random_state.randint(0, len(region_codes), num_of_users)
+    birth_dates = DOWNLOAD_DATE - pd.to_timedelta(random_state.randint(14 * 365, 70 * 365, num_of_users), unit='D')
+    pd.DataFrame({
+        'user_id': user_ids,
+        'user_birth': birth_dates.strftime('%Y-%m-%d')
+    }).to_csv(file_names['users_file'], sep=';', index=False)
+    pd.DataFrame({
+        'user_id': user_ids,
+        'region': np.array(list(region_names.values()))[user_regions]
+    }).to_csv(file_names['regions_file'], sep=';', index=False)
+
+    organization_ids = np.arange(num_of_organizations)
+    organization_regions = random_state.randint(0, len(region_codes), num_of_organizations)
+    pd.DataFrame({
+        'ID': organization_ids,
+        'Учреждение': [f'Учреждение {org_id}' for org_id in organization_ids],
+        'Адрес': [f'{region_names[region_codes[region]]}, ул Центральная, д {org_id}'
+                  for org_id, region in zip(organization_ids, organization_regions)],
+        'ИНН': 7700000000 + organization_ids,
+        'Категория': np.array(CATEGORIES)[random_state.randint(0, len(CATEGORIES), num_of_organizations)]
+    }).to_csv(file_names['organizations_file'], sep=';', index=False)
+
+    event_ids = np.arange(1, num_of_events + 1)
+    event_names = np.array([f'Событие {event_id}' for event_id in event_ids])
+    event_organizations = random_state.randint(0, num_of_organizations, num_of_events)
+    pd.DataFrame({
+        'entity._id': event_ids,
+        'entity.name': event_names,
+        'entity.saleLink': [f'https://tickets.example/{event_id}' for event_id in event_ids],
+        'entity.additionalSaleLinks.0': None,
+        'entity.organization._id': event_organizations,
+        'entity.organization.name': [f'Учреждение {org_id}' for org_id in event_organizations]
+    }).to_csv(file_names['all_events_file'], index=False)
+    future_events = np.sort(random_state.choice(num_of_events, int(num_of_events * future_share), replace=False))
+    pd.DataFrame({
+        'ID': event_ids[future_events],
+        'name': event_names[future_events]
+    }).to_csv(file_names['current_events_file'], sep=';', index=False)
+
+    # events of every region ordered by their popularity rank
+    event_regions = organization_regions[event_organizations]
+    region_events = [random_state.permutation(np.flatnonzero(event_regions == region))
+                     for region in range(len(region_codes))]
+    all_events = random_state.permutation(num_of_events)
+
+    start_time = pd.Timestamp(DOWNLOAD_DATE - pd.Timedelta(days=30)).value // 10 ** 9
+    header = True
+    for start in range(0, num_of_clicks, chunksize):
+        size = min(chunksize, num_of_clicks - start)
+        users = random_state.randint(0, num_of_users, size)
+        ranks = random_state.zipf(zipf_exponent + 1, size) - 1
+        events = all_events[ranks % num_of_events]
+        home = random_state.random_sample(size) < home_region_share
+        for region, events_of_region in enumerate(region_events):
+            clicked = home & (user_regions[users] == region)
+            if len(events_of_region) != 0 and clicked.any():
+                events[clicked] = events_of_region[ranks[clicked] % len(events_of_region)]
+        create_time = pd.to_datetime(start_time + random_state.randint(0, 30 * 24 * 3600, size), unit='s')
+        pd.DataFrame({
+            'session_id': event_ids[events],
+            'session_name': event_names[events],
+            'session_identity': 'event',
+            'create_time': create_time.strftime('%Y-%m-%d %H:%M:%S'),
+            'user_id': user_ids[users],
+            'organization_id': event_organizations[events]
+        }).to_csv(file_names['clicks_file'], sep=';', index=False, header=header, mode='w' if header else 'a')
+        header = False
+    return file_names
+
+
+parser = argparse.ArgumentParser(
+    prog='synthetic_data',
+    description='Generating synthetic raw tables in the schemas expected by prepare_dataframes.py.'
+)
+
+parser.add_argument('output_directory', type=str, help='a directory for the generated files.')
+parser.add_argument('num_of_clicks', type=int, help='a number of clicks, e.g. 10000 or 50000000.')
+parser.add_argument('-num_of_users', type=int, action='store')
+parser.add_argument('-num_of_events', type=int, action='store')
+parser.add_argument('-num_of_regions', type=int, default=10, action='store')
+parser.add_argument('-random_state', type=int, default=0, action='store')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print('INFO: generating synthetic data ...')
+    generate_raw_data(
+        output_directory=args.output_directory,
+        num_of_clicks=args.num_of_clicks,
+        num_of_users=args.num_of_users,
+        num_of_events=args.num_of_events,
+        num_of_regions=args.num_of_regions,
+        random_state=args.random_state
+    )
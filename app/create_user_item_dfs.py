@@ -1,7 +1,9 @@
 import argparse
-import pandas as pd
 from pathlib import Path
 from pipeline import filtering as ftr
+from pipeline import storage
+from pipeline import instrumentation as instr
+from recommenders.popularity import compute_popularity_table, DEFAULT_AGE_BINS
 
 parser = argparse.ArgumentParser(
     prog='make_user_item_dfs',
@@ -46,10 +48,87 @@ parser.add_argument(
     action='store'
 )
 
+parser.add_argument(
+    '-all_pairs',
+    help='save user-event dataframes for every pair of user and event regions, not only for users and events '
+         'from the same region.',
+    action='store_true'
+)
+
+parser.add_argument(
+    '-storage_format',
+    type=str,
+    default='csv',
+    choices=list(storage.STORAGE_FORMATS),
+    help='a format of the saved user-event tables: csv, parquet or feather.',
+    action='store'
+)
+
+parser.add_argument(
+    '-changed_regions',
+    type=str,
+    help='a changed_regions.json file saved by prepare_dataframes.py -incremental; only the regional tables listed '
+         'there are processed.',
+    action='store'
+)
+
+parser.add_argument(
+    '-popularity_file',
+    type=str,
+    help='a file name without the suffix for the table of the most clicked events of every region, served to the '
+         'users unknown to the models (see recommenders.popularity); saved in -storage_format outside target_dir.',
+    action='store'
+)
+
+parser.add_argument(
+    '-popularity_top',
+    type=int,
+    default=100,
+    help='a number of the most clicked events saved per region.',
+    action='store'
+)
+
+parser.add_argument(
+    '-popularity_by_age',
+    help=f'save the most clicked events per age bucket of the users too, bucket edges: {list(DEFAULT_AGE_BINS)}.',
+    action='store_true'
+)
+
+parser.add_argument(
+    '-popularity_by_category',
+    help='save the most clicked events per category of the events too.',
+    action='store_true'
+)
+
+parser.add_argument(
+    '-log_file',
+    type=str,
+    help='a file the JSON log lines of the stages are appended to; they are written to stderr in any case.',
+    action='store'
+)
+
+parser.add_argument(
+    '-profile',
+    type=str,
+    choices=list(instr.PROFILE_MODES),
+    help='profile the run with cProfile (statistics are saved into -profile_file) or tracemalloc (the top '
+         'allocations are logged).',
+    action='store'
+)
+
+parser.add_argument(
+    '-profile_file',
+    type=str,
+    default='create_user_item_dfs.prof',
+    help='a file for the cProfile statistics.',
+    action='store'
+)
+
 args = parser.parse_args()
 
 if __name__ == "__main__":
-    print('INFO: creating user-event dataframes ...')
+    logger = instr.configure_logging(args.log_file)
+    logger.info('creating user-event dataframes ...')
     for path in args.user_df, args.event_df, args.user_event_df:
         if not Path(path).is_file():
             raise OSError(f'File {path} was not found.')
@@ -57,30 +136,62 @@ if __name__ == "__main__":
     if not Path(args.target_dir).is_dir():
         raise OSError(f'Directory {args.target_dir} does not exist.')
 
-    user_event_df = pd.read_csv(args.user_event_df)
-    user_df = pd.read_csv(args.user_df)
-    event_df = pd.read_csv(args.event_df)
-
-    if args.user_region is not None and args.event_region is not None:
-        df = ftr.filter_user_event_df(
-            user_event_df,
-            user_df,
-            event_df,
-            user_region_code=args.user_region,
-            event_region_code=args.event_region
-        )
-        df.to_csv(f'user_{args.user_region}_event_{args.event_region}.csv', index=False)
-    else:
-        user_region_codes = set(user_df.region_code)
-        event_region_codes = set(event_df.region_code)
-        region_codes = user_region_codes.intersection(event_region_codes)
-
-        for region_code in region_codes:
-            df = ftr.filter_user_event_df(
+    with instr.profile(args.profile, args.profile_file), instr.stage('create_user_item_dfs') as total:
+        with instr.stage('read_tables') as metrics:
+            user_event_df = storage.read_table(args.user_event_df, storage.USER_EVENT_DTYPES)
+            user_df = storage.read_table(args.user_df, storage.USER_DTYPES)
+            event_df = storage.read_table(args.event_df, storage.EVENT_DTYPES)
+            metrics.update({'rows': len(user_event_df), 'users': len(user_df), 'events': len(event_df)})
+
+        # the row positions of every region are found once and shared by all partitions
+        index = ftr.UserEventIndex(user_event_df, user_df, event_df)
+        if args.user_region is not None and args.event_region is not None:
+            with instr.stage('partition', user_region=args.user_region, event_region=args.event_region) as metrics:
+                df = index.filter_user_event_df(user_region=args.user_region, event_region=args.event_region)
+                storage.write_table(
+                    df,
+                    storage.get_partition_name(args.user_region, args.event_region),
+                    args.storage_format,
+                    storage.USER_EVENT_DTYPES
+                )
+                metrics['rows'] = len(df)
+        else:
+            region_pairs = None
+            if args.changed_regions is not None:
+                region_pairs = storage.read_changed_regions(args.changed_regions)
+                if not args.all_pairs:
+                    region_pairs = [(user_region, event_region) for user_region, event_region in region_pairs
+                                    if user_region == event_region]
+            partitions = ftr.partition_user_event_df(
                 user_event_df,
                 user_df,
                 event_df,
-                user_region_code=region_code,
-                event_region_code=region_code
+                region_pairs=region_pairs,
+                same_region_only=not args.all_pairs,
+                index=index
             )
-            df.to_csv(f'{args.target_dir}/user_{region_code}_event_{region_code}.csv', index=False)
+            total['regions'] = 0
+            for (user_region_code, event_region_code), df in partitions:
+                with instr.stage('partition', user_region=user_region_code, event_region=event_region_code,
+                                 rows=len(df)):
+                    storage.write_table(
+                        df,
+                        f'{args.target_dir}/{storage.get_partition_name(user_region_code, event_region_code)}',
+                        args.storage_format,
+                        storage.USER_EVENT_DTYPES
+                    )
+                total['regions'] += 1
+
+        if args.popularity_file is not None:
+            with instr.stage('popularity', by_age=args.popularity_by_age,
+                             by_category=args.popularity_by_category) as metrics:
+                popularity_df = compute_popularity_table(
+                    user_event_df,
+                    user_df,
+                    event_df,
+                    N=args.popularity_top,
+                    age_bins=DEFAULT_AGE_BINS if args.popularity_by_age else None,
+                    by_category=args.popularity_by_category
+                )
+                storage.write_table(popularity_df, args.popularity_file, args.storage_format)
+                metrics['rows'] = len(popularity_df)
@@ -1,9 +1,149 @@
+import numpy as np
 import pandas as pd
+import scipy.sparse as sparse
 from sklearn.model_selection import ParameterGrid
 from tqdm.notebook import tqdm_notebook
-from typing import Tuple
+from typing import Tuple, Dict, Optional, Iterable
 
-from app.recommenders.implicit_models import UserItemRecommender
+from app.recommenders.implicit_models import UserItemRecommender, DEFAULT_BLOCK_SIZE
+from app.recommenders.implicit_models import build_user_item_matrix
+from app.recommenders.encoding import IdEncoder
+
+METRICS = ('hit_rate', 'recall', 'ndcg', 'map')
+
+
+def leave_one_out_split(
+        user_item_df: pd.DataFrame,
+        user_ids: Optional[Iterable[str]] = None,
+        min_interactions: int = 2,
+        random_state: int = 0
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Holds out one random interaction of every evaluated user at once. User and item numbers are not changed, so the
+    recommender fitted on the train part scores the held-out items by the same numbers.
+
+    :param user_item_df: a pandas Dataframe with the columns of UserItemRecommender.fit
+    :param user_ids: ids of the evaluated users, all users if None
+    :param min_interactions: users with fewer interactions are not evaluated, so every user stays in the train part
+    :return: the train part and the held-out part of user_item_df
+    """
+    interactions_per_user = user_item_df.groupby('user_num', observed=True)['item_num'].transform('size')
+    candidates = user_item_df.loc[interactions_per_user >= min_interactions]
+    if user_ids is not None:
+        candidates = candidates.loc[candidates['user_id'].isin(list(user_ids))]
+    random_keys = np.random.RandomState(random_state).random_sample(len(candidates))
+    held_out = candidates.iloc[np.argsort(random_keys)].drop_duplicates('user_num')
+    train = user_item_df.drop(held_out.index)
+    return train, held_out.sort_values('user_num')
+
+
+def fit_on_part(
+        recommender: UserItemRecommender,
+        user_item_df: pd.DataFrame,
+        part: pd.DataFrame,
+        show_progress: bool = False
+) -> None:
+    """
+    Fits the recommender on a part of user_item_df keeping the user and item numbers of the whole dataframe, so the
+    users and items without interactions in the part (e.g. an item clicked only in a held-out interaction) are still
+    known to the recommender and the numbers of the held-out interactions match its matrix.
+    """
+    user_encoder = IdEncoder.from_columns(user_item_df['user_id'], user_item_df['user_num'])
+    item_encoder = IdEncoder.from_columns(user_item_df['item_id'], user_item_df['item_num'])
+    matrix = build_user_item_matrix(part['user_num'], part['item_num'], part['rating'],
+                                    shape=(len(user_encoder), len(item_encoder)))
+    recommender.fit_matrix(matrix, user_encoder.ids, item_encoder.ids, show_progress=show_progress)
+
+
+def ranking_metrics(
+        recommended_items: np.ndarray,
+        relevant: sparse.csr_matrix
+) -> Dict[str, float]:
+    """
+    Calculates hit-rate@K, recall@K, NDCG@K and MAP@K for all users at once, K is the number of recommended items.
+
+    :param recommended_items: item numbers of shape (number of users, K) sorted by descending score, -1 for missing
+    :param relevant: a binary sparse matrix of the relevant items, one row per row of recommended_items
+    :return: a dictionary with the metrics averaged over the users having relevant items
+    """
+    relevant = relevant.tocsr()
+    num_of_users, K = recommended_items.shape
+    num_of_relevant = np.diff(relevant.indptr)
+    evaluated = num_of_relevant > 0
+    if not evaluated.any():
+        return {metric: 0.0 for metric in METRICS}
+
+    relevant_coo = relevant.tocoo()
+    relevant_keys = relevant_coo.row.astype(np.int64) * relevant.shape[1] + relevant_coo.col
+    recommended_keys = np.arange(num_of_users)[:, None] * relevant.shape[1] + recommended_items
+    hits = (recommended_items >= 0) & np.isin(recommended_keys, relevant_keys)
+
+    discounts = 1 / np.log2(np.arange(K) + 2)
+    ideal_hits = np.minimum(num_of_relevant, K)
+    ideal_dcg = np.cumsum(discounts)[np.maximum(ideal_hits - 1, 0)]
+    precision_at_rank = np.cumsum(hits, axis=1) / np.arange(1, K + 1)
+
+    metrics = {
+        'hit_rate': hits.any(axis=1),
+        'recall': hits.sum(axis=1) / np.maximum(num_of_relevant, 1),
+        'ndcg': hits.dot(discounts) / ideal_dcg,
+        'map': (precision_at_rank * hits).sum(axis=1) / np.maximum(ideal_hits, 1)
+    }
+    return {metric: round(float(values[evaluated].mean()), 4) for metric, values in metrics.items()}
+
+
+def score_held_out(
+        recommender: UserItemRecommender,
+        held_out: pd.DataFrame,
+        K: int = 10,
+        block_size: int = DEFAULT_BLOCK_SIZE
+) -> Dict[str, float]:
+    """
+    Scores the users of the held-out interactions with the fitted recommender block by block and calculates the
+    ranking metrics of their top-K items.
+
+    :param held_out: a pandas Dataframe with user_num and item_num columns of the held-out interactions
+    :return: a dictionary with hit_rate, recall, ndcg and map
+    """
+    num_of_users, num_of_items = recommender.model.user_factors.shape[0], recommender.model.item_factors.shape[0]
+    # held-out users and items absent from the train part cannot be recommended
+    held_out = held_out.loc[held_out['user_num'] < num_of_users]
+    user_nums, rows = np.unique(held_out['user_num'].to_numpy(), return_inverse=True)
+    items = held_out['item_num'].to_numpy()
+    # an item unknown to the model is moved to a column no recommended item can match
+    relevant = sparse.csr_matrix(
+        (np.ones(len(held_out)), (rows, np.where(items < num_of_items, items, num_of_items))),
+        shape=(len(user_nums), num_of_items + 1)
+    )
+    recommended_items = np.full((len(user_nums), K), -1, dtype=np.int64)
+    for start in range(0, len(user_nums), block_size):
+        recommended_items[start:start + block_size], _ = recommender.score_users(user_nums[start:start + block_size], K)
+    return ranking_metrics(recommended_items, relevant)
+
+
+def evaluate_leave_one_out(
+        recommender: UserItemRecommender,
+        user_item_df: pd.DataFrame,
+        user_ids: Optional[Iterable[str]] = None,
+        K: int = 10,
+        min_interactions: int = 2,
+        random_state: int = 0,
+        block_size: int = DEFAULT_BLOCK_SIZE
+) -> Dict[str, float]:
+    """
+    Leave-one-out evaluation of many users with a single fit: one interaction of every evaluated user is held out
+    (see leave_one_out_split), the recommender is fitted once on the rest and all evaluated users are scored in
+    batches.
+
+    :param recommender: an unfitted recommender
+    :param user_item_df: a pandas Dataframe with the columns of UserItemRecommender.fit
+    :param user_ids: ids of the evaluated users, all users with at least min_interactions interactions if None
+    :param K: number of recommended items
+    :return: a dictionary with hit_rate, recall, ndcg and map at K
+    """
+    train, held_out = leave_one_out_split(user_item_df, user_ids, min_interactions, random_state)
+    fit_on_part(recommender, user_item_df, train)
+    return score_held_out(recommender, held_out, K, block_size)
 
 
 def evaluate(
@@ -19,7 +159,7 @@ def evaluate(
         example = user_event_df[(user_event_df.user_id == clicked_event.user_id) &
                                 (user_event_df.item_id == clicked_event.item_id)]
         us_ev = user_event_df.drop(example.index)
-        recommender.fit(user_item_df=us_ev, show_progress=False)
+        fit_on_part(recommender, user_event_df, us_ev)
         recommended_to_user = recommender.get_user_recommendation(user_id, number_of_recommended, as_pd_dataframe=True)
         if example.iloc[0].item_id in list(recommended_to_user.item_id.values):
             count += 1
@@ -40,18 +180,17 @@ def cross_validation(
         (user_activity_df.clicks_count == num_of_clicked)
         ]
 
-    user_from_interval = users_in_interval.sample().iloc[0]
     best_params = dict()
     best_recommender = None
     max_probability = 0
     for params in tqdm_notebook(ParameterGrid(parameters)):
         rec = recommender(**params)
-        probability = evaluate(
-            user_id=user_from_interval.user_id,
-            user_event_df=user_event_df,
+        probability = evaluate_leave_one_out(
             recommender=rec,
-            number_of_recommended=num_of_recommended
-        )
+            user_item_df=user_event_df,
+            user_ids=users_in_interval.user_id,
+            K=num_of_recommended
+        )['hit_rate']
         if probability > max_probability:
             print(probability)
             max_probability = probability
@@ -74,17 +213,9 @@ def test_best_model(
         (user_activity_df.clicks_count == num_of_clicked)
         ].sample(frac=0.25)
 
-    median_probability = 0.0
-    counter = 0
-    for _, user in users_in_interval.iterrows():
-        median_probability += evaluate(
-            user_id=user.user_id,
-            user_event_df=user_item_df,
-            recommender=best_model,
-            number_of_recommended=num_of_recommended
-        )
-        counter += 1
-    else:
-        median_probability = median_probability / counter
-
-    return median_probability
+    return evaluate_leave_one_out(
+        recommender=best_model,
+        user_item_df=user_item_df,
+        user_ids=users_in_interval.user_id,
+        K=num_of_recommended
+    )['hit_rate']
@@ -0,0 +1,329 @@
+import os
+import json
+import time
+import argparse
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List, Optional, Any
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.model_selection import ParameterGrid, ParameterSampler
+
+from app.pipeline import filtering as ftr
+from app.pipeline import storage
+from app.pipeline import parallel
+from app.pipeline import instrumentation as instr
+from app.recommenders.implicit_models import ALSRecommender, BPRRecommender
+from app.recommenders.implicit_models import build_user_item_matrix
+from app.recommenders.encoding import IdEncoder
+from app.evaluation.cross_validation import METRICS, leave_one_out_split, score_held_out
+
+RECOMMENDERS = {
+    'als': ALSRecommender,
+    'bpr': BPRRecommender
+}
+
+RESULT_COLUMNS = ['region', 'recommender', 'settings', 'params', 'iterations', *METRICS, 'fit_seconds',
+                  'score_seconds']
+
+# the split of the last evaluated region, so a worker reads, splits and builds the train matrix of every region once
+_splits = dict()
+
+
+def load_user_item_df(file_name: str) -> pd.DataFrame:
+    user_event_df = storage.read_table(file_name, storage.USER_EVENT_DTYPES)
+    user_event_df = ftr.numerate_user_event_df(user_event_df)
+    return user_event_df.rename(columns={
+        'event_id': 'item_id',
+        'event_num': 'item_num',
+        'clicks_count': 'rating'
+    })
+
+
+def get_split(file_name: str, min_interactions: int, random_state: int):
+    key = (file_name, min_interactions, random_state)
+    if key not in _splits:
+        _splits.clear()
+        user_item_df = load_user_item_df(file_name)
+        train, held_out = leave_one_out_split(user_item_df, None, min_interactions, random_state)
+        # the encoders are built from the whole table: an item clicked only in a held-out interaction is not in train
+        user_encoder = IdEncoder.from_columns(user_item_df['user_id'], user_item_df['user_num'])
+        item_encoder = IdEncoder.from_columns(user_item_df['item_id'], user_item_df['item_num'])
+        matrix = build_user_item_matrix(train['user_num'], train['item_num'], train['rating'],
+                                        shape=(len(user_encoder), len(item_encoder)))
+        _splits[key] = (matrix, user_encoder.ids, item_encoder.ids), held_out
+    return _splits[key]
+
+
+def evaluate_configuration(
+        recommender_name: str,
+        params: Dict[str, Any],
+        file_name: str,
+        K: int = 10,
+        min_interactions: int = 2,
+        random_state: int = 0,
+        num_of_threads: int = 0
+) -> Dict[str, Any]:
+    """
+    Worker entry point: fits one configuration on the leave-one-out train part of the region and scores the held-out
+    interactions. The same random_state gives every configuration the same held-out interactions.
+
+    :return: a row of the results table
+    """
+    (matrix, user_ids, item_ids), held_out = get_split(file_name, min_interactions, random_state)
+    recommender = RECOMMENDERS[recommender_name](**params, num_of_threads=num_of_threads)
+    start = time.perf_counter()
+    recommender.fit_matrix(matrix, user_ids, item_ids, show_progress=False)
+    fit_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    metrics = score_held_out(recommender, held_out, K)
+    return {
+        'region': Path(file_name).stem,
+        'recommender': recommender_name,
+        'settings': get_settings_key(K, min_interactions, random_state),
+        'params': json.dumps(params, sort_keys=True),
+        'iterations': params.get('iterations'),
+        **metrics,
+        'fit_seconds': round(fit_seconds, 3),
+        'score_seconds': round(time.perf_counter() - start, 3)
+    }
+
+
+def get_settings_key(K: int, min_interactions: int, random_state: int) -> str:
+    """
+    :return: the settings the metrics of a results row depend on besides the parameters, as a results table value
+    """
+    return json.dumps({'K': K, 'min_interactions': min_interactions, 'random_state': random_state}, sort_keys=True)
+
+
+class ParameterSearch:
+    """
+    Evaluates recommender configurations on a process pool and appends every result to a .csv table as soon as it is
+    ready. Configurations found in the table are not evaluated again, so an interrupted search resumes where it
+    stopped. Only the rows with the same K, min_interactions and random_state are reused, the metrics of other
+    settings cannot be compared.
+
+    Strategies:
+        - grid: every configuration of the parameter space;
+        - random: n_trials configurations sampled from the parameter space;
+        - halving: successive halving over n_trials sampled configurations, the number of fit iterations is the
+          budget: all configurations are fitted with min_iterations, the best 1/eta of them are fitted again with
+          eta times more iterations and so on up to max_iterations, weak configurations are stopped early.
+    """
+
+    def __init__(self,
+                 recommender_name: str,
+                 parameter_space: Dict[str, List[Any]],
+                 results_file: str,
+                 strategy: str = 'random',
+                 n_trials: int = 20,
+                 metric: str = 'ndcg',
+                 K: int = 10,
+                 min_iterations: int = 5,
+                 max_iterations: int = 100,
+                 eta: int = 3,
+                 workers: int = 1,
+                 min_interactions: int = 2,
+                 random_state: int = 0):
+        if recommender_name not in RECOMMENDERS:
+            raise ValueError(f'Incorrect value of "recommender" parameter: {recommender_name}')
+        if strategy not in ('grid', 'random', 'halving'):
+            raise ValueError(f'Incorrect value of "strategy" parameter: {strategy}')
+        if metric not in METRICS:
+            raise ValueError(f'Incorrect value of "metric" parameter: {metric}')
+        self.recommender_name = recommender_name
+        self.parameter_space = parameter_space
+        self.results_file = results_file
+        self.strategy = strategy
+        self.n_trials = n_trials
+        self.metric = metric
+        self.K = K
+        self.min_iterations = min_iterations
+        self.max_iterations = max_iterations
+        self.eta = eta
+        self.workers = workers
+        self.min_interactions = min_interactions
+        self.random_state = random_state
+
+    def get_configurations(self) -> List[Dict[str, Any]]:
+        parameter_space = self.parameter_space
+        if self.strategy == 'halving':
+            # the number of iterations is set by the budget of the halving round
+            parameter_space = {name: values for name, values in parameter_space.items() if name != 'iterations'}
+        if self.strategy == 'grid':
+            return list(ParameterGrid(parameter_space))
+        return list(ParameterSampler(parameter_space, n_iter=self.n_trials, random_state=self.random_state))
+
+    def read_results(self) -> pd.DataFrame:
+        if Path(self.results_file).is_file():
+            results = pd.read_csv(self.results_file)
+            if list(results.columns) != RESULT_COLUMNS:
+                raise ValueError(f'{self.results_file} has different columns, it cannot be resumed: '
+                                 f'{list(results.columns)}')
+            return results
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+
+    def _save_result(self, row: Dict[str, Any]) -> None:
+        header = not Path(self.results_file).is_file()
+        pd.DataFrame([row], columns=RESULT_COLUMNS).to_csv(self.results_file, mode='a', header=header, index=False)
+
+    def _evaluate(self,
+                  executor: Optional[ProcessPoolExecutor],
+                  file_name: str,
+                  configurations: List[Dict[str, Any]],
+                  num_of_threads: int) -> pd.DataFrame:
+        """
+        :return: the results of the configurations for the region, evaluated now or read from the results table
+        """
+        results = self.read_results()
+        results = results.loc[(results['region'] == Path(file_name).stem) &
+                              (results['recommender'] == self.recommender_name) &
+                              (results['settings'] == get_settings_key(self.K, self.min_interactions,
+                                                                       self.random_state))]
+        done = set(results['params'])
+        pending = [params for params in configurations if json.dumps(params, sort_keys=True) not in done]
+
+        arguments = (file_name, self.K, self.min_interactions, self.random_state, num_of_threads)
+        if executor is None:
+            rows = (evaluate_configuration(self.recommender_name, params, *arguments) for params in pending)
+        else:
+            rows = executor.map(evaluate_configuration, [self.recommender_name] * len(pending), pending,
+                                *[[argument] * len(pending) for argument in arguments])
+        new_rows = list()
+        for row in rows:
+            self._save_result(row)
+            new_rows.append(row)
+
+        keys = {json.dumps(params, sort_keys=True) for params in configurations}
+        results = pd.concat([results, pd.DataFrame(new_rows, columns=RESULT_COLUMNS)], ignore_index=True)
+        return results.loc[results['params'].isin(keys)].drop_duplicates('params', keep='last')
+
+    def run_region(self, file_name: str, executor: Optional[ProcessPoolExecutor] = None,
+                   num_of_threads: int = 0) -> pd.Series:
+        """
+        Searches the best configuration for one regional user-event table.
+
+        :return: the results table row of the best configuration
+        """
+        configurations = self.get_configurations()
+        if self.strategy != 'halving':
+            results = self._evaluate(executor, file_name, configurations, num_of_threads)
+            return results.sort_values(self.metric, ascending=False).iloc[0]
+
+        iterations = self.min_iterations
+        while True:
+            budget = [{**params, 'iterations': iterations} for params in configurations]
+            results = self._evaluate(executor, file_name, budget, num_of_threads)
+            results = results.sort_values(self.metric, ascending=False)
+            if len(configurations) <= 1 or iterations >= self.max_iterations:
+                return results.iloc[0]
+            survivors = set(results['params'].iloc[:max(1, len(configurations) // self.eta)])
+            configurations = [params for params, budget_params in zip(configurations, budget)
+                              if json.dumps(budget_params, sort_keys=True) in survivors]
+            iterations = min(iterations * self.eta, self.max_iterations)
+
+    def run(self, file_names: List[str]) -> pd.DataFrame:
+        """
+        Runs the search for every region, configurations of a region are evaluated in parallel.
+
+        :return: a table with the best configuration of every region
+        """
+        if self.workers == 1:
+            return pd.DataFrame([self.run_region(file_name) for file_name in file_names])
+
+        num_of_threads = max(1, (os.cpu_count() or 1) // self.workers)
+        with parallel.worker_pool(self.workers) as executor:
+            return pd.DataFrame([self.run_region(file_name, executor, num_of_threads) for file_name in file_names])
+
+
+parser = argparse.ArgumentParser(
+    prog='search',
+    description='Searching the best recommender parameters for regional user-event tables.'
+)
+
+parser.add_argument(
+    'recommender',
+    type=str,
+    help='short designation of the recommender model:\n'
+         '- als: Alternative Least Squares;'
+         '- bpr: Bayesian Personalized Ranking.'
+)
+
+parser.add_argument(
+    'user_event_df',
+    type=str,
+    help='a user_event_df file name OR a name of the directory where these files are stored.'
+)
+
+parser.add_argument(
+    'parameter_space',
+    type=str,
+    help='a .json file with the lists of values for every recommender parameter, e.g. '
+         '{"factors": [32, 64], "regularization": [0.01, 0.1], "confidence": ["alpha"], "alpha_value": [1, 15]}.'
+)
+
+parser.add_argument(
+    'results_file',
+    type=str,
+    help='a .csv file with the results table; the search is resumed if it exists.'
+)
+
+parser.add_argument('-strategy', type=str, default='random', choices=['grid', 'random', 'halving'], action='store')
+parser.add_argument('-n_trials', type=int, default=20, help='a number of sampled configurations.', action='store')
+parser.add_argument('-metric', type=str, default='ndcg', choices=list(METRICS), action='store')
+parser.add_argument('-K', type=int, default=10, help='a number of recommended items.', action='store')
+parser.add_argument('-min_interactions', type=int, default=2,
+                    help='users with fewer interactions are not evaluated (see leave_one_out_split).', action='store')
+parser.add_argument('-min_iterations', type=int, default=5, action='store')
+parser.add_argument('-max_iterations', type=int, default=100, action='store')
+parser.add_argument('-eta', type=int, default=3, help='a share of configurations kept by a halving round is 1/eta.',
+                    action='store')
+parser.add_argument('-workers', '--workers', type=int, default=1, help='a number of worker processes.',
+                    action='store')
+parser.add_argument('-regions', type=int, nargs='+', help='codes of the user regions to search parameters for.',
+                    action='store')
+parser.add_argument('-random_state', type=int, default=0, action='store')
+parser.add_argument(
+    '-log_file',
+    type=str,
+    help='a file the JSON log lines are appended to; they are written to stderr in any case.',
+    action='store'
+)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logger = instr.configure_logging(args.log_file)
+    logger.info('searching parameters ...')
+
+    if args.workers < 1:
+        raise ValueError(f'Incorrect value of "workers" parameter: {args.workers}')
+
+    with open(args.parameter_space, 'r') as json_file:
+        parameter_space = json.load(json_file)
+
+    if Path(args.user_event_df).is_file():
+        files = [args.user_event_df]
+    elif Path(args.user_event_df).is_dir():
+        files = storage.list_partitions(args.user_event_df, args.regions)
+    else:
+        raise OSError(f'Incorrect value of "user_event_df" parameter: file or directory {args.user_event_df}'
+                      f'does not exist.')
+
+    search = ParameterSearch(
+        recommender_name=args.recommender,
+        parameter_space=parameter_space,
+        results_file=args.results_file,
+        strategy=args.strategy,
+        n_trials=args.n_trials,
+        metric=args.metric,
+        K=args.K,
+        min_interactions=args.min_interactions,
+        min_iterations=args.min_iterations,
+        max_iterations=args.max_iterations,
+        eta=args.eta,
+        workers=args.workers,
+        random_state=args.random_state
+    )
+    best = search.run(files)
+    for row in best.loc[:, ['region', 'params', 'iterations', args.metric]].to_dict('records'):
+        logger.info('best parameters', extra={'fields': row})
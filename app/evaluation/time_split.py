@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from pathlib import Path
+from typing import Dict, List, Optional, Any, Iterable, Tuple
+
+from app.pipeline import preprocessing as prs
+from app.pipeline import filtering as ftr
+from app.pipeline import storage
+from app.pipeline import instrumentation as instr
+from app.recommenders.implicit_models import UserItemRecommender, ALSRecommender, BPRRecommender, DEFAULT_BLOCK_SIZE
+from app.recommenders.implicit_models import build_user_item_matrix
+from app.recommenders.encoding import IdEncoder
+from app.evaluation.cross_validation import METRICS, score_held_out
+
+RECOMMENDERS = {
+    'als': ALSRecommender,
+    'bpr': BPRRecommender
+}
+
+DEFAULT_STORAGE_FORMAT = 'parquet'
+
+
+def split_clicks_by_time(
+        clicks_file_path: str,
+        cutoff: str,
+        users_df: pd.DataFrame,
+        events_df: pd.DataFrame,
+        output_directory: str,
+        storage_format: str = DEFAULT_STORAGE_FORMAT,
+        chunksize: Optional[int] = None,
+        same_region_only: bool = True
+) -> List[str]:
+    """
+    Counts clicks before and after the cutoff and saves both user-event tables partitioned by regions:
+    output_directory/train/<partition> and output_directory/test/<partition>, where <partition> is
+    storage.get_partition_name(user region, event region).
+
+    The partitions are written into a temporary directory inside output_directory and replace the train and test
+    directories of a previous split only when all of them are saved, so no partition of another cutoff is left.
+    split.json with the cutoff is written last and marks a complete split.
+
+    :return: a list of the saved train partitions
+    """
+    train, test = prs.get_time_split_user_event_dataframes(clicks_file_path, cutoff, chunksize)
+    output_directory = Path(output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    temporary_directory = Path(tempfile.mkdtemp(prefix='.split_', dir=output_directory))
+    try:
+        train_directory, test_directory = temporary_directory / 'train', temporary_directory / 'test'
+        train_directory.mkdir()
+        test_directory.mkdir()
+
+        partition_names = list()
+        region_pairs = list()
+        for (user_region, event_region), partition in ftr.partition_user_event_df(
+                train, users_df, events_df, same_region_only=same_region_only):
+            partition_name = storage.get_partition_name(user_region, event_region)
+            file_name = storage.write_table(partition, str(train_directory / partition_name), storage_format,
+                                            storage.USER_EVENT_DTYPES)
+            partition_names.append(Path(file_name).name)
+            region_pairs.append((user_region, event_region))
+        for (user_region, event_region), partition in ftr.partition_user_event_df(
+                test, users_df, events_df, region_pairs):
+            storage.write_table(partition, str(test_directory / storage.get_partition_name(user_region, event_region)),
+                                storage_format, storage.USER_EVENT_DTYPES)
+
+        split_file = output_directory / 'split.json'
+        if split_file.exists():
+            split_file.unlink()
+        for part in ('train', 'test'):
+            if (output_directory / part).exists():
+                shutil.rmtree(output_directory / part)
+            os.replace(temporary_directory / part, output_directory / part)
+    finally:
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+    with open(output_directory / 'split.json', 'w') as json_file:
+        json.dump({'cutoff': cutoff}, json_file)
+    return [str(output_directory / 'train' / partition_name) for partition_name in partition_names]
+
+
+class TimeSplitEvaluator:
+    """
+    Evaluates recommenders on the regional train/test tables saved by split_clicks_by_time. The numerated train table
+    and the test interactions of every region are read and prepared once and reused for every evaluated model.
+
+    Only test interactions of users and items known from the train part and not clicked by the user before the cutoff
+    are evaluated: a recommender filters out the clicked items and cannot score unknown users and items.
+    """
+
+    def __init__(self, split_directory: str, K: int = 10, block_size: int = DEFAULT_BLOCK_SIZE):
+        self.split_directory = split_directory
+        self.K = K
+        self.block_size = block_size
+        self._cache = dict()
+        self._matrices = dict()
+
+    def get_partitions(self, user_region_codes: Optional[Iterable[int]] = None) -> List[str]:
+        return [Path(file_name).stem for file_name in
+                storage.list_partitions(str(Path(self.split_directory) / 'train'), user_region_codes)]
+
+    def get_region(self, partition_name: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        :return: the numerated train user-item dataframe and the test interactions with train user and item numbers
+        """
+        if partition_name not in self._cache:
+            train = storage.read_table(
+                storage.find_table(str(Path(self.split_directory) / 'train'), partition_name),
+                storage.USER_EVENT_DTYPES
+            )
+            train = ftr.numerate_user_event_df(train).rename(columns={
+                'event_id': 'item_id',
+                'event_num': 'item_num',
+                'clicks_count': 'rating'
+            })
+            try:
+                test = storage.read_table(
+                    storage.find_table(str(Path(self.split_directory) / 'test'), partition_name),
+                    storage.USER_EVENT_DTYPES
+                )
+            except OSError:
+                test = pd.DataFrame(columns=['user_id', 'event_id'])
+
+            user_nums = pd.Series(train['user_num'].values, index=train['user_id'].astype(str)).drop_duplicates()
+            item_nums = pd.Series(train['item_num'].values, index=train['item_id'].values).drop_duplicates()
+            test = pd.DataFrame({
+                'user_num': test['user_id'].astype(str).map(user_nums).values,
+                'item_num': test['event_id'].map(item_nums).values
+            }).dropna().astype(int)
+            clicked = train.loc[:, ['user_num', 'item_num']].assign(clicked=True)
+            test = test.merge(clicked, on=['user_num', 'item_num'], how='left')
+            test = test.loc[test['clicked'].isna(), ['user_num', 'item_num']].drop_duplicates()
+            self._cache[partition_name] = train, test
+        return self._cache[partition_name]
+
+    def get_train_matrix(self, partition_name: str) -> Tuple[sparse.csr_matrix, np.ndarray, np.ndarray]:
+        """
+        :return: the user-item matrix of the train part of the region with its user and item ids, built once for all
+        evaluated models
+        """
+        if partition_name not in self._matrices:
+            train, _ = self.get_region(partition_name)
+            user_encoder = IdEncoder.from_columns(train['user_id'], train['user_num'])
+            item_encoder = IdEncoder.from_columns(train['item_id'], train['item_num'])
+            matrix = build_user_item_matrix(train['user_num'], train['item_num'], train['rating'],
+                                            shape=(len(user_encoder), len(item_encoder)))
+            self._matrices[partition_name] = matrix, user_encoder.ids, item_encoder.ids
+        return self._matrices[partition_name]
+
+    def evaluate(self, recommender: UserItemRecommender, partition_name: str) -> Dict[str, Any]:
+        """
+        Fits the recommender on the train part of the region and scores the test interactions.
+
+        :return: a row with the region, metrics, number of evaluated users and fit time
+        """
+        _, test = self.get_region(partition_name)
+        matrix, user_ids, item_ids = self.get_train_matrix(partition_name)
+        start = time.perf_counter()
+        recommender.fit_matrix(matrix, user_ids, item_ids, show_progress=False)
+        fit_seconds = time.perf_counter() - start
+        metrics = score_held_out(recommender, test, self.K, self.block_size)
+        return {
+            'region': partition_name,
+            **metrics,
+            'num_of_users': test['user_num'].nunique(),
+            'fit_seconds': round(fit_seconds, 3)
+        }
+
+    def evaluate_all(self,
+                     recommenders: Dict[str, UserItemRecommender],
+                     user_region_codes: Optional[Iterable[int]] = None) -> pd.DataFrame:
+        """
+        Evaluates every recommender on every region in one pass over the regions, so the data of a region is prepared
+        once for all models.
+
+        :param recommenders: recommenders by their names
+        :return: a table with a row per region and recommender
+        """
+        rows = list()
+        for partition_name in self.get_partitions(user_region_codes):
+            for name, recommender in recommenders.items():
+                rows.append({'recommender': name, **self.evaluate(recommender, partition_name)})
+            # regions are evaluated one after another, the data of the previous one is not needed any more
+            self._cache.pop(partition_name, None)
+            self._matrices.pop(partition_name, None)
+        return pd.DataFrame(rows, columns=['recommender', 'region', *METRICS, 'num_of_users', 'fit_seconds'])
+
+
+def summarize(results: pd.DataFrame) -> pd.DataFrame:
+    """
+    :return: the metrics of every recommender averaged over the regions weighted by the number of evaluated users
+    """
+    weighted = results.loc[:, METRICS].multiply(results['num_of_users'], axis=0)
+    weighted = weighted.assign(recommender=results['recommender'], num_of_users=results['num_of_users'])
+    summary = weighted.groupby('recommender').sum()
+    summary.loc[:, METRICS] = summary.loc[:, METRICS].divide(summary['num_of_users'].clip(lower=1), axis=0)
+    return summary.round(4).reset_index()
+
+
+parser = argparse.ArgumentParser(
+    prog='time_split',
+    description='Splitting clicks by time and evaluating recommenders on the future clicks of every region.'
+)
+
+parser.add_argument(
+    'clicks_file',
+    type=str,
+    help='.csv file containing information about users clicks'
+)
+
+parser.add_argument(
+    'preprocessed_directory',
+    type=str,
+    help='a directory with user_df and events_df tables saved by prepare_dataframes.py.'
+)
+
+parser.add_argument(
+    'cutoff',
+    type=str,
+    help='clicks made before this time are used for training, e.g. 2021-12-01.'
+)
+
+parser.add_argument(
+    'split_directory',
+    type=str,
+    help='a directory for the train and test regional tables; the saved split is reused if it has the same cutoff.'
+)
+
+parser.add_argument(
+    'results_file',
+    type=str,
+    help='a .csv file for the metrics of every recommender in every region.'
+)
+
+parser.add_argument(
+    '-recommenders',
+    type=str,
+    nargs='+',
+    default=['als', 'bpr'],
+    help='short designations of the evaluated recommender models.',
+    action='store'
+)
+
+parser.add_argument(
+    '-params',
+    type=str,
+    help='a .json file with recommender parameters by recommender designation, e.g. '
+         '{"als": {"confidence": "alpha", "alpha_value": 15}}.',
+    action='store'
+)
+
+parser.add_argument('-K', type=int, default=10, help='a number of recommended items.', action='store')
+parser.add_argument('-regions', type=int, nargs='+', help='codes of the user regions to evaluate.', action='store')
+parser.add_argument('-chunksize', type=int, help='a number of rows of the clicks file read at once.', action='store')
+parser.add_argument('-storage_format', type=str, default=DEFAULT_STORAGE_FORMAT,
+                    choices=list(storage.STORAGE_FORMATS), action='store')
+parser.add_argument(
+    '-log_file',
+    type=str,
+    help='a file the JSON log lines are appended to; they are written to stderr in any case.',
+    action='store'
+)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logger = instr.configure_logging(args.log_file)
+    logger.info('evaluating recommenders on the time split ...')
+
+    params = {'als': {'confidence': 'alpha', 'alpha_value': 15}}
+    if args.params is not None:
+        with open(args.params, 'r') as json_file:
+            params = json.load(json_file)
+    for name in args.recommenders:
+        if name not in RECOMMENDERS:
+            raise ValueError(f'Incorrect value of "recommenders" parameter: {name}')
+
+    split_file = Path(args.split_directory) / 'split.json'
+    saved_cutoff = None
+    if split_file.is_file():
+        with open(split_file, 'r') as json_file:
+            saved_cutoff = json.load(json_file)['cutoff']
+    if saved_cutoff != args.cutoff:
+        users_df = storage.read_table(storage.find_table(args.preprocessed_directory, 'user_df'), storage.USER_DTYPES)
+        events_df = storage.read_table(storage.find_table(args.preprocessed_directory, 'events_df'),
+                                       storage.EVENT_DTYPES)
+        split_clicks_by_time(args.clicks_file, args.cutoff, users_df, events_df, args.split_directory,
+                             args.storage_format, args.chunksize)
+
+    evaluator = TimeSplitEvaluator(args.split_directory, K=args.K)
+    results = evaluator.evaluate_all(
+        {name: RECOMMENDERS[name](**params.get(name, dict())) for name in args.recommenders},
+        args.regions
+    )
+    results.to_csv(args.results_file, index=False)
+    for row in summarize(results).to_dict('records'):
+        logger.info('summary', extra={'fields': row})
@@ -1,13 +1,22 @@
 # TODO 1: passing model parameters
 # TODO 2: model tuning
-# TODO 3: add logger
 
+import os
+import time
 import argparse
+import functools
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import pipeline.filtering as ftr
-from recommenders.implicit_models import ALSRecommender, BPRRecommender
+from pipeline import storage
+from pipeline import instrumentation as instr
+from pipeline import parallel
+from recommenders.implicit_models import UserItemRecommender, ALSRecommender, BPRRecommender, DEFAULT_BLOCK_SIZE
+from recommenders.ann import ann_recall_report
 from pathlib import Path
+from typing import List, Tuple, Optional
+from concurrent.futures import as_completed
 
 parser = argparse.ArgumentParser(
     prog='make_recommendations',
@@ -40,57 +49,452 @@ parser.add_argument(
     help='a type of output file with user recommendation:\n'
          '-json'
          '-csv'
+         '-bin: a directory with fixed-width binary arrays and a sorted user index '
+         '(see recommenders.binary_format);'
+         '-similar: the 10 most similar events of every event instead of user recommendations, saved as '
+         '<region>_similar in the bin format keyed by the event id.'
+)
+
+parser.add_argument(
+    '-block_size',
+    type=int,
+    default=DEFAULT_BLOCK_SIZE,
+    help='a number of users scored at once; bounds peak memory of the batched recommendation.',
+    action='store'
+)
+
+parser.add_argument(
+    '-workers', '--workers',
+    type=int,
+    default=1,
+    help='a number of worker processes; regions are distributed over a process pool when it is greater than 1.',
+    action='store'
+)
+
+parser.add_argument(
+    '-regions',
+    type=int,
+    nargs='+',
+    help='codes of the user regions to make recommendations for; all regional files are processed by default.',
+    action='store'
+)
+
+parser.add_argument(
+    '-changed_regions',
+    type=str,
+    help='a changed_regions.json file saved by prepare_dataframes.py -incremental; only the regional tables listed '
+         'there are processed.',
+    action='store'
+)
+
+parser.add_argument(
+    '-models_directory',
+    type=str,
+    help='a directory where fitted models are saved, one subdirectory per region.',
+    action='store'
+)
+
+parser.add_argument(
+    '-warm_start',
+    help='refit the models saved in models_directory with the new interactions instead of training from scratch.',
+    action='store_true'
+)
+
+parser.add_argument(
+    '-ann_probe',
+    type=int,
+    help='a number of item clusters scanned per user; enables the approximate top-N search when passed.',
+    action='store'
+)
+
+parser.add_argument(
+    '-ann_lists',
+    type=int,
+    help='a number of item clusters of the approximate search, sqrt(number of items) by default.',
+    action='store'
+)
+
+parser.add_argument(
+    '-ann_report',
+    help='save the recall of the approximate search against the exact one for a grid of parameters '
+         'as <region>_ann_report.csv into output_directory.',
+    action='store_true'
+)
+
+parser.add_argument(
+    '-national',
+    help='fit one recommender on the clicks of all regional files of the user_event_df directory instead of one '
+         'recommender per file; recommendations are saved per regional file, the candidates of its users are '
+         'restricted to the events of its event region.',
+    action='store_true'
+)
+
+parser.add_argument(
+    '-future_events_df',
+    type=str,
+    help='a future_events_df file saved by prepare_dataframes.py; the clicked events absent from it are over and are '
+         'never recommended.',
+    action='store'
+)
+
+parser.add_argument(
+    '-prune_past_events',
+    help='drop the clicks of the events that are over before fitting, so they are not in the user-item matrix at '
+         'all; requires -future_events_df.',
+    action='store_true'
+)
+
+parser.add_argument(
+    '-compress',
+    help='compress the recommendation files with gzip (.json.gz or .csv.gz).',
+    action='store_true'
+)
+
+parser.add_argument(
+    '-score_dtype',
+    type=str,
+    default='float16',
+    choices=['float16', 'float32'],
+    help='a type of the scores saved in the bin and similar output files.',
+    action='store'
+)
+
+parser.add_argument(
+    '-log_file',
+    type=str,
+    help='a file the JSON log lines of the stages are appended to; they are written to stderr in any case.',
+    action='store'
+)
+
+parser.add_argument(
+    '-profile',
+    type=str,
+    choices=list(instr.PROFILE_MODES),
+    help='profile the run with cProfile (statistics are saved into -profile_file) or tracemalloc (the top '
+         'allocations are logged); with workers > 1 only the main process is profiled.',
+    action='store'
+)
+
+parser.add_argument(
+    '-profile_file',
+    type=str,
+    default='make_recommendations.prof',
+    help='a file for the cProfile statistics.',
+    action='store'
 )
 
 args = parser.parse_args()
 
 
-def run_recommender(file_name: str) -> None:
-    user_event_df = pd.read_csv(file_name)
-    user_event_df = ftr.numerate_user_event_df(user_event_df)
-    user_event_df = user_event_df.rename(columns={
+def get_recommender(recommender_name: str, num_of_threads: int = 0) -> UserItemRecommender:
+    if recommender_name == 'als':
+        return ALSRecommender(
+            confidence='alpha',
+            alpha_value=15,
+            num_of_threads=num_of_threads
+        )
+    elif recommender_name == 'bpr':
+        return BPRRecommender(num_of_threads=num_of_threads)
+    else:
+        raise ValueError(f'Incorrect value of "recommender" parameter: {recommender_name}')
+
+
+def fit_recommender(
+        recommender: UserItemRecommender,
+        user_event_df: pd.DataFrame,
+        model_directory: Optional[str] = None,
+        warm_start: bool = False,
+        extra_item_ids: Optional[List[int]] = None
+) -> UserItemRecommender:
+    """
+    Fits the recommender. With warm_start, the model saved in model_directory is loaded and refitted with the new
+    interactions instead of training from scratch (for the models that support refitting).
+
+    :param extra_item_ids: ids of the items that are never recommended, e.g. the events that are over
+    """
+    if warm_start and model_directory is not None and Path(model_directory).is_dir() and hasattr(recommender, 'refit'):
+        recommender.load_state(model_directory, mmap_mode=None)
+        recommender.refit(user_event_df, extra_item_ids)
+    else:
+        recommender.fit(user_event_df, extra_item_ids)
+    if model_directory is not None:
+        recommender.save(model_directory)
+    return recommender
+
+
+@functools.lru_cache(maxsize=1)
+def read_future_events_df(file_name: str) -> pd.DataFrame:
+    """
+    Reads the ids of the future events once per process, every region of a run is filtered with the same table.
+    """
+    return storage.read_table(file_name, columns=['ID'])
+
+
+def read_national_user_event_df(
+        file_names: List[str],
+        future_events_df: Optional[pd.DataFrame] = None
+) -> pd.DataFrame:
+    """
+    Concatenates regional user-event tables into one national user-item table with the user_region and event_region
+    codes of their files. A user is numbered once even if the clicks of the user are split between several files.
+
+    :param future_events_df: if passed, the clicks of the events absent from it are dropped
+    """
+    user_event_dfs = list()
+    for file_name in file_names:
+        region_pair = storage.parse_partition_name(file_name)
+        if region_pair is None:
+            continue
+        user_event_df = storage.read_table(file_name, storage.USER_EVENT_DTYPES)
+        if future_events_df is not None:
+            user_event_df = ftr.filter_user_event_by_future_events(user_event_df, future_events_df)
+        user_event_dfs.append(user_event_df.assign(user_region=region_pair[0], event_region=region_pair[1]))
+    if len(user_event_dfs) == 0:
+        raise OSError('No regional user-event tables were found for the national model.')
+    user_event_df = ftr.numerate_user_event_df(pd.concat(user_event_dfs, ignore_index=True))
+    return user_event_df.rename(columns={
             'event_id': 'item_id',
             'event_num': 'item_num',
             'clicks_count': 'rating'
         }
     )
-    recommender.fit(user_event_df)
-    recommender.get_all_recommendation()
 
-    if args.output_file_type == 'json':
-        recommender.to_json(f'{args.output_directory}/{Path(file_name).stem}_rec')
-    elif args.output_file_type == 'csv':
-        recommender.to_csv(f'{args.output_directory}/{Path(file_name).stem}_rec')
-    else:
-        raise ValueError(f'Incorrect value of "output_file_type" parameter: {args.output_file_type}')
 
+def fit_region(
+        recommender: UserItemRecommender,
+        user_event_df: pd.DataFrame,
+        region: str,
+        options: argparse.Namespace,
+        extra_item_ids: Optional[List[int]] = None
+) -> None:
+    model_directory = None
+    if options.models_directory is not None:
+        model_directory = f'{options.models_directory}/{region}'
+    with instr.stage('fit', region=region, recommender=options.recommender) as metrics:
+        fit_recommender(recommender, user_event_df, model_directory, options.warm_start, extra_item_ids)
+        metrics.update({
+            'users': recommender.sparse_user_item.shape[0],
+            'items': recommender.sparse_user_item.shape[1],
+            'nnz': recommender.sparse_user_item.nnz,
+            'extra_items': len(recommender.extra_item_ids or []),
+            'iterations': getattr(recommender, 'iterations', None),
+            'warm_start': options.warm_start
+        })
+    if options.ann_report:
+        with instr.stage('ann_report', region=region):
+            num_of_lists = int(np.sqrt(recommender.model.item_factors.shape[0]))
+            report = ann_recall_report(
+                recommender,
+                n_lists_values=sorted({max(1, num_of_lists // 2), max(1, num_of_lists), max(1, num_of_lists * 2)}),
+                n_probe_values=[1, 2, 4, 8, 16, 32]
+            )
+            report.to_csv(f'{options.output_directory}/{region}_ann_report.csv', index=False)
+    if options.ann_probe is not None:
+        with instr.stage('ann_index', region=region, n_probe=options.ann_probe):
+            recommender.build_ann_index(n_lists=options.ann_lists, n_probe=options.ann_probe)
 
-if __name__ == "__main__":
-    print('INFO: making recommendations ...')
 
-    if args.recommender == 'als':
-        recommender = ALSRecommender(
-            confidence='alpha',
-            alpha_value=15
+def save_recommendations(
+        recommender: UserItemRecommender,
+        region: str,
+        options: argparse.Namespace,
+        user_nums: Optional[np.ndarray] = None,
+        item_mask: Optional[np.ndarray] = None
+) -> None:
+    # recommendations are written block by block as they are calculated
+    file_name = f'{options.output_directory}/{region}_rec'
+    with instr.stage('recommend', region=region, output_file_type=options.output_file_type) as metrics:
+        if options.output_file_type == 'json':
+            metrics['recommendations'] = recommender.to_json(file_name, block_size=options.block_size,
+                                                             compress=options.compress, user_nums=user_nums,
+                                                             item_mask=item_mask)
+        elif options.output_file_type == 'csv':
+            metrics['recommendations'] = recommender.to_csv(file_name, block_size=options.block_size,
+                                                            compress=options.compress, user_nums=user_nums,
+                                                            item_mask=item_mask)
+        elif options.output_file_type == 'bin':
+            metrics['recommendations'] = recommender.to_binary(file_name, block_size=options.block_size,
+                                                               score_dtype=options.score_dtype, user_nums=user_nums,
+                                                               item_mask=item_mask)
+        elif options.output_file_type == 'similar':
+            metrics['similar_items'] = recommender.to_similar_items(f'{options.output_directory}/{region}_similar',
+                                                                    block_size=options.block_size,
+                                                                    score_dtype=options.score_dtype,
+                                                                    item_mask=item_mask)
+        else:
+            raise ValueError(f'Incorrect value of "output_file_type" parameter: {options.output_file_type}')
+
+
+def run_recommender(
+        recommender: UserItemRecommender,
+        file_name: str,
+        options: argparse.Namespace
+) -> None:
+    region = Path(file_name).stem
+    extra_item_ids = None
+    with instr.stage('read', region=region) as metrics:
+        user_event_df = storage.read_table(file_name, storage.USER_EVENT_DTYPES)
+        if options.future_events_df is not None:
+            future_events_df = read_future_events_df(options.future_events_df)
+            if options.prune_past_events:
+                user_event_df = ftr.filter_user_event_by_future_events(user_event_df, future_events_df)
+            extra_item_ids = ftr.get_extra_events_ids(user_event_df, future_events_df)
+        metrics['rows'] = len(user_event_df)
+        if len(user_event_df) == 0 or (extra_item_ids is not None and
+                                       len(extra_item_ids) == user_event_df['event_id'].nunique()):
+            # all clicked events of the region are over, there is nothing to recommend
+            metrics['skipped'] = True
+            return
+        user_event_df = ftr.numerate_user_event_df(user_event_df)
+        user_event_df = user_event_df.rename(columns={
+                'event_id': 'item_id',
+                'event_num': 'item_num',
+                'clicks_count': 'rating'
+            }
         )
-    elif args.recommedner == 'bpr':
-        recommender = BPRRecommender()
-    else:
+    fit_region(recommender, user_event_df, region, options, extra_item_ids)
+    save_recommendations(recommender, region, options)
+
+
+def run_national_recommender(
+        recommender: UserItemRecommender,
+        file_names: List[str],
+        options: argparse.Namespace
+) -> None:
+    """
+    Fits a single recommender on the national table made of all regional files of the user_event_df directory and
+    saves the recommendations of every file of file_names: its users get the events of its event region only, the
+    other items are hidden by the region-item mask at scoring time.
+    """
+    extra_item_ids = None
+    with instr.stage('read', region='national') as metrics:
+        future_events_df = None
+        if options.future_events_df is not None:
+            future_events_df = read_future_events_df(options.future_events_df)
+        user_event_df = read_national_user_event_df(
+            storage.list_partitions(options.user_event_df),
+            future_events_df if options.prune_past_events else None
+        )
+        if future_events_df is not None:
+            extra_item_ids = ftr.get_extra_events_ids(user_event_df, future_events_df, 'item_id')
+        metrics['rows'] = len(user_event_df)
+    fit_region(recommender, user_event_df, 'national', options, extra_item_ids)
+
+    region_codes, region_item_mask = ftr.get_region_item_mask(
+        user_event_df['item_num'],
+        user_event_df['event_region'],
+        recommender.model.item_factors.shape[0]
+    )
+    users_per_region = user_event_df.groupby(['user_region', 'event_region'])['user_num'].unique()
+    for file_name in file_names:
+        region_pair = storage.parse_partition_name(file_name)
+        if region_pair is None or region_pair not in users_per_region.index:
+            continue
+        user_nums = np.sort(users_per_region[region_pair].astype(np.int64))
+        item_mask = region_item_mask[np.searchsorted(region_codes, region_pair[1])].toarray().ravel()
+        extra_item_mask = recommender.get_extra_item_mask()
+        if extra_item_mask is not None and not np.any(item_mask & extra_item_mask):
+            # all events of the region are over
+            continue
+        save_recommendations(recommender, Path(file_name).stem, options, user_nums, item_mask)
+
+
+def run_region(
+        file_name: str,
+        options: argparse.Namespace,
+        num_of_threads: int
+) -> Tuple[str, float]:
+    """
+    Worker entry point: every region gets its own recommender instance, so no model state is shared between processes.
+
+    :return: the region file name and the processing time in seconds
+    """
+    # the worker process imports this module without running the main block
+    instr.configure_logging(options.log_file)
+    start = time.perf_counter()
+    recommender = get_recommender(options.recommender, num_of_threads)
+    run_recommender(recommender, file_name, options)
+    return file_name, time.perf_counter() - start
+
+
+def run_regions_in_parallel(
+        file_names: List[str],
+        options: argparse.Namespace
+) -> Tuple[List[Tuple[str, float]], List[Tuple[str, str]]]:
+    """
+    Distributes regional files over a process pool. The largest files are submitted first (longest-processing-time
+    scheduling), so the tail of the run is made of small regions. A failed region does not stop the other ones.
+
+    :return: a list of (file name, seconds) for processed regions and a list of (file name, error) for failed ones
+    """
+    file_names = sorted(file_names, key=lambda file_name: Path(file_name).stat().st_size, reverse=True)
+    num_of_threads = max(1, (os.cpu_count() or 1) // options.workers)
+
+    results, failures = list(), list()
+    with parallel.worker_pool(options.workers) as executor:
+        futures = {
+            executor.submit(run_region, file_name, options, num_of_threads): file_name
+            for file_name in file_names
+        }
+        for future in tqdm(iterable=as_completed(futures), desc='Making recommendations', total=len(futures)):
+            try:
+                results.append(future.result())
+            except Exception as error:
+                failures.append((futures[future], repr(error)))
+    return results, failures
+
+
+if __name__ == "__main__":
+    logger = instr.configure_logging(args.log_file)
+    logger.info('making recommendations ...')
+
+    if args.recommender not in ('als', 'bpr'):
         raise ValueError(f'Incorrect value of "recommender" parameter: {args.recommender}')
 
+    if args.output_file_type not in ('json', 'csv', 'bin', 'similar'):
+        raise ValueError(f'Incorrect value of "output_file_type" parameter: {args.output_file_type}')
+
+    if args.workers < 1:
+        raise ValueError(f'Incorrect value of "workers" parameter: {args.workers}')
+
+    if args.prune_past_events and args.future_events_df is None:
+        raise ValueError('"prune_past_events" parameter requires "future_events_df" parameter.')
+
+    if args.future_events_df is not None and not Path(args.future_events_df).is_file():
+        raise OSError(f'File {args.future_events_df} was not found.')
+
+    if args.national and not Path(args.user_event_df).is_dir():
+        raise ValueError('"national" parameter requires a directory with regional user_event_df files.')
+
     if not Path(args.output_directory).is_dir():
         raise OSError(f'Incorrect value of "output_dir" parameter: directory {args.output_directory}'
                       f'does not exist.')
 
-    if Path(args.user_event_df).is_file():
-        run_recommender(args.user_event_df)
-    elif Path(args.user_event_df).is_dir():
-        count = 0
-        for path in Path(args.user_event_df).iterdir():
-            if path.is_file():
-                count += 1
-        for file in tqdm(iterable=Path(args.user_event_df).iterdir(), desc='Making recommendations', total=count):
-            run_recommender(str(file))
-    else:
-        raise OSError(f'Incorrect value of "user_event_df" parameter: file or directory {args.user_event_df}'
-                      f'does not exist.')
+    with instr.profile(args.profile, args.profile_file), instr.stage('make_recommendations') as total:
+        if Path(args.user_event_df).is_file():
+            recommender = get_recommender(args.recommender)
+            run_recommender(recommender, args.user_event_df, args)
+            total['regions'] = 1
+        elif Path(args.user_event_df).is_dir():
+            changed_region_pairs = None
+            if args.changed_regions is not None:
+                changed_region_pairs = storage.read_changed_regions(args.changed_regions)
+            files = storage.list_partitions(args.user_event_df, args.regions, changed_region_pairs)
+            total['regions'] = len(files)
+            if args.national:
+                recommender = get_recommender(args.recommender)
+                run_national_recommender(recommender, files, args)
+            elif args.workers == 1:
+                recommender = get_recommender(args.recommender)
+                for file in tqdm(iterable=files, desc='Making recommendations', total=len(files)):
+                    run_recommender(recommender, file, args)
+            else:
+                processed, failed = run_regions_in_parallel(files, args)
+                logger.info(f'{len(processed)} regions processed, {len(failed)} failed.')
+                if len(failed) != 0:
+                    for file, error in failed:
+                        logger.error(f'{file}: {error}', extra={'fields': {'region': Path(file).stem}})
+                    raise RuntimeError(f'Recommendations were not made for {len(failed)} regions.')
+        else:
+            raise OSError(f'Incorrect value of "user_event_df" parameter: file or directory {args.user_event_df}'
+                          f'does not exist.')
@@ -1,6 +1,8 @@
+import functools
 import numpy as np
 import pandas as pd
-from typing import List, Union, Optional
+import scipy.sparse as sparse
+from typing import List, Union, Optional, Iterable, Iterator, Tuple, Dict, Sequence
 
 
 def filter_user_event_df_by_user_age(
@@ -9,7 +11,7 @@ def filter_user_event_df_by_user_age(
         user_age: Optional[Union[int, List[int]]]
 ) -> pd.DataFrame:
     if isinstance(user_age, list) and len(user_age) == 2:
-        users_by_age = user_df.loc[(user_df['age'] >= user_age[0]) |
+        users_by_age = user_df.loc[(user_df['age'] >= user_age[0]) &
                                    (user_df['age'] <= user_age[1])]
     elif isinstance(user_age, int):
         users_by_age = user_df.loc[user_df['age'] == user_age]
@@ -58,18 +60,206 @@ def filter_user_event_by_event_region(
     return user_event
 
 
+class UserEventIndex:
+    """
+    Row positions of user_event_df per user region code, user age (or age bucket) and event region code, built once.
+    A combination of filters is resolved by intersecting the sorted position arrays instead of isin over the whole
+    table on every call:
+
+        index = UserEventIndex(user_event_df, users_df, events_df, age_bins=(0, 18, 25, 35, 150))
+        df = index.filter_user_event_df(user_region=66, user_age=[18, 22], event_region=66)
+        df = index.filter_user_event_df(user_region=66, user_age_bucket=(18, 25), event_region=66)
+
+    A filter takes the values the filter_user_event_* functions take: a code or an age, a list of codes and
+    a [min, max] list of ages; an age bucket is an (age_from, age_to) pair of neighbouring age_bins, age_to excluded.
+    The rows of users and events absent from user_df and events_df are never selected. Every position array is
+    built on its first use, so e.g. partitioning by regions does not index the ages.
+    """
+
+    def __init__(self,
+                 user_event_df: pd.DataFrame,
+                 user_df: pd.DataFrame,
+                 events_df: pd.DataFrame,
+                 age_bins: Optional[Sequence[int]] = None):
+        self.user_event_df = user_event_df
+        self.user_df = user_df
+        self.events_df = events_df
+        self.age_bins = None if age_bins is None else list(age_bins)
+
+    @functools.cached_property
+    def user_region_rows(self) -> Dict[int, np.ndarray]:
+        return self._get_rows_per_value(self.user_event_df['user_id'], self.user_df, 'user_id', 'region_code')
+
+    @functools.cached_property
+    def user_age_rows(self) -> Dict[int, np.ndarray]:
+        return self._get_rows_per_value(self.user_event_df['user_id'], self.user_df, 'user_id', 'age')
+
+    @functools.cached_property
+    def user_age_bucket_rows(self) -> Dict[Tuple[int, int], np.ndarray]:
+        if self.age_bins is None:
+            raise ValueError('The index was built without age_bins')
+        return {
+            (age_from, age_to): self._union(self.user_age_rows, [age for age in self.user_age_rows
+                                                                 if age_from <= age < age_to])
+            for age_from, age_to in zip(self.age_bins[:-1], self.age_bins[1:])
+        }
+
+    @functools.cached_property
+    def event_region_rows(self) -> Dict[int, np.ndarray]:
+        return self._get_rows_per_value(self.user_event_df['event_id'], self.events_df, 'event_id', 'region_code')
+
+    @staticmethod
+    def _get_rows_per_value(keys: pd.Series, df: pd.DataFrame, key: str, column: str) -> Dict[int, np.ndarray]:
+        """
+        :return: sorted positions of the keys whose rows of df have the value of the column, by the value
+        """
+        values = df.loc[:, [key, column]].dropna().drop_duplicates()
+        rows = pd.DataFrame({key: keys.values, '_row': np.arange(len(keys))}).merge(values, on=key)
+        # the rows of merge are not ordered by the position, the groups keep the order of the sorted rows
+        order = np.argsort(rows['_row'].to_numpy(dtype=np.int64))
+        positions = rows['_row'].to_numpy(dtype=np.int64)[order]
+        values = rows[column].to_numpy(dtype=np.float64)[order]
+        return {int(value): positions[group] for value, group in pd.Series(values).groupby(values).indices.items()}
+
+    @staticmethod
+    def _intersect(rows: np.ndarray, other_rows: np.ndarray) -> np.ndarray:
+        if len(rows) > len(other_rows):
+            rows, other_rows = other_rows, rows
+        if len(rows) == 0:
+            return rows
+        # binary search of the shorter sorted array in the longer one
+        positions = np.minimum(np.searchsorted(other_rows, rows), len(other_rows) - 1)
+        return rows[other_rows[positions] == rows]
+
+    @staticmethod
+    def _union(rows_per_value: Dict, values: Iterable) -> np.ndarray:
+        selected = [rows_per_value[value] for value in set(values) if value in rows_per_value]
+        if not selected:
+            return np.array([], dtype=np.int64)
+        if len(selected) == 1:
+            return selected[0]
+        return np.unique(np.concatenate(selected))
+
+    def get_rows(self,
+                 user_region: Optional[Union[int, List[int]]] = None,
+                 user_age: Optional[Union[int, List[int]]] = None,
+                 event_region: Optional[Union[int, List[int]]] = None,
+                 user_age_bucket: Optional[Tuple[int, int]] = None) -> np.ndarray:
+        """
+        :return: sorted positions of the user_event_df rows matching all passed filters; None filters are not applied
+        """
+        selections = list()
+        for name, value in (
+                ('user_region', user_region),
+                ('user_age', user_age),
+                ('event_region', event_region)
+        ):
+            if value is None:
+                continue
+            rows_per_value = getattr(self, f'{name}_rows')
+            if name == 'user_age' and isinstance(value, list) and len(value) == 2:
+                value = [age for age in rows_per_value if value[0] <= age <= value[1]]
+            elif isinstance(value, (int, np.integer)):
+                value = [int(value)]
+            elif not isinstance(value, list):
+                raise ValueError(f"Incorrect value of {name}")
+            selections.append(self._union(rows_per_value, value))
+        if user_age_bucket is not None:
+            if tuple(user_age_bucket) not in self.user_age_bucket_rows:
+                raise ValueError("Incorrect value of user_age_bucket")
+            selections.append(self.user_age_bucket_rows[tuple(user_age_bucket)])
+
+        if not selections:
+            return np.arange(len(self.user_event_df))
+        rows = selections[0]
+        for other_rows in sorted(selections[1:], key=len):
+            rows = self._intersect(rows, other_rows)
+        return rows
+
+    def filter_user_event_df(self,
+                             user_region: Optional[Union[int, List[int]]] = None,
+                             user_age: Optional[Union[int, List[int]]] = None,
+                             event_region: Optional[Union[int, List[int]]] = None,
+                             user_age_bucket: Optional[Tuple[int, int]] = None) -> pd.DataFrame:
+        """
+        :return: the rows of user_event_df matching all passed filters in their original order
+        """
+        return self.user_event_df.iloc[self.get_rows(user_region, user_age, event_region, user_age_bucket)]
+
+    def iter_region_pair_rows(
+            self,
+            region_pairs: Optional[Iterable[Tuple[int, int]]] = None,
+            same_region_only: bool = True
+    ) -> Iterator[Tuple[Tuple[int, int], np.ndarray]]:
+        """
+        Splits the rows by (user region, event region) pairs, see partition_user_event_df.
+
+        :return: an iterator over ((user region code, event region code), sorted row positions) of the non-empty
+         pairs sorted by the pair
+        """
+        if region_pairs is not None:
+            for user_region, event_region in sorted(set(region_pairs)):
+                rows = self.get_rows(user_region=int(user_region), event_region=int(event_region))
+                if len(rows) != 0:
+                    yield (int(user_region), int(event_region)), rows
+            return
+
+        if same_region_only:
+            for region in sorted(self.user_region_rows):
+                rows = self._intersect(self.user_region_rows[region],
+                                       self.event_region_rows.get(region, np.array([], dtype=np.int64)))
+                if len(rows) != 0:
+                    yield (region, region), rows
+            return
+
+        # an event has a single region, so the rows of a user region are split by the region of their events
+        event_regions = np.full(len(self.user_event_df), -1, dtype=np.int64)
+        event_region_codes = sorted(self.event_region_rows)
+        for position, region in enumerate(event_region_codes):
+            event_regions[self.event_region_rows[region]] = position
+        for user_region in sorted(self.user_region_rows):
+            rows = self.user_region_rows[user_region]
+            positions = event_regions[rows]
+            rows, positions = rows[positions >= 0], positions[positions >= 0]
+            order = np.argsort(positions, kind='stable')
+            rows, positions = rows[order], positions[order]
+            starts = np.flatnonzero(np.r_[True, positions[1:] != positions[:-1]]) if len(positions) else []
+            for start, stop in zip(starts, [*starts[1:], len(rows)]):
+                yield (user_region, event_region_codes[positions[start]]), rows[start:stop]
+
+
 def numerate_user_event_df(user_event_df: pd.DataFrame) -> pd.DataFrame:
-    user_event_df['event_id'] = user_event_df['event_id'].astype('category')
-    user_event_df['user_id'] = user_event_df['user_id'].astype('category')
+    # ids read from columnar files can be already categorical with the categories of the whole country
+    user_event_df['event_id'] = user_event_df['event_id'].astype('category').cat.remove_unused_categories()
+    user_event_df['user_id'] = user_event_df['user_id'].astype('category').cat.remove_unused_categories()
     user_event_df['user_num'] = user_event_df['user_id'].cat.codes
     user_event_df['event_num'] = user_event_df['event_id'].cat.codes
     return user_event_df
 
 
-def get_extra_events_ids(user_event_df: pd.DataFrame, future_event_df: pd.DataFrame) -> List[int]:
-    event_ids = set(user_event_df['event_id'])
-    future_events_ids = set(future_event_df['ID'])
-    return list(event_ids.difference(future_events_ids))
+def get_extra_events_ids(
+        user_event_df: pd.DataFrame,
+        future_event_df: pd.DataFrame,
+        event_id_column: str = 'event_id'
+) -> List[int]:
+    """
+    Returns the ids of the clicked events that are not in future_event_df, i.e. the past events a recommender
+    should not recommend (see the extra_item_ids parameter of UserItemRecommender.fit).
+
+    :param event_id_column: a column of user_event_df with event ids, e.g. 'item_id' of a user-item table
+    """
+    event_ids = np.asarray(user_event_df[event_id_column].unique())
+    return np.setdiff1d(event_ids, future_event_df['ID'].to_numpy()).tolist()
+
+
+def filter_user_event_by_future_events(
+        user_event_df: pd.DataFrame,
+        future_event_df: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Drops the clicks of the past events, so the user-item matrix only contains the events that can be recommended.
+    """
+    return user_event_df.loc[user_event_df['event_id'].isin(future_event_df['ID'].to_numpy())]
 
 
 def filter_user_event_df(
@@ -85,6 +275,74 @@ def filter_user_event_df(
     )
 
 
+def partition_user_event_df(
+        user_event_df: pd.DataFrame,
+        users_df: pd.DataFrame,
+        events_df: pd.DataFrame,
+        region_pairs: Optional[Iterable[Tuple[int, int]]] = None,
+        same_region_only: bool = True,
+        index: Optional[UserEventIndex] = None
+) -> Iterator[Tuple[Tuple[int, int], pd.DataFrame]]:
+    """
+    Splits user_event_df into (user region, event region) partitions with a UserEventIndex: the row positions of every
+    user region and event region are found once and every partition is an intersection of two sorted position
+    arrays. Every partition contains the same rows as
+    filter_user_event_df(user_event_df, users_df, events_df, user_region, event_region).
+
+    :param region_pairs: (user region code, event region code) pairs to keep; all pairs are kept if None
+    :param same_region_only: keep only the partitions where users and events are located in the same region,
+     ignored when region_pairs are passed
+    :param index: an index of user_event_df already built by the caller, built here if None
+    :return: an iterator over ((user region code, event region code), partition dataframe)
+    """
+    if index is None:
+        index = UserEventIndex(user_event_df, users_df, events_df)
+    for region_pair, rows in index.iter_region_pair_rows(region_pairs, same_region_only):
+        yield region_pair, user_event_df.iloc[rows]
+
+
+def get_region_pairs(
+        user_event_df: pd.DataFrame,
+        users_df: pd.DataFrame,
+        events_df: pd.DataFrame
+) -> List[Tuple[int, int]]:
+    """
+    Returns (user region code, event region code) pairs of all partitions the user-event rows belong to,
+    e.g. the regional tables affected by new clicks.
+    """
+    return [region_pair for region_pair, _ in partition_user_event_df(
+        user_event_df,
+        users_df,
+        events_df,
+        same_region_only=False
+    )]
+
+
+def get_region_item_mask(
+        item_nums: Union[pd.Series, np.ndarray],
+        item_region_codes: Union[pd.Series, np.ndarray],
+        num_of_items: Optional[int] = None
+) -> Tuple[np.ndarray, sparse.csr_matrix]:
+    """
+    Builds a sparse region-item mask of a national user-item table, e.g. to restrict the candidates of a recommender
+    fitted on all regions to the events of a region.
+
+    :param item_nums: item numbers of the table rows
+    :param item_region_codes: region codes of the items of the table rows
+    :param num_of_items: number of columns of the mask, the maximum item number + 1 if None
+    :return: sorted region codes and a boolean matrix with a row per region code, True for the items of the region
+    """
+    region_codes, rows = np.unique(np.asarray(item_region_codes), return_inverse=True)
+    item_nums = np.asarray(item_nums)
+    if num_of_items is None:
+        num_of_items = int(item_nums.max()) + 1 if len(item_nums) else 0
+    region_item_mask = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, item_nums)),
+        shape=(len(region_codes), num_of_items)
+    )
+    return region_codes, region_item_mask
+
+
 def split_df_into_diapasons(df: pd.DataFrame) -> pd.DataFrame:
     activity = df.groupby('user_id')['clicks_count'].count().sort_values(ascending=False).reset_index()
     activity['diapason'] = pd.cut(activity['clicks_count'], bins=np.linspace(0, 70, 15),
@@ -0,0 +1,146 @@
+import sys
+import json
+import time
+import logging
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterator
+
+try:
+    import resource
+except ImportError:
+    # the resource module is available on Unix only
+    resource = None
+
+LOGGER_NAME = 'recommendations'
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a single JSON line: time, level, message and the fields passed with extra={'fields': {...}}.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            **getattr(record, 'fields', dict())
+        }
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+def configure_logging(log_file: Optional[str] = None, level: int = logging.INFO) -> logging.Logger:
+    """
+    Sets up the JSON line logger of the pipeline scripts. Lines are written to stderr, so they do not mix with tqdm
+    bars on stdout, and appended to log_file if it is passed. Calling it again (e.g. in a worker process that
+    imported the script) does not add the handlers twice.
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    logger.propagate = False
+    if not any(isinstance(handler.formatter, JsonFormatter) for handler in logger.handlers):
+        handlers = [logging.StreamHandler(sys.stderr)]
+        if log_file is not None:
+            handlers.append(logging.FileHandler(log_file, mode='a', encoding='utf-8'))
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+            logger.addHandler(handler)
+    return logger
+
+
+def get_logger() -> logging.Logger:
+    return logging.getLogger(LOGGER_NAME)
+
+
+def get_peak_rss_mb() -> Optional[float]:
+    """
+    :return: the peak resident set size of the process in megabytes, None where the resource module is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is measured in bytes on macOS and in kilobytes on Linux
+    return round(peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10, 1)
+
+
+@contextmanager
+def stage(name: str, **fields) -> Iterator[Dict[str, Any]]:
+    """
+    Measures a pipeline stage and logs a JSON line with its wall time, CPU time and peak RSS when the stage ends.
+    The yielded dictionary is logged too, so counters known inside the stage (rows, nnz, iterations,
+    recommendations) are added to it; iterations and recommendations are also logged per second of wall time.
+
+        with stage('fit', region=77) as metrics:
+            recommender.fit(df)
+            metrics['nnz'] = recommender.sparse_user_item.nnz
+
+    :param name: the stage name, logged as the message
+    :param fields: fields identifying the stage, e.g. the region
+    """
+    metrics = dict(fields)
+    start, cpu_start = time.perf_counter(), time.process_time()
+    status = 'failed'
+    try:
+        yield metrics
+        status = 'ok'
+    finally:
+        wall_seconds = time.perf_counter() - start
+        metrics.update({
+            'stage': name,
+            'status': status,
+            'wall_seconds': round(wall_seconds, 4),
+            'cpu_seconds': round(time.process_time() - cpu_start, 4),
+            'peak_rss_mb': get_peak_rss_mb()
+        })
+        for counter in 'iterations', 'recommendations':
+            if metrics.get(counter) is not None and wall_seconds > 0:
+                metrics[f'{counter}_per_second'] = round(metrics[counter] / wall_seconds, 1)
+        get_logger().log(logging.INFO if status == 'ok' else logging.ERROR, name, extra={'fields': metrics})
+
+
+@contextmanager
+def profile(mode: Optional[str] = None, file_name: Optional[str] = None, top: int = 20) -> Iterator[None]:
+    """
+    Profiles the enclosed code if mode is passed:
+        - cprofile: the statistics are saved into file_name (read them with pstats or snakeviz);
+        - tracemalloc: the peak of traced memory and the top allocation sites are logged.
+
+    :param mode: None, 'cprofile' or 'tracemalloc'
+    :param top: number of allocation sites logged by tracemalloc
+    """
+    if mode is None:
+        yield
+        return
+    if mode not in PROFILE_MODES:
+        raise ValueError(f'Incorrect value of "profile" parameter: {mode}')
+
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(file_name)
+            get_logger().info('profile', extra={'fields': {'mode': mode, 'file_name': file_name}})
+    else:
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            sites = [
+                {'site': str(statistic.traceback), 'size_mb': round(statistic.size / 2 ** 20, 3),
+                 'count': statistic.count}
+                for statistic in snapshot.statistics('lineno')[:top]
+            ]
+            get_logger().info('profile', extra={'fields': {
+                'mode': mode,
+                'peak_traced_mb': round(peak / 2 ** 20, 2),
+                'top_allocations': sites
+            }})
@@ -0,0 +1,29 @@
+import os
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+BLAS_THREADS_VARIABLES = ('OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'OMP_NUM_THREADS')
+
+
+@contextmanager
+def worker_pool(max_workers: int, blas_threads: int = 1) -> Iterator[ProcessPoolExecutor]:
+    """
+    Opens a pool of spawned worker processes with BLAS thread pools limited to blas_threads threads. BLAS pools are
+    created on import, so the limit is passed to the workers through the environment. The variables are set while the
+    pool is open, because the workers are started on demand by submit. Their previous values are restored when the
+    pool is closed, so the parent process and the processes it starts later are not limited.
+    """
+    saved = {variable: os.environ.get(variable) for variable in BLAS_THREADS_VARIABLES}
+    for variable in BLAS_THREADS_VARIABLES:
+        os.environ[variable] = str(blas_threads)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            yield executor
+    finally:
+        for variable, value in saved.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
@@ -1,16 +1,34 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime
-from typing import List, Union, Optional
+from typing import Any, Dict, List, Union, Optional, Iterator, Tuple
 
 DOWNLOAD_DATE = '2021-11-15'
 DOWNLOAD_DATE = datetime.strptime(str(DOWNLOAD_DATE), "%Y-%m-%d")
 
+CLICKS_COLUMNS = ['create_time', 'user_id', 'session_id', 'session_name', 'organization_id']
+CLICKS_DTYPES = {
+    'create_time': 'category',
+    'user_id': 'category',
+    'session_id': 'float64',
+    'session_name': 'category',
+    'organization_id': 'float64'
+}
+
 
 def get_user_age_in_years(birth_date) -> int:
     date_1 = datetime.strptime(str(birth_date), "%Y-%m-%d")
     return abs((DOWNLOAD_DATE - date_1).days) // 365
 
 
+def get_user_ages_in_years(birth_dates: pd.Series) -> pd.Series:
+    """
+    Vectorized get_user_age_in_years
+    """
+    birth_dates = pd.to_datetime(birth_dates.astype(str), format="%Y-%m-%d")
+    return (DOWNLOAD_DATE - birth_dates).dt.days.abs() // 365
+
+
 def get_region_code_for_user(region_name: str, region_numbers: dict) -> Optional[int]:
     try:
         return region_numbers[region_name]
@@ -19,116 +37,118 @@ def get_region_code_for_user(region_name: str, region_numbers: dict) -> Optional
 
 
 # TODO: save region_numbers as json to clean up the code below
+EVENT_REGION_NUMBERS = {
+    'Белгородская обл': 31,
+    'Калужская обл': 40,
+    'г Санкт-Петербург': 78,
+    'Курганская обл': 45,
+    'Нижегородская обл': 52,
+    'Самарская обл': 63,
+    'Ярославская обл': 76,
+    'Свердловская обл': 66,
+    'Тульская обл': 71,
+    'Пермский край': 59,
+    'г Москва': 77,
+    'Тверская обл': 69,
+    'Респ Карелия': 10,
+    'Ульяновская обл': 73,
+    'АО Ханты-Мансийский Автономный округ - Югра': 86,
+    'Омская обл': 55,
+    'Смоленская обл': 67,
+    'Тюменская обл': 72,
+    'Тамбовская обл': 68,
+    'Московская обл': 50,
+    'Кемеровская обл': 42,
+    'Чувашская республика Чувашия': 21,
+    'Респ Татарстан': 16,
+    'Рязанская обл': 62,
+    'Ставропольский край': 26,
+    'Пензенская обл': 58,
+    'Респ Бурятия': 3,
+    'Новосибирская обл': 54,
+    'Краснодарский край': 23,
+    'Респ Марий Эл': 12,
+    'Астраханская обл': 30,
+    'Удмуртская Респ': 18,
+    'Ивановская обл': 37,
+    'Забайкальский край': 75,
+    'Саратовская обл': 64,
+    'Волгоградская обл': 34,
+    'Респ Крым': 82,
+    'Кировская обл': 43,
+    'Челябинская обл': 74,
+    'Приморский край': 25,
+    'Ростовская обл': 61,
+    'Владимирская обл': 33,
+    'Красноярский край': 24,
+    'Курская обл': 46,
+    'Камчатский край': 41,
+    'Респ Мордовия': 13,
+    'Хабаровский край': 27,
+    'Респ Дагестан': 5,
+    'Респ Башкортостан': 2,
+    'Томская обл': 70,
+    'Респ Адыгея': 1,
+    'Алтайский край': 22,
+    'Орловская обл': 57,
+    'Костромская обл': 44,
+    'Вологодская обл': 35,
+    'Ямало-Ненецкий ао': 89,
+    'Оренбургская обл': 56,
+    'Калининградская обл': 39,
+    'Респ Хакасия': 19,
+    'Респ Коми': 11,
+    'г Севастополь': 92,
+    'Липецкая обл': 48,
+    'Респ Саха /Якутия/': 14,
+    'Магаданская обл': 49,
+    'Новгородская обл': 53,
+    'Ямало-Ненецкий АО': 89,
+    'Чеченская Респ': 95,
+    'Мурманская обл': 51,
+    'Респ Северная Осетия - Алания': 15,
+    'Кабардино-Балкарская респ': 7,
+    'Воронежская обл': 36,
+    'респ Дагестан': 5,
+    'Амурская обл': 28,
+    'Кабардино-Балкарская Респ': 7,
+    'Сахалинская обл': 65,
+    'Брянская обл': 32,
+    'Ленинградская обл': 47,
+    'Архангельская обл': 29,
+    'Иркутская обл': 38,
+    'Карачаево-Черкесская Респ': 9,
+    'Ханты-Мансийский Автономный округ - Югра': 86,
+    'Респ Алтай': 4,
+    'Респ Ингушетия': 6,
+    'Ненецкий АО': 83,
+    'респ Бурятия': 3,
+    'Чеченская респ': 95,
+    'Псковская обл': 60,
+    'Респ Калмыкия': 8,
+    'п Рязановское': 77,
+    'Респ Тыва': 17,
+    'респ Татарстан': 16,
+    'п Кленовское': 77,
+    'п Десеновское': 77,
+    'п Михайлово-Ярцевское': 77,
+    'Еврейская Аобл': 79,
+    'респ Саха /Якутия/': 14,
+    'респ Мордовия': 13,
+    'п Новофедоровское': 77,
+    'ао Ханты-Мансийский Автономный округ - Югра': 86,
+    'респ Ингушетия': 6,
+    'респ Башкортостан': 2,
+    'респ Карелия': 10,
+    'респ Марий Эл': 12,
+    'обл Кемеровская область - Кузбасс': 42,
+    'Удмуртская респ': 18
+}
+
+
 def get_region_code_for_event(region_name: str) -> Optional[int]:
-    region_numbers = {
-        'Белгородская обл': 31,
-        'Калужская обл': 40,
-        'г Санкт-Петербург': 78,
-        'Курганская обл': 45,
-        'Нижегородская обл': 52,
-        'Самарская обл': 63,
-        'Ярославская обл': 76,
-        'Свердловская обл': 66,
-        'Тульская обл': 71,
-        'Пермский край': 59,
-        'г Москва': 77,
-        'Тверская обл': 69,
-        'Респ Карелия': 10,
-        'Ульяновская обл': 73,
-        'АО Ханты-Мансийский Автономный округ - Югра': 86,
-        'Омская обл': 55,
-        'Смоленская обл': 67,
-        'Тюменская обл': 72,
-        'Тамбовская обл': 68,
-        'Московская обл': 50,
-        'Кемеровская обл': 42,
-        'Чувашская республика Чувашия': 21,
-        'Респ Татарстан': 16,
-        'Рязанская обл': 62,
-        'Ставропольский край': 26,
-        'Пензенская обл': 58,
-        'Респ Бурятия': 3,
-        'Новосибирская обл': 54,
-        'Краснодарский край': 23,
-        'Респ Марий Эл': 12,
-        'Астраханская обл': 30,
-        'Удмуртская Респ': 18,
-        'Ивановская обл': 37,
-        'Забайкальский край': 75,
-        'Саратовская обл': 64,
-        'Волгоградская обл': 34,
-        'Респ Крым': 82,
-        'Кировская обл': 43,
-        'Челябинская обл': 74,
-        'Приморский край': 25,
-        'Ростовская обл': 61,
-        'Владимирская обл': 33,
-        'Красноярский край': 24,
-        'Курская обл': 46,
-        'Камчатский край': 41,
-        'Респ Мордовия': 13,
-        'Хабаровский край': 27,
-        'Респ Дагестан': 5,
-        'Респ Башкортостан': 2,
-        'Томская обл': 70,
-        'Респ Адыгея': 1,
-        'Алтайский край': 22,
-        'Орловская обл': 57,
-        'Костромская обл': 44,
-        'Вологодская обл': 35,
-        'Ямало-Ненецкий ао': 89,
-        'Оренбургская обл': 56,
-        'Калининградская обл': 39,
-        'Респ Хакасия': 19,
-        'Респ Коми': 11,
-        'г Севастополь': 92,
-        'Липецкая обл': 48,
-        'Респ Саха /Якутия/': 14,
-        'Магаданская обл': 49,
-        'Новгородская обл': 53,
-        'Ямало-Ненецкий АО': 89,
-        'Чеченская Респ': 95,
-        'Мурманская обл': 51,
-        'Респ Северная Осетия - Алания': 15,
-        'Кабардино-Балкарская респ': 7,
-        'Воронежская обл': 36,
-        'респ Дагестан': 5,
-        'Амурская обл': 28,
-        'Кабардино-Балкарская Респ': 7,
-        'Сахалинская обл': 65,
-        'Брянская обл': 32,
-        'Ленинградская обл': 47,
-        'Архангельская обл': 29,
-        'Иркутская обл': 38,
-        'Карачаево-Черкесская Респ': 9,
-        'Ханты-Мансийский Автономный округ - Югра': 86,
-        'Респ Алтай': 4,
-        'Респ Ингушетия': 6,
-        'Ненецкий АО': 83,
-        'респ Бурятия': 3,
-        'Чеченская респ': 95,
-        'Псковская обл': 60,
-        'Респ Калмыкия': 8,
-        'п Рязановское': 77,
-        'Респ Тыва': 17,
-        'респ Татарстан': 16,
-        'п Кленовское': 77,
-        'п Десеновское': 77,
-        'п Михайлово-Ярцевское': 77,
-        'Еврейская Аобл': 79,
-        'респ Саха /Якутия/': 14,
-        'респ Мордовия': 13,
-        'п Новофедоровское': 77,
-        'ао Ханты-Мансийский Автономный округ - Югра': 86,
-        'респ Ингушетия': 6,
-        'респ Башкортостан': 2,
-        'респ Карелия': 10,
-        'респ Марий Эл': 12,
-        'обл Кемеровская область - Кузбасс': 42,
-        'Удмуртская респ': 18
-    }
     try:
-        return region_numbers[region_name]
+        return EVENT_REGION_NUMBERS[region_name]
     except KeyError:
         return None
 
@@ -147,8 +167,9 @@ def get_user_dataframe(
 ) -> pd.DataFrame:
     users_df = pd.read_csv(users_file_path, sep=';')
     users_age = users_df
-    users_age['user_age'] = users_age['user_birth'].apply(func=get_user_age_in_years)
-    users_age_dict = dict(zip(users_age.user_id, users_age.user_age))
+    users_age['user_age'] = get_user_ages_in_years(users_age['user_birth'])
+    # the last record wins for a duplicated user id, as it would in a dict
+    users_age = users_age.drop_duplicates(subset=['user_id'], keep='last').set_index('user_id')['user_age']
 
     users_regions_df = pd.read_csv(regions_file_path, sep=';')
     region_nums = pd.read_csv(regions_nums_file_path)
@@ -158,11 +179,10 @@ def get_user_dataframe(
     })
     region_nums_dict = dict(zip(region_nums.region_name, region_nums.region_code))
     users_regions = users_regions_df
-    users_regions['region_code'] = users_regions['region'].apply(func=get_region_code_for_user,
-                                                                 region_numbers=region_nums_dict)
+    users_regions['region_code'] = users_regions['region'].map(region_nums_dict)
 
     users_full = users_regions
-    users_full['age'] = users_full['user_id'].apply(func=get_user_age, user_age=users_age_dict)
+    users_full['age'] = users_full['user_id'].astype(str).map(users_age)
     users_full = users_full.dropna(subset=['age'])
     return users_full
 
@@ -200,9 +220,8 @@ def get_events_dataframe(
         'ИНН': 'INN',
         'Категория': 'category'
     })
-    organizations['region'] = organizations['address'].apply(func=get_region_from_address)
-    org_id_region = dict(zip(organizations.org_id, organizations.region))
-    org_id_category = dict(zip(organizations.org_id, organizations.category))
+    organizations['region'] = organizations['address'].str.split(',').str[0]
+    organizations = organizations.drop_duplicates(subset=['org_id'], keep='last').set_index('org_id')
 
     all_events = all_events_df
     all_events = all_events.rename(columns={
@@ -216,10 +235,10 @@ def get_events_dataframe(
     all_events = all_events.dropna(subset=['org_id'])
     all_events = all_events.astype({'org_id': int})
 
-    all_events['region_name'] = all_events['org_id'].apply(func=get_event_region, regions_dict=org_id_region)
-    all_events['category'] = all_events['org_id'].apply(func=get_event_category, categories_dict=org_id_category)
+    all_events['region_name'] = all_events['org_id'].map(organizations['region'])
+    all_events['category'] = all_events['org_id'].map(organizations['category'])
 
-    all_events['region_code'] = all_events['region_name'].apply(func=get_region_code_for_event)
+    all_events['region_code'] = all_events['region_name'].map(EVENT_REGION_NUMBERS)
     all_events = all_events.dropna(subset=['region_code'])
     all_events['region_code'] = all_events['region_code'].astype(int)
     return all_events
@@ -240,6 +259,218 @@ def get_clicks_dataframe(
     return clicks
 
 
+class _SeenKeys:
+    """
+    A set of int64 keys kept as sorted runs of geometrically growing sizes: a new run is merged with the last one
+    while the last one is not longer, so every key is re-sorted O(log(number of runs)) times and a lookup is a binary
+    search in each of O(log(number of keys)) runs.
+    """
+
+    def __init__(self):
+        self.runs = list()
+
+    def __len__(self) -> int:
+        return sum(len(run) for run in self.runs)
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        found = np.zeros(len(keys), dtype=bool)
+        for run in self.runs:
+            positions = np.minimum(np.searchsorted(run, keys), len(run) - 1)
+            found |= run[positions] == keys
+        return found
+
+    def add(self, keys: np.ndarray) -> None:
+        """
+        :param keys: unique keys which are not in the set yet
+        """
+        if len(keys) == 0:
+            return
+        run = np.sort(keys)
+        while self.runs and len(self.runs[-1]) <= len(run):
+            run = np.sort(np.concatenate([self.runs.pop(), run]), kind='mergesort')
+        self.runs.append(run)
+
+
+class _ValueIds:
+    """
+    Numbers the distinct values of a column in the order they are first seen, a missing value included. Only the
+    categories of a chunk are looked up in the dictionary, not its rows.
+    """
+
+    MAX_NUMBER_OF_VALUES = 2 ** 31
+
+    def __init__(self):
+        self.ids = dict()
+
+    def get_ids(self, values: pd.Series) -> np.ndarray:
+        values = values.astype('category')
+        categories = values.cat.categories.tolist() + [None]
+        category_ids = np.array([self.ids.setdefault(value, len(self.ids)) for value in categories], dtype=np.int64)
+        if len(self.ids) > self.MAX_NUMBER_OF_VALUES:
+            raise ValueError(f'More than {self.MAX_NUMBER_OF_VALUES} distinct values cannot be numbered')
+        # the code of a missing value is -1, i.e. the last category id
+        return category_ids[values.cat.codes.to_numpy()]
+
+
+def iter_clicks_chunks(
+        clicks_file_path: str,
+        chunksize: int
+) -> Iterator[pd.DataFrame]:
+    """
+    Reads the clicks table chunk by chunk with the columns and dtypes needed for the user-event table and cleans every
+    chunk the same way as get_clicks_dataframe. Duplicates of (create_time, user_id) are dropped across chunks by the
+    keys seen so far: the create_time and user_id values are numbered exactly (see _ValueIds) and a pair of numbers is
+    packed into an int64 key, so distinct pairs never collide. The duplicates can be anywhere in the file, so this
+    state cannot be bounded: it takes 8 bytes per distinct (create_time, user_id) pair and a dictionary entry per
+    distinct create_time and user_id value, i.e. it grows with the number of raw clicks, but it is much smaller than
+    the clicks themselves.
+
+    :param chunksize: number of rows read at once
+    :return: an iterator over cleaned clicks dataframes
+    """
+    seen_keys = _SeenKeys()
+    create_time_ids, user_ids = _ValueIds(), _ValueIds()
+    chunks = pd.read_csv(clicks_file_path, sep=';', usecols=CLICKS_COLUMNS, dtype=CLICKS_DTYPES, chunksize=chunksize)
+    for clicks in chunks:
+        # the numbers are below 2 ** 31, so the packed keys of different pairs are different and non-negative
+        keys = (create_time_ids.get_ids(clicks['create_time']) << 32) | user_ids.get_ids(clicks['user_id'])
+        first_seen = ~pd.Series(keys).duplicated().values
+        first_seen &= ~seen_keys.contains(keys)
+        seen_keys.add(keys[first_seen])
+
+        clicks = clicks.loc[first_seen]
+        clicks = clicks.rename(columns={
+            'session_id': 'event_id',
+            'session_name': 'event_name'
+        })
+        clicks = clicks.dropna(subset=['event_id', 'organization_id'])
+        yield clicks
+
+
+def count_clicks(clicks: pd.DataFrame) -> pd.DataFrame:
+    user_event = clicks.groupby(['user_id', 'event_id', 'event_name'], observed=True)['create_time'].count()
+    user_event = user_event.reset_index().rename(columns={'create_time': 'clicks_count'})
+    return user_event.astype({'user_id': object, 'event_name': object})
+
+
+def merge_clicks_counts(user_event_dfs: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Sums clicks_count of the same (user_id, event_id, event_name) in several user-event dataframes
+    """
+    user_event = pd.concat(user_event_dfs, ignore_index=True)
+    user_event = user_event.astype({'user_id': object, 'event_name': object})
+    user_event = user_event.groupby(['user_id', 'event_id', 'event_name'])['clicks_count'].sum()
+    return user_event.reset_index()
+
+
+class ClicksCounter:
+    """
+    Sums the user-event dataframes of the clicks chunks (see count_clicks). The counts of the chunks are kept aside and
+    grouped together with the running aggregate only every compact_every chunks, so the aggregate is not re-grouped
+    after every chunk; peak memory is the aggregate plus the counts of compact_every chunks.
+    """
+
+    def __init__(self, compact_every: int = 16):
+        self.compact_every = compact_every
+        self.user_event_dfs = list()
+
+    def add(self, user_event_df: pd.DataFrame) -> None:
+        self.user_event_dfs.append(user_event_df)
+        if len(self.user_event_dfs) > self.compact_every:
+            self.user_event_dfs = [merge_clicks_counts(self.user_event_dfs)]
+
+    def get_user_event_df(self) -> pd.DataFrame:
+        """
+        :return: the summed user-event dataframe with integer event ids, empty if no chunks were added
+        """
+        if len(self.user_event_dfs) == 0:
+            user_event = pd.DataFrame(columns=['user_id', 'event_id', 'event_name', 'clicks_count'])
+        else:
+            user_event = merge_clicks_counts(self.user_event_dfs)
+        self.user_event_dfs = [user_event]
+        return user_event.astype({'event_id': int, 'clicks_count': int})
+
+
+def get_user_event_delta(
+        clicks_file_path: str,
+        cursor: Optional[Dict[str, Any]] = None,
+        chunksize: Optional[int] = None
+) -> Tuple[pd.DataFrame, Optional[Dict[str, Any]]]:
+    """
+    Counts the clicks which were not counted yet. The result can be added to the user-event table built from the
+    previous clicks with merge_clicks_counts.
+
+    The cursor is create_time of the last counted clicks (the high-water mark) and the ids of the users whose clicks
+    at exactly that time were counted. A click is identified by (create_time, user_id) (see get_clicks_dataframe), so
+    clicks which arrive late with the same create_time as the mark are still counted; clicks older than the mark are
+    never counted.
+
+    :param cursor: the cursor returned by the previous call; all clicks are counted if None
+    :param chunksize: if passed, the clicks file is read chunk by chunk (see iter_clicks_chunks)
+    :return: the user-event dataframe of new clicks (empty if there are none) and the new cursor, None if no clicks
+     were ever counted
+    """
+    high_water_mark, user_ids_at_mark = None, set()
+    if cursor is not None:
+        high_water_mark, user_ids_at_mark = pd.Timestamp(cursor['high_water_mark']), set(cursor['user_ids'])
+
+    try:
+        if chunksize is None:
+            chunks = [get_clicks_dataframe(clicks_file_path)]
+        else:
+            chunks = iter_clicks_chunks(clicks_file_path, chunksize)
+        counter = ClicksCounter()
+        for clicks in chunks:
+            create_time = pd.to_datetime(clicks['create_time'].astype(str), errors='coerce').to_numpy()
+            user_ids = clicks['user_id'].astype(str).values
+            if high_water_mark is not None:
+                new = (create_time > high_water_mark) | ((create_time == high_water_mark) &
+                                                         ~np.isin(user_ids, list(user_ids_at_mark)))
+                clicks, create_time, user_ids = clicks.loc[new], create_time[new], user_ids[new]
+            # clicks without a valid time do not move the mark
+            if not np.isnat(create_time).all():
+                chunk_mark = pd.Timestamp(create_time[~np.isnat(create_time)].max())
+                if high_water_mark is None or chunk_mark > high_water_mark:
+                    high_water_mark, user_ids_at_mark = chunk_mark, set()
+                user_ids_at_mark.update(user_ids[create_time == high_water_mark].tolist())
+            counter.add(count_clicks(clicks))
+    except pd.errors.EmptyDataError:
+        # an empty delta file without a header
+        counter = ClicksCounter()
+
+    if high_water_mark is None:
+        return counter.get_user_event_df(), None
+    return counter.get_user_event_df(), {'high_water_mark': str(high_water_mark), 'user_ids': sorted(user_ids_at_mark)}
+
+
+def get_time_split_user_event_dataframes(
+        clicks_file_path: str,
+        cutoff: str,
+        chunksize: Optional[int] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Counts clicks made before the cutoff and clicks made at the cutoff or after it separately, so a recommender can be
+    trained on the past clicks and evaluated on the future ones.
+
+    :param cutoff: a create_time value, e.g. '2021-12-01'
+    :param chunksize: if passed, the clicks file is read chunk by chunk (see iter_clicks_chunks)
+    :return: the train and test user-event dataframes
+    """
+    if chunksize is None:
+        chunks = [get_clicks_dataframe(clicks_file_path)]
+    else:
+        chunks = iter_clicks_chunks(clicks_file_path, chunksize)
+
+    cutoff = pd.Timestamp(cutoff)
+    train_counter, test_counter = ClicksCounter(), ClicksCounter()
+    for clicks in chunks:
+        create_time = pd.to_datetime(clicks['create_time'].astype(str), errors='coerce')
+        # clicks without a valid time cannot be assigned to any of the parts
+        train_counter.add(count_clicks(clicks.loc[(create_time < cutoff).values]))
+        test_counter.add(count_clicks(clicks.loc[(create_time >= cutoff).values]))
+    return train_counter.get_user_event_df(), test_counter.get_user_event_df()
+
+
 def get_future_event_dataframe(
         future_event_file_path: str
 ) -> pd.DataFrame:
@@ -247,10 +478,23 @@ def get_future_event_dataframe(
 
 
 def get_user_event_dataframe(
-        user_event_file_path: str
+        user_event_file_path: str,
+        chunksize: Optional[int] = None
 ) -> pd.DataFrame:
-    user_event_df = get_clicks_dataframe(user_event_file_path)
-    user_event = user_event_df.groupby(['user_id', 'event_id', 'event_name'])['create_time'].count().reset_index()
-    user_event = user_event.rename(columns={'create_time': 'clicks_count'})
+    """
+    Counts clicks of every user on every event.
+
+    :param chunksize: if passed, the clicks file is read and aggregated chunk by chunk, so the clicks are never loaded
+     at once; peak memory is the (user, event) counts plus 8 bytes per distinct click (see iter_clicks_chunks)
+    """
+    if chunksize is None:
+        user_event_df = get_clicks_dataframe(user_event_file_path)
+        user_event = user_event_df.groupby(['user_id', 'event_id', 'event_name'])['create_time'].count().reset_index()
+        user_event = user_event.rename(columns={'create_time': 'clicks_count'})
+    else:
+        counter = ClicksCounter()
+        for clicks in iter_clicks_chunks(user_event_file_path, chunksize):
+            counter.add(count_clicks(clicks))
+        return counter.get_user_event_df()
     user_event['event_id'] = user_event['event_id'].astype(int)
     return user_event
@@ -0,0 +1,242 @@
+import os
+import re
+import json
+import pandas as pd
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Iterable, Tuple
+
+STORAGE_FORMATS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'feather': '.feather'
+}
+
+USER_EVENT_DTYPES = {
+    'user_id': 'category',
+    'event_id': 'int64',
+    'clicks_count': 'int64'
+}
+
+USER_DTYPES = {
+    'user_id': 'category',
+    'region_code': 'Int64',
+    'age': 'int64'
+}
+
+EVENT_DTYPES = {
+    'event_id': 'int64',
+    'org_id': 'int64',
+    'region_code': 'int64'
+}
+
+PARTITION_NAME_PATTERN = re.compile(r'^user_(\d+)_event_(\d+)$')
+
+
+def get_storage_format(file_path: str) -> str:
+    suffix = Path(file_path).suffix
+    for storage_format, format_suffix in STORAGE_FORMATS.items():
+        if suffix == format_suffix:
+            return storage_format
+    raise ValueError(f'Unsupported file type: {file_path}')
+
+
+def apply_dtypes(df: pd.DataFrame, dtypes: Optional[Dict[str, str]]) -> pd.DataFrame:
+    if dtypes is None:
+        return df
+    return df.astype({column: dtype for column, dtype in dtypes.items() if column in df.columns})
+
+
+def _replace_file(file_path: str, write: Callable[[str], Any]) -> None:
+    """
+    Writes a file next to file_path and moves it over file_path with os.replace, so a reader or a crash never sees
+    a partially written file.
+    """
+    temporary_path = f'{file_path}.tmp'
+    write(temporary_path)
+    os.replace(temporary_path, file_path)
+
+
+def _write_table(df: pd.DataFrame, file_path: str, storage_format: str) -> None:
+    if storage_format == 'csv':
+        df.to_csv(file_path, index=False)
+    elif storage_format == 'parquet':
+        df.to_parquet(file_path, index=False)
+    else:
+        df.reset_index(drop=True).to_feather(file_path)
+
+
+def write_table(
+        df: pd.DataFrame,
+        path: str,
+        storage_format: str = 'csv',
+        dtypes: Optional[Dict[str, str]] = None
+) -> str:
+    """
+    Saves a dataframe in one of STORAGE_FORMATS. Parquet and feather keep the column dtypes (categorical ids,
+    integer region codes), so the next stage does not need to parse and infer them again. The file is replaced
+    atomically.
+
+    :param path: target file name without a suffix
+    :param storage_format: 'csv', 'parquet' or 'feather'
+    :param dtypes: dtypes the columns are cast to before saving
+    :return: the full name of the saved file
+    """
+    if storage_format not in STORAGE_FORMATS:
+        raise ValueError(f'Incorrect value of "storage_format" parameter: {storage_format}')
+
+    file_path = f'{path}{STORAGE_FORMATS[storage_format]}'
+    df = apply_dtypes(df, dtypes)
+    _replace_file(file_path, lambda temporary_path: _write_table(df, temporary_path, storage_format))
+    return file_path
+
+
+def read_table(
+        file_path: str,
+        dtypes: Optional[Dict[str, str]] = None,
+        columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    """
+    Reads a dataframe saved by write_table, the format is chosen by the file suffix.
+
+    :param dtypes: dtypes for the columns of a .csv file; columnar files already store them
+    :param columns: a list of columns to read, all columns are read if None
+    """
+    storage_format = get_storage_format(file_path)
+    if storage_format == 'csv':
+        df = pd.read_csv(file_path, usecols=columns)
+        return apply_dtypes(df, dtypes)
+    elif storage_format == 'parquet':
+        return pd.read_parquet(file_path, columns=columns)
+    else:
+        return pd.read_feather(file_path, columns=columns)
+
+
+def find_table(directory: str, name: str) -> str:
+    """
+    Finds a table saved by write_table in the directory regardless of its storage format. If the table was saved in
+    several formats (e.g. -storage_format was changed between runs), the most recently saved file is returned.
+    """
+    file_paths = [Path(directory) / f'{name}{format_suffix}' for format_suffix in STORAGE_FORMATS.values()]
+    file_paths = [file_path for file_path in file_paths if file_path.is_file()]
+    if len(file_paths) == 0:
+        raise OSError(f'Table {name} was not found in {directory}.')
+    return str(max(file_paths, key=lambda file_path: file_path.stat().st_mtime_ns))
+
+
+def get_partition_name(user_region_code: int, event_region_code: int) -> str:
+    return f'user_{user_region_code}_event_{event_region_code}'
+
+
+def parse_partition_name(file_path: str) -> Optional[Tuple[int, int]]:
+    match = PARTITION_NAME_PATTERN.match(Path(file_path).stem)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def list_partitions(
+        directory: str,
+        user_region_codes: Optional[Iterable[int]] = None,
+        region_pairs: Optional[Iterable[Tuple[int, int]]] = None
+) -> List[str]:
+    """
+    Lists regional user-event tables stored in the directory.
+
+    :param user_region_codes: codes of the user regions to select
+    :param region_pairs: (user region code, event region code) pairs to select
+    :return: a list of file names; all supported files are listed if no codes or pairs are passed
+    """
+    if user_region_codes is not None:
+        user_region_codes = set(user_region_codes)
+    if region_pairs is not None:
+        region_pairs = set(map(tuple, region_pairs))
+
+    partitions = list()
+    for path in sorted(Path(directory).iterdir()):
+        if not path.is_file() or path.suffix not in STORAGE_FORMATS.values():
+            continue
+        if user_region_codes is not None or region_pairs is not None:
+            region_pair = parse_partition_name(str(path))
+            if region_pair is None:
+                continue
+            if user_region_codes is not None and region_pair[0] not in user_region_codes:
+                continue
+            if region_pairs is not None and region_pair not in region_pairs:
+                continue
+        partitions.append(str(path))
+    return partitions
+
+
+def _write_json(file_path: str, data: Dict[str, Any]) -> None:
+    def write(temporary_path: str) -> None:
+        with open(temporary_path, 'w') as json_file:
+            json.dump(data, json_file)
+    _replace_file(file_path, write)
+
+
+def read_clicks_cursor(state_file: str) -> Optional[Dict[str, Any]]:
+    """
+    Reads the cursor of the clicks counted in the user-event table (see preprocessing.get_user_event_delta), None if
+    the table was never built. If the last write_table_with_cursor was interrupted after the cursor was saved, the
+    staged table is moved in place first, so the table always matches the returned cursor.
+    """
+    if not Path(state_file).is_file():
+        return None
+    with open(state_file, 'r') as json_file:
+        state = json.load(json_file)
+    if 'staged_table' in state:
+        if Path(state['staged_table']).is_file():
+            os.replace(state['staged_table'], state['table'])
+        state = {'cursor': state['cursor']}
+        _write_json(state_file, state)
+    if 'cursor' not in state:
+        # the state of the first version kept only the time of the last counted click
+        return None if state['high_water_mark'] is None else {'high_water_mark': state['high_water_mark'],
+                                                              'user_ids': []}
+    return state['cursor']
+
+
+def write_table_with_cursor(
+        df: pd.DataFrame,
+        path: str,
+        storage_format: str,
+        dtypes: Optional[Dict[str, str]],
+        state_file: str,
+        cursor: Optional[Dict[str, Any]]
+) -> str:
+    """
+    Saves the user-event table and the cursor of its clicks as one update: the table is staged next to its target,
+    the cursor is saved together with the name of the staged table, and only then the table is moved in place.
+    A crash at any step leaves either the old table with the old cursor or a state read_clicks_cursor completes,
+    so the clicks of a delta are never counted twice or lost.
+
+    :return: the full name of the saved table
+    """
+    if storage_format not in STORAGE_FORMATS:
+        raise ValueError(f'Incorrect value of "storage_format" parameter: {storage_format}')
+
+    file_path = f'{path}{STORAGE_FORMATS[storage_format]}'
+    staged_path = f'{file_path}.staged'
+    _replace_file(staged_path, lambda temporary_path: _write_table(apply_dtypes(df, dtypes), temporary_path,
+                                                                   storage_format))
+    _write_json(state_file, {'cursor': cursor, 'table': file_path, 'staged_table': staged_path})
+    os.replace(staged_path, file_path)
+    _write_json(state_file, {'cursor': cursor})
+    return file_path
+
+
+def read_changed_regions(file_path: str) -> List[Tuple[int, int]]:
+    """
+    Reads (user region code, event region code) pairs of the regional tables affected by the last update.
+    """
+    with open(file_path, 'r') as json_file:
+        return [tuple(region_pair) for region_pair in json.load(json_file)['region_pairs']]
+
+
+def write_changed_regions(file_path: str, region_pairs: Iterable[Tuple[int, int]]) -> None:
+    region_pairs = sorted(set(region_pairs))
+    _write_json(file_path, {
+        'region_pairs': [list(region_pair) for region_pair in region_pairs],
+        'regions': sorted({user_region for user_region, event_region in region_pairs
+                           if user_region == event_region})
+    })
@@ -2,6 +2,9 @@ import argparse
 from pathlib import Path
 
 from pipeline import preprocessing as prs
+from pipeline import filtering as ftr
+from pipeline import storage
+from pipeline import instrumentation as instr
 
 parser = argparse.ArgumentParser(
     prog='prepare_dataframes',
@@ -57,12 +60,69 @@ parser.add_argument(
     help='directory for saving .csv files'
 )
 
+parser.add_argument(
+    '-storage_format',
+    type=str,
+    default='csv',
+    choices=list(storage.STORAGE_FORMATS),
+    help='a format of the saved tables: csv, parquet or feather.',
+    action='store'
+)
+
+parser.add_argument(
+    '-chunksize',
+    type=int,
+    help='a number of rows of the clicks file read at once; the whole file is read into memory if not passed.',
+    action='store'
+)
+
+parser.add_argument(
+    '-incremental',
+    help='treat clicks_file as a delta: only clicks not counted before (see user_event_state.json) are counted and '
+         'added to the existing user-event table; changed regions are saved into changed_regions.json.',
+    action='store_true'
+)
+
+parser.add_argument(
+    '-log_file',
+    type=str,
+    help='a file the JSON log lines of the stages are appended to; they are written to stderr in any case.',
+    action='store'
+)
+
+parser.add_argument(
+    '-profile',
+    type=str,
+    choices=list(instr.PROFILE_MODES),
+    help='profile the run with cProfile (statistics are saved into -profile_file) or tracemalloc (the top '
+         'allocations are logged).',
+    action='store'
+)
+
+parser.add_argument(
+    '-profile_file',
+    type=str,
+    default='prepare_dataframes.prof',
+    help='a file for the cProfile statistics.',
+    action='store'
+)
+
 args = parser.parse_args()
 args = vars(args)
-paths = list(args.values())
+paths = [args[name] for name in (
+    'clicks_file',
+    'all_events_file',
+    'current_events_file',
+    'organizations_file',
+    'users_file',
+    'regions_file',
+    'regions_codes',
+    'output_directory'
+)]
 
 if __name__ == "__main__":
-    print('INFO: preparing dataframes ...')
+    logger = instr.configure_logging(args['log_file'])
+    logger.info('preparing dataframes ...')
 
     for path in paths[:-1]:
         if not Path(path).is_file():
@@ -72,28 +132,68 @@ if __name__ == "__main__":
             raise OSError(f'Directory {paths[-1]} does not exist.')
 
     target_dir = paths[-1]
-
-    # TODO: add filtering passed cultural events (pipeline.filtering.get_future_event_dataframe)
-
-    user_event_df = prs.get_user_event_dataframe(
-        user_event_file_path=args['clicks_file']
-    )
-    user_event_df.to_csv(f'{target_dir}/user_event_df.csv', index=False)
-
-    users_df = prs.get_user_dataframe(
-        users_file_path=args['users_file'],
-        regions_file_path=args['regions_file'],
-        regions_nums_file_path=args['regions_codes']
-    )
-    users_df.to_csv(f'{target_dir}/user_df.csv', index=False)
-
-    events_df = prs.get_events_dataframe(
-        events_file_path=args['all_events_file'],
-        organizations_file_path=args['organizations_file']
-    )
-    events_df.to_csv(f'{target_dir}/events_df.csv', index=False)
-
-    future_events_df = prs.get_future_event_dataframe(
-        future_event_file_path=args['current_events_file']
-    )
-    future_events_df.to_csv(f'{target_dir}/future_events_df.csv', index=False)
+    storage_format = args['storage_format']
+
+    # the past events are filtered out when recommendations are made (make_recommendations.py -future_events_df),
+    # their clicks are still needed to fit the models
+
+    with instr.profile(args['profile'], args['profile_file']), instr.stage('prepare_dataframes'):
+        with instr.stage('user_event_df', incremental=args['incremental'], chunksize=args['chunksize']) as metrics:
+            if args['incremental']:
+                state_file = f'{target_dir}/user_event_state.json'
+                cursor = storage.read_clicks_cursor(state_file)
+                user_event_delta, new_cursor = prs.get_user_event_delta(
+                    clicks_file_path=args['clicks_file'],
+                    cursor=cursor,
+                    chunksize=args['chunksize']
+                )
+                metrics['delta_rows'] = len(user_event_delta)
+                if cursor is not None:
+                    user_event_df = storage.read_table(
+                        storage.find_table(target_dir, 'user_event_df'),
+                        storage.USER_EVENT_DTYPES
+                    )
+                    user_event_df = prs.merge_clicks_counts([user_event_df, user_event_delta])
+                else:
+                    user_event_df = user_event_delta
+                # the table and the cursor are saved as one update, so the same clicks are skipped by the next run
+                storage.write_table_with_cursor(user_event_df, f'{target_dir}/user_event_df', storage_format,
+                                                storage.USER_EVENT_DTYPES, state_file, new_cursor)
+            else:
+                user_event_df = prs.get_user_event_dataframe(
+                    user_event_file_path=args['clicks_file'],
+                    chunksize=args['chunksize']
+                )
+                storage.write_table(user_event_df, f'{target_dir}/user_event_df', storage_format,
+                                    storage.USER_EVENT_DTYPES)
+            metrics['rows'] = len(user_event_df)
+
+        with instr.stage('user_df') as metrics:
+            users_df = prs.get_user_dataframe(
+                users_file_path=args['users_file'],
+                regions_file_path=args['regions_file'],
+                regions_nums_file_path=args['regions_codes']
+            )
+            storage.write_table(users_df, f'{target_dir}/user_df', storage_format, storage.USER_DTYPES)
+            metrics['rows'] = len(users_df)
+
+        with instr.stage('events_df') as metrics:
+            events_df = prs.get_events_dataframe(
+                events_file_path=args['all_events_file'],
+                organizations_file_path=args['organizations_file']
+            )
+            storage.write_table(events_df, f'{target_dir}/events_df', storage_format, storage.EVENT_DTYPES)
+            metrics['rows'] = len(events_df)
+
+        with instr.stage('future_events_df') as metrics:
+            future_events_df = prs.get_future_event_dataframe(
+                future_event_file_path=args['current_events_file']
+            )
+            storage.write_table(future_events_df, f'{target_dir}/future_events_df', storage_format)
+            metrics['rows'] = len(future_events_df)
+
+        if args['incremental']:
+            changed_region_pairs = ftr.get_region_pairs(user_event_delta, users_df, events_df)
+            storage.write_changed_regions(f'{target_dir}/changed_regions.json', changed_region_pairs)
+            logger.info(f'{len(changed_region_pairs)} regional user-event tables were changed.',
+                        extra={'fields': {'changed_regions': len(changed_region_pairs)}})
@@ -0,0 +1,174 @@
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+
+from typing import Optional, Tuple, Iterable
+
+
+class IVFIndex:
+    """
+    An inverted file index for the maximum inner product search over item factors. Items are clustered by spherical
+    k-means into n_lists lists; a query scores the centroids, takes the items of the n_probe best lists as a shortlist
+    and re-ranks the shortlist with exact inner products. Everything is computed in-process with NumPy on CPU.
+    """
+
+    def __init__(self,
+                 n_lists: Optional[int] = None,
+                 n_probe: int = 8,
+                 n_iterations: int = 10,
+                 random_state: int = 0):
+        """
+        :param n_lists: number of item clusters, sqrt(number of items) if None
+        :param n_probe: number of clusters scanned per query
+        :param n_iterations: number of k-means iterations
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iterations = n_iterations
+        self.random_state = random_state
+
+        self.item_factors = None
+        self.centroids = None
+        self.lists = None
+
+    def fit(self, item_factors: np.ndarray) -> 'IVFIndex':
+        """
+        Clusters the item factors and builds the lists of item numbers, padded with -1 to the same length
+
+        :param item_factors: the item factors matrix of a fitted model
+        :return: the fitted index
+        """
+        self.item_factors = item_factors
+        num_of_items = item_factors.shape[0]
+        n_lists = self.n_lists if self.n_lists is not None else int(np.sqrt(num_of_items))
+        n_lists = max(1, min(n_lists, num_of_items))
+
+        norms = np.linalg.norm(item_factors, axis=1, keepdims=True)
+        directions = item_factors / np.maximum(norms, 1e-12)
+        random_state = np.random.RandomState(self.random_state)
+        centroids = directions[random_state.choice(num_of_items, n_lists, replace=False)]
+        for _ in range(self.n_iterations):
+            assignment = np.argmax(directions.dot(centroids.T), axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, directions)
+            empty = np.linalg.norm(sums, axis=1) == 0
+            # empty clusters are restarted from random items
+            sums[empty] = directions[random_state.choice(num_of_items, np.count_nonzero(empty))]
+            centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+        assignment = np.argmax(directions.dot(centroids.T), axis=1)
+
+        order = np.argsort(assignment, kind='stable')
+        sizes = np.bincount(assignment, minlength=n_lists)
+        self.lists = np.full((n_lists, max(sizes.max(), 1)), -1, dtype=np.int64)
+        positions = np.arange(num_of_items) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        self.lists[assignment[order], positions] = order
+        self.centroids = centroids.astype(item_factors.dtype)
+        return self
+
+    def search(self,
+               user_factors: np.ndarray,
+               N: int,
+               user_items: Optional[sparse.csr_matrix] = None,
+               item_mask: Optional[np.ndarray] = None,
+               block_size: int = 256) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the approximate top-N items for every user
+
+        :param user_factors: factors of the queried users
+        :param N: number of items per user
+        :param user_items: a sparse matrix of already seen items, one row per queried user, to filter them out
+        :param item_mask: a boolean array, False for the items that cannot be recommended
+        :param block_size: number of users searched at once; bounds the size of the shortlist scores
+        :return: item numbers and scores arrays of shape (number of users, N) sorted by descending score; missing
+         items have number -1 and score -inf
+        """
+        n_probe = min(self.n_probe, self.lists.shape[0])
+        num_of_items = self.item_factors.shape[0]
+        top_n = min(N, n_probe * self.lists.shape[1])
+        items = np.full((user_factors.shape[0], N), -1, dtype=np.int64)
+        scores = np.full((user_factors.shape[0], N), -np.inf, dtype=np.float32)
+
+        for start in range(0, user_factors.shape[0], block_size):
+            users = np.asarray(user_factors[start:start + block_size])
+            centroid_scores = users.dot(self.centroids.T)
+            if n_probe < self.lists.shape[0]:
+                probe = np.argpartition(-centroid_scores, n_probe - 1, axis=1)[:, :n_probe]
+            else:
+                probe = np.tile(np.arange(n_probe), (len(users), 1))
+            candidates = self.lists[probe].reshape(len(users), -1)
+
+            valid = candidates >= 0
+            candidate_items = np.where(valid, candidates, 0)
+            candidate_scores = np.einsum('uck,uk->uc', self.item_factors[candidate_items], users)
+            if item_mask is not None:
+                valid &= item_mask[candidate_items]
+            if user_items is not None:
+                seen = user_items[start:start + block_size].tocoo()
+                seen_keys = seen.row.astype(np.int64) * num_of_items + seen.col
+                candidate_keys = np.arange(len(users))[:, None] * num_of_items + candidate_items
+                valid &= ~np.isin(candidate_keys, seen_keys)
+            candidate_scores = np.where(valid, candidate_scores, -np.inf)
+
+            top = np.argpartition(-candidate_scores, top_n - 1, axis=1)[:, :top_n]
+            top_scores = np.take_along_axis(candidate_scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            top_items = np.take_along_axis(candidate_items, top, axis=1)
+
+            stop = start + len(users)
+            scores[start:stop, :top_n] = top_scores
+            items[start:stop, :top_n] = np.where(np.isfinite(top_scores), top_items, -1)
+        return items, scores
+
+
+def ann_recall_report(recommender,
+                      n_lists_values: Iterable[int],
+                      n_probe_values: Iterable[int],
+                      N: int = 10,
+                      sample_size: int = 1000,
+                      random_state: int = 0) -> pd.DataFrame:
+    """
+    Compares the approximate top-N of IVF indexes with different parameters against the exact top-N for a sample of
+    users of the fitted recommender.
+
+    :param recommender: a fitted UserItemRecommender
+    :param n_lists_values: numbers of clusters to try
+    :param n_probe_values: numbers of scanned clusters to try
+    :return: a dataframe with columns n_lists, n_probe, recall, exact_seconds, ann_seconds and speedup
+    """
+    ann_index = recommender.ann_index
+    recommender.ann_index = None
+    num_of_users = recommender.model.user_factors.shape[0]
+    user_nums = np.random.RandomState(random_state).choice(num_of_users, min(sample_size, num_of_users),
+                                                           replace=False)
+    user_nums = np.sort(user_nums)
+    start = time.perf_counter()
+    exact_items, _ = recommender.score_users(user_nums, N)
+    exact_seconds = time.perf_counter() - start
+    relevant = np.count_nonzero(exact_items >= 0)
+
+    rows = list()
+    for n_lists in n_lists_values:
+        index = IVFIndex(n_lists=n_lists, random_state=random_state).fit(recommender.model.item_factors)
+        for n_probe in n_probe_values:
+            index.n_probe = n_probe
+            recommender.ann_index = index
+            start = time.perf_counter()
+            ann_items, _ = recommender.score_users(user_nums, N)
+            ann_seconds = time.perf_counter() - start
+            found = sum(
+                len(np.intersect1d(exact[exact >= 0], approximate[approximate >= 0]))
+                for exact, approximate in zip(exact_items, ann_items)
+            )
+            rows.append({
+                'n_lists': index.lists.shape[0],
+                'n_probe': n_probe,
+                'recall': round(found / max(relevant, 1), 4),
+                'exact_seconds': round(exact_seconds, 4),
+                'ann_seconds': round(ann_seconds, 4),
+                'speedup': round(exact_seconds / max(ann_seconds, 1e-9), 2)
+            })
+    recommender.ann_index = ann_index
+    return pd.DataFrame(rows)
@@ -0,0 +1,125 @@
+import json
+import numpy as np
+
+from pathlib import Path
+from typing import Iterable, Iterator, List, Tuple, Union
+
+FORMAT_VERSION = 1
+SCORE_DTYPES = ('float16', 'float32')
+
+
+def get_item_id_dtype(item_ids: np.ndarray) -> np.dtype:
+    """
+    :return: the narrowest fixed-width integer type the item ids fit into
+    """
+    if len(item_ids) == 0 or np.iinfo(np.int32).min <= np.min(item_ids) and np.max(item_ids) <= np.iinfo(np.int32).max:
+        return np.dtype('int32')
+    return np.dtype('int64')
+
+
+def write_binary_recommendations(
+        directory: str,
+        rows: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+        item_id_dtype: Union[str, np.dtype] = 'int64',
+        score_dtype: str = 'float16'
+) -> Tuple[int, int]:
+    """
+    Saves recommendations into the directory in a binary format:
+        - items.bin, scores.bin: item ids and scores of all users, one contiguous run of rows per user;
+        - user_ids.npy: user ids sorted in ascending order;
+        - positions.npy: (start, stop) rows of every user of user_ids in items.bin and scores.bin;
+        - meta.json: format version, dtypes and sizes of the arrays.
+    Item ids and scores are appended to the files block by block, so only the user index is kept in memory.
+
+    :param rows: an iterator over (user_id, item_id, score) arrays, the rows of a user must not be split between blocks
+    :param item_id_dtype: a fixed-width integer type of the item ids
+    :param score_dtype: 'float16' or 'float32'
+    :return: the numbers of saved users and rows
+    """
+    if score_dtype not in SCORE_DTYPES:
+        raise ValueError(f'Incorrect value of "score_dtype" parameter: {score_dtype}')
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    user_ids, starts, stops = list(), list(), list()
+    num_of_rows = 0
+    with open(directory / 'items.bin', 'wb') as items_file, open(directory / 'scores.bin', 'wb') as scores_file:
+        for block_user_ids, item_ids, scores in rows:
+            if len(block_user_ids) == 0:
+                continue
+            items_file.write(np.asarray(item_ids, dtype=item_id_dtype).tobytes())
+            scores_file.write(np.asarray(scores, dtype=score_dtype).tobytes())
+            # rows of a user are contiguous, so users start where the user id changes
+            block_starts = np.flatnonzero(np.r_[True, block_user_ids[1:] != block_user_ids[:-1]])
+            user_ids.append(np.asarray(block_user_ids)[block_starts].astype(str))
+            starts.append(block_starts + num_of_rows)
+            stops.append(np.r_[block_starts[1:], len(block_user_ids)] + num_of_rows)
+            num_of_rows += len(block_user_ids)
+
+    user_ids = np.concatenate(user_ids) if user_ids else np.array([], dtype=str)
+    positions = np.stack([
+        np.concatenate(starts) if starts else np.array([], dtype=np.int64),
+        np.concatenate(stops) if stops else np.array([], dtype=np.int64)
+    ], axis=1).astype(np.int64)
+    order = np.argsort(user_ids, kind='stable')
+    np.save(directory / 'user_ids.npy', user_ids[order])
+    np.save(directory / 'positions.npy', positions[order])
+    with open(directory / 'meta.json', 'w') as json_file:
+        json.dump({
+            'format_version': FORMAT_VERSION,
+            'item_id_dtype': np.dtype(item_id_dtype).name,
+            'score_dtype': score_dtype,
+            'num_of_users': len(user_ids),
+            'num_of_rows': num_of_rows
+        }, json_file)
+    return len(user_ids), num_of_rows
+
+
+class RecommendationReader:
+    """
+    Reads recommendations saved by write_binary_recommendations. All arrays are memory-mapped, a user is found by
+    binary search over the sorted user ids and only the rows of this user are read from the disk.
+    """
+
+    def __init__(self, directory: str):
+        directory = Path(directory)
+        with open(directory / 'meta.json', 'r') as json_file:
+            self.meta = json.load(json_file)
+        if self.meta['format_version'] != FORMAT_VERSION:
+            raise ValueError(f'Unsupported format version of {directory}: {self.meta["format_version"]}')
+        self.user_ids = np.load(directory / 'user_ids.npy', mmap_mode='r')
+        self.positions = np.load(directory / 'positions.npy', mmap_mode='r')
+        # np.memmap cannot map an empty file
+        if self.meta['num_of_rows'] != 0:
+            self.items = np.memmap(directory / 'items.bin', dtype=self.meta['item_id_dtype'], mode='r')
+            self.scores = np.memmap(directory / 'scores.bin', dtype=self.meta['score_dtype'], mode='r')
+        else:
+            self.items = np.array([], dtype=self.meta['item_id_dtype'])
+            self.scores = np.array([], dtype=self.meta['score_dtype'])
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def __contains__(self, user_id: str) -> bool:
+        return self._find(user_id) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.user_ids.tolist())
+
+    def _find(self, user_id: str):
+        position = np.searchsorted(self.user_ids, str(user_id))
+        if position < len(self.user_ids) and self.user_ids[position] == str(user_id):
+            return position
+        return None
+
+    def get_user_recommendation(self, user_id: str) -> List[Tuple[int, float]]:
+        """
+        :param user_id: string value of user id from source data
+        :return: a list of (item id, score) sorted by descending score
+        :raises KeyError: if there are no recommendations for the user
+        """
+        position = self._find(user_id)
+        if position is None:
+            raise KeyError(user_id)
+        start, stop = self.positions[position]
+        return list(zip(self.items[start:stop].tolist(), self.scores[start:stop].astype(float).tolist()))
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+from typing import Any, Iterable, Tuple, Union
+
+
+class IdEncoder:
+    """
+    Maps user or item ids to their numbers in the recommender matrices and back with NumPy arrays instead of Python
+    dictionaries: ids[num] gives the id of a number and the search in the sorted copy of ids gives the number of an
+    id. Ids of a categorical column are already sorted, so no extra copy is made for them.
+    """
+
+    def __init__(self, ids: Union[np.ndarray, Iterable[Any]]):
+        """
+        :param ids: unique ids ordered by their numbers
+        """
+        self.ids = np.asarray(ids)
+        if len(self.ids) > 1 and np.all(self.ids[1:] > self.ids[:-1]):
+            self._order = None
+            self._sorted_ids = self.ids
+        else:
+            self._order = np.argsort(self.ids, kind='stable')
+            self._sorted_ids = self.ids[self._order]
+
+    @classmethod
+    def from_columns(cls, ids: pd.Series, nums: pd.Series) -> 'IdEncoder':
+        """
+        Creates an encoder from the id and number columns of a user-item dataframe. For a categorical id column
+        numbered by its codes (see pipeline.filtering.numerate_user_event_df) the categories are used as they are.
+
+        :raises ValueError: if the numbers are not 0, 1, ..., n - 1 (every number must have an id)
+        """
+        if isinstance(ids.dtype, pd.CategoricalDtype) and np.array_equal(ids.cat.codes.values, nums.values):
+            return cls(ids.cat.categories.values)
+        nums = nums.to_numpy()
+        ids = np.asarray(ids.to_numpy())
+        unique_nums = np.unique(nums)
+        if len(unique_nums) and (unique_nums[0] != 0 or unique_nums[-1] != len(unique_nums) - 1):
+            raise ValueError(f'The numbers must be 0, ..., n - 1 without gaps, got {len(unique_nums)} numbers '
+                             f'from {unique_nums[0]} to {unique_nums[-1]}')
+        encoded_ids = np.empty(len(unique_nums), dtype=ids.dtype)
+        encoded_ids[nums] = ids
+        return cls(encoded_ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id_) -> bool:
+        return self.encode([id_])[0] >= 0
+
+    def decode(self, nums: Union[np.ndarray, Iterable[int]]) -> np.ndarray:
+        """
+        :return: ids of the numbers
+        """
+        return self.ids[np.asarray(nums, dtype=np.int64)]
+
+    def encode(self, ids: Union[np.ndarray, Iterable[Any]]) -> np.ndarray:
+        """
+        :return: numbers of the ids, -1 for unknown ids; the ids are cast to the type of the encoder ids first, so
+         '5' is found among integer ids and 5 among string ids
+        """
+        ids = np.asarray(ids)
+        nums = np.full(len(ids), -1, dtype=np.int64)
+        if len(self.ids) == 0 or len(ids) == 0:
+            return nums
+        ids, castable = self._cast(ids)
+        positions = np.minimum(np.searchsorted(self._sorted_ids, ids), len(self.ids) - 1)
+        found = self._sorted_ids[positions] == ids
+        found_nums = positions if self._order is None else self._order[positions]
+        nums[castable] = np.where(found, found_nums, -1)
+        return nums
+
+    def _cast(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: the ids that can be cast to the type of the encoder ids and a mask of them among the passed ids
+        """
+        if self.ids.dtype.kind not in 'iuf':
+            # numbers are never equal to strings, and comparing them in searchsorted raises an error
+            return ids.astype(str) if ids.dtype.kind in 'iufb' else ids, np.ones(len(ids), dtype=bool)
+        if ids.dtype.kind in 'iuf':
+            return ids, np.ones(len(ids), dtype=bool)
+        numbers = pd.to_numeric(pd.Series(ids, dtype=object), errors='coerce')
+        castable = numbers.notna().to_numpy()
+        numbers = numbers[castable].to_numpy()
+        if self.ids.dtype.kind in 'iu':
+            castable[castable] = numbers == np.floor(numbers)
+            numbers = numbers[numbers == np.floor(numbers)]
+        return numbers.astype(self.ids.dtype), castable
+
+    def get_num(self, id_) -> int:
+        """
+        :return: the number of the id
+        :raises KeyError: if the id is unknown
+        """
+        num = self.encode([id_])[0]
+        if num < 0:
+            raise KeyError(id_)
+        return int(num)
@@ -1,17 +1,48 @@
 # TODO: upgrade to the implicit library version 0.5
 
+import os
 import csv
+import gzip
 import json
+import inspect
+import logging
+import numpy as np
 import pandas as pd
 import scipy.sparse as sparse
 
-from bidict import bidict
 from abc import abstractmethod, ABC
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Tuple, Iterator, Dict, Any
+from pathlib import Path
 from implicit.als import AlternatingLeastSquares
 from implicit.bpr import BayesianPersonalizedRanking
 from implicit.nearest_neighbours import bm25_weight
 
+from .ann import IVFIndex
+from .encoding import IdEncoder
+from .binary_format import get_item_id_dtype, write_binary_recommendations
+
+# the logger configured by pipeline.instrumentation.configure_logging (LOGGER_NAME) in the pipeline scripts
+logger = logging.getLogger('recommendations')
+
+DEFAULT_BLOCK_SIZE = 1024
+
+
+def build_user_item_matrix(user_nums: Union[pd.Series, np.ndarray],
+                           item_nums: Union[pd.Series, np.ndarray],
+                           ratings: Union[pd.Series, np.ndarray],
+                           shape: Optional[Tuple[int, int]] = None) -> sparse.csr_matrix:
+    """
+    Builds the user-item matrix in float32, the type the implicit models train on, with a single COO to CSR
+    conversion. Ratings of repeated (user, item) pairs are summed.
+
+    :param shape: (number of users, number of items), derived from the maximum numbers if None
+    """
+    matrix = sparse.coo_matrix(
+        (np.asarray(ratings, dtype=np.float32), (np.asarray(user_nums), np.asarray(item_nums))),
+        shape=shape
+    )
+    return matrix.tocsr()
+
 
 class UserItemRecommender(ABC):
     """
@@ -20,14 +51,16 @@ class UserItemRecommender(ABC):
 
     def __init__(self, num_of_threads: int = 0):
         self.model = None
-        self.recommendations = list()
+        self.recommendations = None
         self.user_item = None
         self.extra_item_ids = None
+        self.extra_item_mask = None
 
-        self.user_number_per_id = None
-        self.item_number_per_id = None
-        self.sparse_item_user = None
+        self.user_encoder = None
+        self.item_encoder = None
         self.sparse_user_item = None
+        self.ann_index = None
+        self.similar_items = None
 
         self.num_of_threads = num_of_threads
 
@@ -41,30 +74,169 @@ class UserItemRecommender(ABC):
         +---------+---------+--------+----------+----------+
         | user_id | item_id | rating | user_num | item_num |
         +---------+---------+--------+----------+----------+
-        :param extra_item_ids: a list of  extra item ids to filter out from the output
+        :param extra_item_ids: a list of  extra item ids to filter out from the output, e.g. the past events
+         (see pipeline.filtering.get_extra_events_ids)
         """
         # print('- fitting the model')
         self.user_item = user_item_df
-        self.extra_item_ids = extra_items_ids
+        self.user_encoder = IdEncoder.from_columns(self.user_item['user_id'], self.user_item['user_num'])
+        self.item_encoder = IdEncoder.from_columns(self.user_item['item_id'], self.user_item['item_num'])
+        self._set_user_item_matrix(
+            build_user_item_matrix(self.user_item['user_num'], self.user_item['item_num'], self.user_item['rating'],
+                                   shape=(len(self.user_encoder), len(self.item_encoder))),
+            extra_items_ids
+        )
 
-        user_number_per_id = self.user_item.loc[:, ['user_num', 'user_id']].drop_duplicates()
-        self.user_number_per_id = bidict(dict(zip(user_number_per_id.user_id, user_number_per_id.user_num)))
+    def fit_matrix(self,
+                   user_item_matrix: sparse.spmatrix,
+                   user_ids: Optional[Union[np.ndarray, List[Any]]] = None,
+                   item_ids: Optional[Union[np.ndarray, List[Any]]] = None,
+                   extra_item_ids: Optional[List[int]] = None,
+                   show_progress: bool = False) -> None:
+        """
+        Fits the model on a prebuilt sparse matrix instead of a dataframe, e.g. a matrix built once by
+        build_user_item_matrix and shared by several recommenders. A float32 CSR matrix is used without a copy.
 
-        item_number_per_id = self.user_item.loc[:, ['item_num', 'item_id']].drop_duplicates()
-        self.item_number_per_id = bidict(dict(zip(item_number_per_id.item_id, item_number_per_id.item_num)))
+        :param user_item_matrix: a sparse matrix of ratings with users in rows and items in columns
+        :param user_ids: ids of the rows, the row numbers if None
+        :param item_ids: ids of the columns, the column numbers if None
+        :param extra_item_ids: a list of extra item ids to filter out from the output
+        """
+        num_of_users, num_of_items = user_item_matrix.shape
+        user_ids = np.arange(num_of_users) if user_ids is None else user_ids
+        item_ids = np.arange(num_of_items) if item_ids is None else item_ids
+        if len(user_ids) != num_of_users or len(item_ids) != num_of_items:
+            raise ValueError(f'The numbers of user and item ids do not match the matrix shape {user_item_matrix.shape}')
 
-        self.sparse_item_user = sparse.csr_matrix(
-            (self.user_item['rating'].astype(float), (self.user_item['item_num'], self.user_item['user_num']))
-        )
-        self.sparse_user_item = sparse.csr_matrix(
-            (self.user_item['rating'].astype(float), (self.user_item['user_num'], self.user_item['item_num']))
-        )
+        self.user_item = None
+        self.user_encoder = IdEncoder(user_ids)
+        self.item_encoder = IdEncoder(item_ids)
+        self._set_user_item_matrix(sparse.csr_matrix(user_item_matrix, dtype=np.float32), extra_item_ids)
+        self._fit_model(show_progress)
 
-        if self.extra_item_ids is not None:
-            self.extra_item_ids = [self.item_number_per_id[item_id] for item_id in self.extra_item_ids]
+    def _set_user_item_matrix(self, user_item_matrix: sparse.csr_matrix, extra_item_ids: Optional[List[int]]) -> None:
+        self.sparse_user_item = user_item_matrix
+        self.ann_index = None
+        self.similar_items = None
+        self.recommendations = None
+        self.extra_item_mask = None
+        if extra_item_ids is not None:
+            # ids of the items absent from the matrix cannot be recommended anyway
+            extra_item_nums = self.item_encoder.encode(np.asarray(extra_item_ids))
+            self.extra_item_ids = np.unique(extra_item_nums[extra_item_nums >= 0]).tolist()
         else:
             self.extra_item_ids = None
 
+    @property
+    def sparse_item_user(self) -> Optional[sparse.csr_matrix]:
+        """
+        The item-user matrix the implicit models are fitted on. It is transposed from sparse_user_item on every access
+        instead of being kept as a second copy of the ratings, so the returned matrix can be modified in place.
+        """
+        if self.sparse_user_item is None:
+            return None
+        return self.sparse_user_item.T.tocsr()
+
+    @abstractmethod
+    def _fit_model(self, show_progress: bool = False) -> None:
+        """
+        Creates and fits the model of the implicit library on sparse_user_item
+        """
+
+    @abstractmethod
+    def _build_model(self):
+        """
+        Creates an unfitted model of the implicit library with the parameters of the recommender
+        """
+
+    def get_params(self) -> Dict[str, Any]:
+        """
+        :return: the parameters the recommender was created with
+        """
+        parameters = inspect.signature(type(self).__init__).parameters
+        return {name: getattr(self, name) for name in parameters if name != 'self'}
+
+    def save(self, directory: str) -> None:
+        """
+        Saves the fitted recommender into the directory:
+            - params.json: the recommender class and its parameters;
+            - user_factors.npy, item_factors.npy: the factors of the model;
+            - user_items.npz: the sparse user-item matrix in CSR format;
+            - user_ids.npy, item_ids.npy: ids of users and items ordered by their numbers;
+            - extra_item_nums.npy: numbers of the extra items, if they were passed to the fit method.
+        Every file is written under a temporary name and renamed, so the files of a previously saved recommender
+        can be memory-mapped while they are overwritten.
+
+        :param directory: target directory, it is created if it does not exist
+        :return: None
+        """
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+        def replace(file_name: str, write) -> None:
+            temporary_path = Path(directory) / f'.{file_name}.tmp'
+            with open(temporary_path, 'wb') as file:
+                write(file)
+            os.replace(temporary_path, Path(directory) / file_name)
+
+        params = json.dumps({'class': type(self).__name__, 'params': self.get_params()}).encode()
+        replace('params.json', lambda file: file.write(params))
+        replace('user_factors.npy', lambda file: np.save(file, np.asarray(self.model.user_factors)))
+        replace('item_factors.npy', lambda file: np.save(file, np.asarray(self.model.item_factors)))
+        replace('user_items.npz', lambda file: sparse.save_npz(file, self.sparse_user_item.tocsr()))
+        replace('user_ids.npy', lambda file: np.save(file, self.user_encoder.ids.tolist()))
+        replace('item_ids.npy', lambda file: np.save(file, self.item_encoder.ids.tolist()))
+        extra_item_nums_path = Path(directory) / 'extra_item_nums.npy'
+        if self.extra_item_ids is not None:
+            replace('extra_item_nums.npy', lambda file: np.save(file, np.asarray(self.extra_item_ids, dtype=int)))
+        elif extra_item_nums_path.is_file():
+            extra_item_nums_path.unlink()
+
+    def load_state(self, directory: str, mmap_mode: Optional[str] = 'r') -> None:
+        """
+        Restores the fitted state saved by the save method into this recommender. The factors are memory-mapped by
+        default, so several processes loading the same directory share the same pages.
+
+        :param directory: a directory with the saved recommender
+        :param mmap_mode: mmap_mode of numpy.load for the factors, None to read them into memory
+        :return: None
+        """
+        directory = Path(directory)
+        self.model = self._build_model()
+        self.model.user_factors = np.load(directory / 'user_factors.npy', mmap_mode=mmap_mode)
+        self.model.item_factors = np.load(directory / 'item_factors.npy', mmap_mode=mmap_mode)
+        self.sparse_user_item = sparse.load_npz(directory / 'user_items.npz').tocsr().astype(np.float32, copy=False)
+
+        self.user_encoder = IdEncoder(np.load(directory / 'user_ids.npy'))
+        self.item_encoder = IdEncoder(np.load(directory / 'item_ids.npy'))
+
+        self.user_item = None
+        self.ann_index = None
+        self.similar_items = None
+        self.recommendations = None
+        self.extra_item_ids = None
+        self.extra_item_mask = None
+        if (directory / 'extra_item_nums.npy').is_file():
+            self.extra_item_ids = np.load(directory / 'extra_item_nums.npy').tolist()
+
+    @classmethod
+    def load(cls, directory: str, mmap_mode: Optional[str] = 'r', **params) -> 'UserItemRecommender':
+        """
+        Creates a recommender saved by the save method without fitting it again.
+
+        :param directory: a directory with the saved recommender
+        :param mmap_mode: mmap_mode of numpy.load for the factors, None to read them into memory
+        :param params: recommender parameters overriding the saved ones, e.g. num_of_threads
+        :return: the recommender of the saved class
+        """
+        with open(Path(directory) / 'params.json', 'r') as json_file:
+            saved = json.load(json_file)
+        recommender_classes = {subclass.__name__: subclass for subclass in UserItemRecommender.__subclasses__()}
+        if saved['class'] not in recommender_classes:
+            raise ValueError(f'Unknown recommender class: {saved["class"]}')
+        recommender = recommender_classes[saved['class']](**{**saved['params'], **params})
+        recommender.load_state(str(directory), mmap_mode)
+        return recommender
+
     def get_user_recommendation(self,
                                 user_id: str,
                                 N: int = 10,
@@ -77,59 +249,334 @@ class UserItemRecommender(ABC):
         :param user_id: string value of user id from source data
         :return: the list of recommendations as the list type or the pandas dataframe
         """
-        user_num = self.user_number_per_id[user_id]
-        recommended = self.model.recommend(user_num, self.sparse_user_item, filter_items=self.extra_item_ids, N=N)
+        user_num = self.user_encoder.get_num(user_id)
+        if self.ann_index is not None:
+            items, scores = self.score_users(np.array([user_num]), N)
+            recommended = [(item, score) for item, score in zip(items[0], scores[0]) if item >= 0]
+        else:
+            recommended = self.model.recommend(user_num, self.sparse_user_item, filter_items=self.extra_item_ids, N=N)
         recommendations = list()
-        for item in recommended:
-            try:
-                event_num, event_score = item
-                recommendations.append([
-                    user_id,
-                    self.item_number_per_id.inverse[event_num],
-                    event_score
-                ])
-            except KeyError:
-                # TODO: make error description more explicit
-                #  when the number of cultural events is too small, recommender cannot return the list of N events
+        for event_num, event_score in recommended:
+            # TODO: make error description more explicit
+            #  when the number of cultural events is too small, recommender cannot return the list of N events
+            if not 0 <= event_num < len(self.item_encoder):
                 continue
+            recommendations.append([
+                user_id,
+                self.item_encoder.ids[event_num],
+                event_score
+            ])
         if as_pd_dataframe:
             return pd.DataFrame(recommendations, columns=['user_id', 'item_id', 'rating'])
         else:
             return recommendations
 
-    def get_all_recommendation(self, as_pd_dataframe: bool = True) -> Union[list, pd.DataFrame]:
+    def get_all_recommendation(self,
+                               as_pd_dataframe: bool = True,
+                               block_size: Optional[int] = None) -> Union[list, pd.DataFrame]:
         """
         Calculates recommendation for all users with the default parameters for implicit.<model>.recommend method and
         saves it as list or pd.Dataframe
         :param as_pd_dataframe: boolean flag, if True -- return as a pd.Dataframe, otherwise as a list
+        :param block_size: if passed, users are scored in blocks of this size instead of one by one
         :return: the list of recommendations as the list type or the pandas dataframe
         """
         self.recommendations = list()
-        for user_num in self.user_number_per_id.keys():
-            self.recommendations.extend(self.get_user_recommendation(user_num, as_pd_dataframe=False))
+        if block_size is not None:
+            user_nums, item_nums, scores = self.get_all_recommendation_batched(block_size=block_size)
+            user_ids = self.user_encoder.decode(user_nums)
+            item_ids = self.item_encoder.decode(item_nums)
+            self.recommendations = list(zip(user_ids.tolist(), item_ids.tolist(), scores.tolist()))
+        else:
+            for user_id in self.user_encoder.ids:
+                self.recommendations.extend(self.get_user_recommendation(user_id, as_pd_dataframe=False))
         if as_pd_dataframe:
             return pd.DataFrame(self.recommendations, columns=['user_id', 'item_id', 'rating'])
         else:
             return self.recommendations
 
-    def to_csv(self, filename: str) -> None:
+    def build_ann_index(self, n_lists: Optional[int] = None, n_probe: int = 8, random_state: int = 0) -> IVFIndex:
         """
-        Saves recommendation dataframe as .csv without changes
+        Builds an approximate nearest neighbour index over the item factors of the fitted model. Once it is built,
+        recommendations are taken from the shortlist of the n_probe closest item clusters instead of all items
+        (see recommenders.ann.IVFIndex); set ann_index to None to return to the exact search.
 
-        :param filename: target .csv full filename
-        :return: None
+        :param n_lists: number of item clusters, sqrt(number of items) if None
+        :param n_probe: number of clusters scanned per user
+        :return: the built index
         """
-        print('- saving as csv')
-        if self.recommendations is None:
-            self.get_all_recommendation(as_pd_dataframe=False)
-        with open(f"{filename}.csv", 'w', newline='') as file:
+        self.ann_index = IVFIndex(n_lists=n_lists, n_probe=n_probe, random_state=random_state)
+        self.ann_index.fit(self.model.item_factors)
+        return self.ann_index
+
+    def get_extra_item_mask(self) -> Optional[np.ndarray]:
+        """
+        :return: a boolean array, False for the extra items, built once per fit; None if there are no extra items
+        """
+        if not self.extra_item_ids:
+            return None
+        if self.extra_item_mask is None:
+            self.extra_item_mask = np.ones(self.model.item_factors.shape[0], dtype=bool)
+            self.extra_item_mask[self.extra_item_ids] = False
+        return self.extra_item_mask
+
+    def score_users(self,
+                    user_nums: np.ndarray,
+                    N: int = 10,
+                    item_mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Calculates the top-N items for a block of users at once: the user factors are multiplied by the factors of the
+        allowed items (or searched in ann_index, if it was built), already seen items are masked out and the top-N
+        items are selected with np.argpartition.
+
+        :param user_nums: numbers of the scored users
+        :param N: number of recommended items per user
+        :param item_mask: a boolean array, False for the items that cannot be recommended to these users, e.g. the
+         items of other regions; extra items are never recommended
+        :return: item numbers and scores arrays of shape (number of users, N) sorted by descending score; missing
+         items (when the number of items is too small) have number -1 and score -inf
+        """
+        user_factors = np.asarray(self.model.user_factors[user_nums])
+        item_factors = self.model.item_factors
+        num_of_items = item_factors.shape[0]
+        extra_item_mask = self.get_extra_item_mask()
+        if item_mask is None:
+            item_mask = extra_item_mask
+        elif extra_item_mask is not None:
+            item_mask = item_mask & extra_item_mask
+        seen = self.sparse_user_item[user_nums]
+
+        if self.ann_index is not None:
+            return self.ann_index.search(user_factors, N, user_items=seen, item_mask=item_mask)
+
+        items = np.full((len(user_nums), N), -1, dtype=np.int64)
+        scores = np.full((len(user_nums), N), -np.inf, dtype=np.float32)
+        # only the allowed items are scored
+        candidates = np.arange(num_of_items) if item_mask is None else np.flatnonzero(item_mask)
+        top_n = min(N, len(candidates))
+        if top_n <= 0:
+            return items, scores
+
+        if item_mask is not None:
+            item_factors = item_factors[candidates]
+        block_scores = user_factors.dot(np.asarray(item_factors).T)
+        seen = seen.tocoo()
+        candidate_positions = np.full(max(num_of_items, seen.shape[1]), -1, dtype=np.int64)
+        candidate_positions[candidates] = np.arange(len(candidates))
+        seen_positions = candidate_positions[seen.col]
+        seen_items = seen_positions >= 0
+        block_scores[seen.row[seen_items], seen_positions[seen_items]] = -np.inf
+
+        top_items, top_scores = self._select_top(block_scores, top_n)
+        scores[:, :top_n] = top_scores
+        items[:, :top_n] = np.where(np.isfinite(top_scores), candidates[top_items], -1)
+        return items, scores
+
+    @staticmethod
+    def _select_top(block_scores: np.ndarray, top_n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: column numbers and scores of the top_n highest scores of every row sorted by descending score
+        """
+        if top_n < block_scores.shape[1]:
+            top_columns = np.argpartition(-block_scores, top_n - 1, axis=1)[:, :top_n]
+        else:
+            top_columns = np.tile(np.arange(block_scores.shape[1]), (block_scores.shape[0], 1))
+        top_scores = np.take_along_axis(block_scores, top_columns, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        return np.take_along_axis(top_columns, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def iter_similar_item_blocks(self,
+                                 K: int = 10,
+                                 block_size: int = DEFAULT_BLOCK_SIZE,
+                                 item_mask: Optional[np.ndarray] = None
+                                 ) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Finds the K most similar items of every item by the cosine similarity of the item factors. A block of items is
+        compared with all candidates by one matrix product, so peak memory is bounded by block_size * number of items
+        similarities. An item is never similar to itself and extra items are never similar to other items.
+
+        :param K: number of similar items per item
+        :param block_size: number of items compared at once
+        :param item_mask: a boolean array, False for the items that are neither compared nor returned, e.g. the items
+         of other regions
+        :return: an iterator over (item_num, similar item_nums, similarities) arrays, the last two of shape
+         (number of items, K) sorted by descending similarity; missing items have number -1 and similarity -inf
+        """
+        item_factors = np.asarray(self.model.item_factors, dtype=np.float32)
+        num_of_items = item_factors.shape[0]
+        norms = np.linalg.norm(item_factors, axis=1)
+        item_factors = item_factors / np.where(norms > 0, norms, 1)[:, None]
+
+        item_nums = np.arange(num_of_items) if item_mask is None else np.flatnonzero(item_mask)
+        extra_item_mask = self.get_extra_item_mask()
+        if item_mask is not None and extra_item_mask is not None:
+            extra_item_mask = item_mask & extra_item_mask
+        candidates = item_nums if extra_item_mask is None else np.flatnonzero(extra_item_mask)
+        candidate_positions = np.full(num_of_items, -1, dtype=np.int64)
+        candidate_positions[candidates] = np.arange(len(candidates))
+        candidate_factors = item_factors[candidates]
+        top_k = min(K, len(candidates))
+
+        for start in range(0, len(item_nums), block_size):
+            block = item_nums[start:start + block_size]
+            items = np.full((len(block), K), -1, dtype=np.int64)
+            similarities = np.full((len(block), K), -np.inf, dtype=np.float32)
+            if top_k > 0:
+                block_similarities = item_factors[block].dot(candidate_factors.T)
+                self_positions = candidate_positions[block]
+                rows = np.flatnonzero(self_positions >= 0)
+                block_similarities[rows, self_positions[rows]] = -np.inf
+                top_items, top_similarities = self._select_top(block_similarities, top_k)
+                similarities[:, :top_k] = top_similarities
+                items[:, :top_k] = np.where(np.isfinite(top_similarities), candidates[top_items], -1)
+            yield block, items, similarities
+
+    def build_similar_items(self, K: int = 10, block_size: int = DEFAULT_BLOCK_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Precomputes the table of the K most similar items of every item (see iter_similar_item_blocks). The table is
+        kept as two compact arrays with a row per item number: similar item numbers (int32) and similarities
+        (float32), so get_similar_items is a row lookup.
+
+        :return: the similar item numbers and similarities arrays of shape (number of items, K)
+        """
+        num_of_items = self.model.item_factors.shape[0]
+        similar_items = np.full((num_of_items, K), -1, dtype=np.int32)
+        similarities = np.full((num_of_items, K), -np.inf, dtype=np.float32)
+        for item_nums, block_items, block_similarities in self.iter_similar_item_blocks(K, block_size):
+            similar_items[item_nums] = block_items
+            similarities[item_nums] = block_similarities
+        self.similar_items = similar_items, similarities
+        return self.similar_items
+
+    def get_similar_items(self, item_id: Any, N: int = 10) -> List[Tuple[Any, float]]:
+        """
+        Looks up the similar items of an item in the table of build_similar_items, which has to be built beforehand
+        (e.g. when the model is loaded for serving), so concurrent lookups only read it.
+
+        :param item_id: an item id from source data
+        :param N: number of similar items, at most K of the built table
+        :return: a list of (item id, similarity) sorted by descending similarity
+        :raises KeyError: if the item is unknown
+        :raises ValueError: if the table was not built or N is greater than its K
+        """
+        if self.similar_items is None:
+            raise ValueError('The similar items table was not built, call build_similar_items first')
+        similar_items, similarities = self.similar_items
+        if N > similar_items.shape[1]:
+            raise ValueError(f'N = {N} is greater than K = {similar_items.shape[1]} of the similar items table')
+        item_num = self.item_encoder.get_num(item_id)
+        similar_items, similarities = similar_items[item_num, :N], similarities[item_num, :N]
+        found = similar_items >= 0
+        return list(zip(self.item_encoder.decode(similar_items[found]).tolist(),
+                        similarities[found].astype(float).tolist()))
+
+    def iter_recommendation_blocks(self,
+                                   N: int = 10,
+                                   block_size: int = DEFAULT_BLOCK_SIZE,
+                                   user_nums: Optional[np.ndarray] = None,
+                                   item_mask: Optional[np.ndarray] = None
+                                   ) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Calculates recommendations for all users block by block with score_users. Peak memory is bounded by
+        block_size * number of items scores.
+
+        :param N: number of recommended items per user
+        :param block_size: number of users scored at once
+        :param user_nums: numbers of the users to score, all users if None
+        :param item_mask: a boolean array, False for the items that cannot be recommended to these users
+        :return: an iterator over (user_num, item_num, score) arrays, sorted by user_num and descending score
+        """
+        if user_nums is None:
+            user_nums = np.arange(self.model.user_factors.shape[0])
+        for start in range(0, len(user_nums), block_size):
+            block = user_nums[start:start + block_size]
+            items, scores = self.score_users(block, N, item_mask)
+            # when the number of items is too small, a user can have less than N items left after masking
+            valid = items.ravel() >= 0
+            yield np.repeat(block, N)[valid], items.ravel()[valid], scores.ravel()[valid]
+
+    def get_all_recommendation_batched(self,
+                                       N: int = 10,
+                                       block_size: int = DEFAULT_BLOCK_SIZE
+                                       ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Calculates recommendations for all users with batched scoring (see iter_recommendation_blocks)
+
+        :param N: number of recommended items per user
+        :param block_size: number of users scored at once
+        :return: user_num, item_num and score NumPy arrays of equal length
+        """
+        blocks = list(self.iter_recommendation_blocks(N=N, block_size=block_size))
+        if len(blocks) == 0:
+            return np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=np.float32)
+        user_nums, item_nums, scores = zip(*blocks)
+        return np.concatenate(user_nums), np.concatenate(item_nums), np.concatenate(scores)
+
+    def iter_recommendation_rows(self,
+                                 N: int = 10,
+                                 block_size: int = DEFAULT_BLOCK_SIZE,
+                                 user_nums: Optional[np.ndarray] = None,
+                                 item_mask: Optional[np.ndarray] = None
+                                 ) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Iterates over recommendations as (user_id, item_id, score) arrays. Users are scored block by block with
+        iter_recommendation_blocks, so only one block of recommendations is kept in memory at a time. The result of
+        get_all_recommendation is not reused, it could be computed with another N.
+
+        :param N: number of recommended items per user
+        :param block_size: number of users scored at once
+        :param user_nums: numbers of the users to score, all users if None
+        :param item_mask: a boolean array, False for the items that cannot be recommended to these users
+        :return: an iterator over arrays of user ids, item ids and scores; the rows of a user are never split
+         between blocks
+        """
+        for block_user_nums, item_nums, scores in self.iter_recommendation_blocks(N, block_size, user_nums, item_mask):
+            yield self.user_encoder.decode(block_user_nums), self.item_encoder.decode(item_nums), scores
+
+    @staticmethod
+    def _open_output(filename: str, suffix: str, compress: bool):
+        if compress:
+            return gzip.open(f'{filename}{suffix}.gz', 'wt', newline='')
+        return open(f'{filename}{suffix}', 'w', newline='')
+
+    def to_csv(self,
+               filename: str,
+               N: int = 10,
+               block_size: int = DEFAULT_BLOCK_SIZE,
+               compress: bool = False,
+               user_nums: Optional[np.ndarray] = None,
+               item_mask: Optional[np.ndarray] = None) -> int:
+        """
+        Saves recommendations as .csv with user_id, event_id and rating columns. The rows are written block by block
+        as they are calculated (see iter_recommendation_rows).
+
+        :param filename: target .csv full filename without the suffix
+        :param N: number of recommended items per user
+        :param block_size: number of users scored and written at once
+        :param compress: if True, the file is compressed with gzip and saved as .csv.gz
+        :param user_nums: numbers of the saved users, all users if None
+        :param item_mask: a boolean array, False for the items that cannot be recommended to these users
+        :return: the number of saved recommendations
+        """
+        logger.info('saving recommendations', extra={'fields': {'file_name': filename, 'format': 'csv'}})
+        num_of_rows = 0
+        with self._open_output(filename, '.csv', compress) as file:
             writer = csv.writer(file, delimiter=';')
             writer.writerow(['user_id', 'event_id', 'rating'])
-            writer.writerows(self.recommendations)
+            for user_ids, item_ids, scores in self.iter_recommendation_rows(N, block_size, user_nums, item_mask):
+                writer.writerows(zip(user_ids.tolist(), item_ids.tolist(), scores.tolist()))
+                num_of_rows += len(user_ids)
+        return num_of_rows
 
-    def to_json(self, filename) -> None:
+    def to_json(self,
+                filename: str,
+                N: int = 10,
+                block_size: int = DEFAULT_BLOCK_SIZE,
+                compress: bool = False,
+                user_nums: Optional[np.ndarray] = None,
+                item_mask: Optional[np.ndarray] = None) -> int:
         """
-        Saves recommendation dataframe as .json with following format:
+        Saves recommendations as .json with following format:
             {   user_id: {
                     event_1: score_1,
                     event_2: score_2,
@@ -137,28 +584,108 @@ class UserItemRecommender(ABC):
                 },
                 ....
             }
+        The object of every user is written as soon as its block is calculated (see iter_recommendation_rows), so the
+        whole dictionary is never built in memory.
 
-        :param filename: target .json full filename
-        :return: None
+        :param filename: target .json full filename without the suffix
+        :param N: number of recommended items per user
+        :param block_size: number of users scored and written at once
+        :param compress: if True, the file is compressed with gzip and saved as .json.gz
+        :param user_nums: numbers of the saved users, all users if None
+        :param item_mask: a boolean array, False for the items that cannot be recommended to these users
+        :return: the number of saved recommendations
         """
-        recommendation_dict = dict()
-        if self.recommendations is None:
-            self.get_all_recommendation(as_pd_dataframe=False)
-        if len(self.recommendations) != 0:
-            current_user_num = self.recommendations[0][0]
-            user_rec_dict = dict()
-            for row in self.recommendations:
-                if row[0] != current_user_num:
-                    recommendation_dict[current_user_num] = user_rec_dict
-                    user_rec_dict = dict()
-                    current_user_num = row[0]
-                else:
-                    user_rec_dict[row[1]] = round(float(row[2]), 3)
-            with open(f'{filename}.json', 'w') as json_file:
-                json.dump(recommendation_dict, json_file)
-        else:
-            print(f'{filename}: empty list of recommendations for this region.')
+        logger.info('saving recommendations', extra={'fields': {'file_name': filename, 'format': 'json'}})
+        num_of_users, num_of_rows = 0, 0
+        with self._open_output(filename, '.json', compress) as json_file:
+            json_file.write('{')
+            for user_ids, item_ids, scores in self.iter_recommendation_rows(N, block_size, user_nums, item_mask):
+                # every user of the block has already seen every allowed item
+                if len(user_ids) == 0:
+                    continue
+                num_of_rows += len(user_ids)
+                # rows of a user are contiguous, so users start where the user id changes
+                starts = np.flatnonzero(np.r_[True, user_ids[1:] != user_ids[:-1]])
+                stops = np.r_[starts[1:], len(user_ids)]
+                scores = np.round(scores.astype(float), 3)
+                for start, stop in zip(starts.tolist(), stops.tolist()):
+                    user_rec_dict = dict(zip(item_ids[start:stop].tolist(), scores[start:stop].tolist()))
+                    json_file.write(f'{", " if num_of_users else ""}'
+                                    f'{json.dumps(str(user_ids[start]))}: {json.dumps(user_rec_dict)}')
+                    num_of_users += 1
+            json_file.write('}')
+        if num_of_users == 0:
+            logger.warning(f'{filename}: empty list of recommendations for this region.')
+        return num_of_rows
 
+    def to_binary(self,
+                  filename: str,
+                  N: int = 10,
+                  block_size: int = DEFAULT_BLOCK_SIZE,
+                  score_dtype: str = 'float16',
+                  user_nums: Optional[np.ndarray] = None,
+                  item_mask: Optional[np.ndarray] = None) -> int:
+        """
+        Saves recommendations into the filename directory in the binary format of recommenders.binary_format: fixed
+        width item ids and scores with a sorted user id index, read by binary_format.RecommendationReader without
+        parsing the whole file.
+
+        :param filename: target directory name
+        :param N: number of recommended items per user
+        :param block_size: number of users scored and written at once
+        :param score_dtype: 'float16' or 'float32'
+        :param user_nums: numbers of the saved users, all users if None
+        :param item_mask: a boolean array, False for the items that cannot be recommended to these users
+        :return: the number of saved recommendations
+        """
+        logger.info('saving recommendations', extra={'fields': {'file_name': filename, 'format': 'binary'}})
+        item_id_dtype = get_item_id_dtype(self.item_encoder.ids)
+        num_of_users, num_of_rows = write_binary_recommendations(
+            filename,
+            self.iter_recommendation_rows(N, block_size, user_nums, item_mask),
+            item_id_dtype=item_id_dtype,
+            score_dtype=score_dtype
+        )
+        if num_of_users == 0:
+            logger.warning(f'{filename}: empty list of recommendations for this region.')
+        return num_of_rows
+
+    def to_similar_items(self,
+                         filename: str,
+                         K: int = 10,
+                         block_size: int = DEFAULT_BLOCK_SIZE,
+                         score_dtype: str = 'float16',
+                         item_mask: Optional[np.ndarray] = None) -> int:
+        """
+        Saves the K most similar items of every item into the filename directory in the binary format of
+        recommenders.binary_format, keyed by the item id: binary_format.RecommendationReader(filename)
+        .get_user_recommendation(str(item_id)) returns the (similar item id, similarity) list of the item.
+
+        :param filename: target directory name
+        :param K: number of similar items per item
+        :param block_size: number of items compared and written at once
+        :param score_dtype: 'float16' or 'float32'
+        :param item_mask: a boolean array, False for the items that are neither saved nor returned as similar ones
+        :return: the number of saved similar items
+        """
+        logger.info('saving similar items', extra={'fields': {'file_name': filename, 'format': 'binary'}})
+
+        def iter_rows() -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+            for item_nums, similar_items, similarities in self.iter_similar_item_blocks(K, block_size, item_mask):
+                found = similar_items.ravel() >= 0
+                yield (self.item_encoder.decode(np.repeat(item_nums, K)[found]),
+                       self.item_encoder.decode(similar_items.ravel()[found]),
+                       similarities.ravel()[found])
+
+        num_of_items, num_of_rows = write_binary_recommendations(
+            filename,
+            iter_rows(),
+            item_id_dtype=get_item_id_dtype(self.item_encoder.ids),
+            score_dtype=score_dtype
+        )
+        if num_of_items == 0:
+            logger.warning(f'{filename}: empty list of similar items for this region.')
+        return num_of_rows
 
 
 class ALSRecommender(UserItemRecommender):
@@ -183,18 +710,144 @@ class ALSRecommender(UserItemRecommender):
         self.K1 = K1
         self.B = B
 
-    def fit(self, user_item_df: pd.DataFrame, extra_item_ids: Optional[List[int]] = None, show_progress: bool = False,
-            *args, **kwargs) -> None:
-        super().fit(user_item_df, extra_item_ids, show_progress, args, kwargs)
-        self.model = AlternatingLeastSquares(
+    def _build_model(self) -> AlternatingLeastSquares:
+        return AlternatingLeastSquares(
             factors=self.factors,
             regularization=self.regularization,
             iterations=self.iterations,
             num_threads=self.num_of_threads)
+
+    def _get_confidence(self) -> sparse.csr_matrix:
         if self.confidence == 'alpha' or self.confidence is None:
-            self.model.fit((self.sparse_item_user * self.alpha_value).astype('double'), show_progress=show_progress)
+            # sparse_item_user is a new matrix, so it is scaled in place
+            confidence = self.sparse_item_user
+            confidence.data *= self.alpha_value
+            return confidence
         elif self.confidence == 'bm25':
-            self.model.fit(bm25_weight(self.sparse_item_user, K1=self.K1, B=self.B), show_progress=show_progress)
+            return bm25_weight(self.sparse_item_user, K1=self.K1, B=self.B).tocsr()
+        else:
+            raise ValueError(f'Incorrect value of "confidence" parameter: {self.confidence}')
+
+    def fit(self, user_item_df: pd.DataFrame, extra_item_ids: Optional[List[int]] = None, show_progress: bool = False,
+            *args, **kwargs) -> None:
+        super().fit(user_item_df, extra_item_ids, show_progress, args, kwargs)
+        self._fit_model(show_progress)
+
+    def _fit_model(self, show_progress: bool = False) -> None:
+        self.model = self._build_model()
+        self.model.fit(self._get_confidence(), show_progress=show_progress)
+
+    def refit(self,
+              user_item_df: pd.DataFrame,
+              extra_item_ids: Optional[List[int]] = None,
+              iterations: int = 2,
+              full_refit_threshold: float = 0.2,
+              show_progress: bool = False) -> bool:
+        """
+        Updates the fitted model with new interactions: the factors of unchanged users and items are reused and only
+        the rows of users and items whose interactions changed (or which are new) are recomputed by a few alternating
+        least squares solves with the other side fixed. The model is trained from scratch if it was not fitted yet or
+        if the item catalogue changed too much.
+
+        :param user_item_df: a full (not delta) pandas Dataframe with the same columns as for the fit method
+        :param extra_item_ids: a list of extra item ids to filter out from the output
+        :param iterations: number of alternating solves for the changed rows
+        :param full_refit_threshold: the maximum share of added and removed items for which the warm start is used
+        :return: True if the warm start was used, False if the model was trained from scratch
+        """
+        if self.model is None or self.model.user_factors is None:
+            self.fit(user_item_df, extra_item_ids, show_progress)
+            return False
+
+        old_user_ids = self.user_encoder.ids
+        old_item_ids = self.item_encoder.ids
+        old_ratings = self.sparse_user_item.tocoo()
+        old_ratings = pd.DataFrame({
+            'user_id': old_user_ids[old_ratings.row],
+            'item_id': old_item_ids[old_ratings.col],
+            'old_rating': old_ratings.data
+        })
+        old_user_factors = self.model.user_factors
+        old_item_factors = self.model.item_factors
+
+        super().fit(user_item_df, extra_item_ids)
+        user_ids = self.user_encoder.ids
+        item_ids = self.item_encoder.ids
+        user_positions = pd.Index(old_user_ids).get_indexer(user_ids)
+        item_positions = pd.Index(old_item_ids).get_indexer(item_ids)
+
+        removed_items = len(old_item_ids) - np.count_nonzero(item_positions >= 0)
+        added_items = np.count_nonzero(item_positions < 0)
+        if (removed_items + added_items) / max(len(old_item_ids) + added_items, 1) > full_refit_threshold:
+            self._fit_model(show_progress)
+            return False
+
+        new_ratings = self.sparse_user_item.tocoo()
+        new_ratings = pd.DataFrame({
+            'user_id': user_ids[new_ratings.row],
+            'item_id': item_ids[new_ratings.col],
+            'rating': new_ratings.data
+        })
+        ratings = old_ratings.merge(new_ratings, on=['user_id', 'item_id'], how='outer')
+        ratings = ratings.loc[ratings['old_rating'] != ratings['rating']]
+        changed_users = np.union1d(
+            pd.Index(user_ids).get_indexer(ratings['user_id'].unique()),
+            np.flatnonzero(user_positions < 0)
+        )
+        changed_items = np.union1d(
+            pd.Index(item_ids).get_indexer(ratings['item_id'].unique()),
+            np.flatnonzero(item_positions < 0)
+        )
+        changed_users = changed_users[changed_users >= 0]
+        changed_items = changed_items[changed_items >= 0]
+
+        user_factors = self._align_factors(old_user_factors, user_positions)
+        item_factors = self._align_factors(old_item_factors, item_positions)
+        confidence_item_user = self._get_confidence()
+        confidence_user_item = confidence_item_user.T.tocsr()
+        for _ in range(iterations):
+            self._least_squares(confidence_user_item, user_factors, item_factors, changed_users)
+            self._least_squares(confidence_item_user, item_factors, user_factors, changed_items)
+
+        self.model.user_factors = user_factors
+        self.model.item_factors = item_factors
+        # cached values derived from the old factors
+        for attribute in '_YtY', '_XtX', '_user_norms', '_item_norms':
+            if hasattr(self.model, attribute):
+                setattr(self.model, attribute, None)
+        return True
+
+    @staticmethod
+    def _align_factors(old_factors: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        factors = np.zeros((len(positions), old_factors.shape[1]), dtype=old_factors.dtype)
+        known = positions >= 0
+        factors[known] = old_factors[positions[known]]
+        return factors
+
+    def _least_squares(self,
+                       confidence: sparse.csr_matrix,
+                       factors: np.ndarray,
+                       fixed_factors: np.ndarray,
+                       rows: np.ndarray,
+                       block_size: int = 256) -> None:
+        """
+        Solves (YtY + Yt(Cu - I)Y + regularization * I) xu = YtCu pu for the passed rows of the factors matrix, the
+        same equations as implicit.als solves for every row during training.
+        """
+        num_of_factors = fixed_factors.shape[1]
+        YtY = fixed_factors.T.dot(fixed_factors) + self.regularization * np.eye(num_of_factors)
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            block_confidence = confidence[block].tocoo()
+            Y = fixed_factors[block_confidence.col].astype(np.float64)
+            row_sum = sparse.csr_matrix(
+                (np.ones(block_confidence.nnz), (block_confidence.row, np.arange(block_confidence.nnz))),
+                shape=(len(block), block_confidence.nnz)
+            )
+            outer = ((block_confidence.data - 1)[:, None, None] * Y[:, :, None] * Y[:, None, :])
+            A = YtY + (row_sum @ outer.reshape(block_confidence.nnz, -1)).reshape(-1, num_of_factors, num_of_factors)
+            b = row_sum @ (block_confidence.data[:, None] * Y)
+            factors[block] = np.linalg.solve(A, b[..., None])[..., 0]
 
 
 class BPRRecommender(UserItemRecommender):
@@ -216,10 +869,16 @@ class BPRRecommender(UserItemRecommender):
     def fit(self, user_item_df: pd.DataFrame, extra_item_ids: Optional[List[int]] = None, show_progress: bool = True,
             *args, **kwargs) -> None:
         super().fit(user_item_df, extra_item_ids, show_progress, args, kwargs)
-        self.model = BayesianPersonalizedRanking(
+        self._fit_model(show_progress)
+
+    def _fit_model(self, show_progress: bool = True) -> None:
+        self.model = self._build_model()
+        self.model.fit(self.sparse_item_user, show_progress=show_progress)
+
+    def _build_model(self) -> BayesianPersonalizedRanking:
+        return BayesianPersonalizedRanking(
             factors=self.factors,
             learning_rate=self.learning_rate,
             regularization=self.regularization,
             iterations=self.iterations,
             num_threads=self.num_of_threads)
-        self.model.fit(self.sparse_item_user, show_progress=show_progress)
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+from typing import List, Optional, Sequence, Tuple
+
+ALL_AGES = -1
+ALL_CATEGORIES = ''
+DEFAULT_AGE_BINS = (0, 18, 25, 35, 45, 55, 65, 150)
+POPULARITY_COLUMNS = ['region_code', 'age_from', 'age_to', 'category', 'rank', 'event_id', 'clicks_count']
+
+
+def compute_popularity_table(
+        user_event_df: pd.DataFrame,
+        user_df: pd.DataFrame,
+        events_df: pd.DataFrame,
+        N: int = 100,
+        age_bins: Optional[Sequence[int]] = None,
+        by_category: bool = False
+) -> pd.DataFrame:
+    """
+    Finds the N most clicked events of every region among the clicks of the users of the same region, optionally
+    per age bucket of the users and per category of the events as well.
+
+    :param age_bins: edges of the age buckets [age_from, age_to), e.g. DEFAULT_AGE_BINS; no age split if None
+    :param by_category: split the events by their categories too
+    :return: a pandas Dataframe with POPULARITY_COLUMNS, a row per event of a list; the lists of all ages have
+     age_from = age_to = ALL_AGES and the lists of all categories have category = ALL_CATEGORIES
+    """
+    users = user_df.loc[:, ['user_id', 'region_code', 'age']].dropna(subset=['region_code']).drop_duplicates('user_id')
+    event_columns = ['event_id', 'region_code', 'category'] if by_category else ['event_id', 'region_code']
+    events = events_df.loc[:, event_columns].dropna(subset=['region_code']).drop_duplicates('event_id')
+
+    clicks = user_event_df.loc[:, ['user_id', 'event_id', 'clicks_count']]
+    clicks = clicks.merge(users.rename(columns={'region_code': 'user_region'}), on='user_id')
+    clicks = clicks.merge(events, on='event_id')
+    clicks = clicks.loc[clicks['user_region'] == clicks['region_code']].astype({'region_code': int})
+
+    groupings = [[]]
+    if age_bins is not None:
+        bins = np.asarray(age_bins)
+        buckets = np.searchsorted(bins, clicks['age'].to_numpy(dtype=float), side='right') - 1
+        in_bins = (buckets >= 0) & (buckets < len(bins) - 1)
+        buckets = np.clip(buckets, 0, len(bins) - 2)
+        clicks = clicks.assign(age_from=np.where(in_bins, bins[buckets], ALL_AGES),
+                               age_to=np.where(in_bins, bins[buckets + 1], ALL_AGES))
+        groupings.append(['age_from', 'age_to'])
+    if by_category:
+        groupings.extend([[*grouping, 'category'] for grouping in groupings])
+
+    tables = list()
+    for grouping in groupings:
+        keys = ['region_code', *grouping]
+        selected = clicks.loc[clicks['age_from'] != ALL_AGES] if 'age_from' in grouping else clicks
+        counts = selected.groupby([*keys, 'event_id'])['clicks_count'].sum().reset_index()
+        counts = counts.sort_values([*keys, 'clicks_count', 'event_id'], ascending=[True] * len(keys) + [False, True])
+        counts['rank'] = counts.groupby(keys).cumcount()
+        counts = counts.loc[counts['rank'] < N]
+        for column, value in ('age_from', ALL_AGES), ('age_to', ALL_AGES), ('category', ALL_CATEGORIES):
+            if column not in grouping:
+                counts[column] = value
+        tables.append(counts.loc[:, POPULARITY_COLUMNS])
+    return pd.concat(tables, ignore_index=True)
+
+
+class PopularityTable:
+    """
+    Serves the lists of compute_popularity_table, e.g. to users unknown to the regional models. The lists are
+    grouped into a dictionary once, so a lookup does not depend on the size of the table.
+    """
+
+    def __init__(self, table: pd.DataFrame):
+        table = table.fillna({'category': ALL_CATEGORIES}).sort_values('rank', kind='stable')
+        self.items = dict()
+        self.age_buckets = dict()
+        for (region, age_from, age_to, category), items in table.groupby(
+                ['region_code', 'age_from', 'age_to', 'category'], sort=False):
+            key = (int(region), int(age_from), int(age_to), str(category))
+            self.items[key] = list(zip(items['event_id'].tolist(), items['clicks_count'].astype(float).tolist()))
+            if age_from != ALL_AGES:
+                self.age_buckets.setdefault(int(region), set()).add((int(age_from), int(age_to)))
+
+    def __contains__(self, region: int) -> bool:
+        return (region, ALL_AGES, ALL_AGES, ALL_CATEGORIES) in self.items
+
+    def _get_age_bucket(self, region: int, age: Optional[int]) -> Tuple[int, int]:
+        if age is not None:
+            for age_from, age_to in self.age_buckets.get(region, ()):
+                if age_from <= age < age_to:
+                    return age_from, age_to
+        return ALL_AGES, ALL_AGES
+
+    def get_popular_items(self,
+                          region: int,
+                          age: Optional[int] = None,
+                          category: Optional[str] = None,
+                          N: int = 10) -> List[Tuple[int, float]]:
+        """
+        Returns the most specific list available: of the age bucket and category, of the age bucket, of the
+        category or of the whole region.
+
+        :param region: a region code
+        :param age: an age of the user, lists of all ages are used if None
+        :param category: a category of the events, lists of all categories are used if None
+        :param N: number of events
+        :return: a list of (event id, number of clicks) sorted by descending number of clicks
+        :raises KeyError: if there are no clicks in the region
+        """
+        age_bucket = self._get_age_bucket(region, age)
+        category = ALL_CATEGORIES if category is None else category
+        keys = [
+            (region, *age_bucket, category),
+            (region, *age_bucket, ALL_CATEGORIES),
+            (region, ALL_AGES, ALL_AGES, category),
+            (region, ALL_AGES, ALL_AGES, ALL_CATEGORIES)
+        ]
+        for key in keys:
+            if key in self.items:
+                return self.items[key][:N]
+        raise KeyError(region)
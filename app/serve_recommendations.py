@@ -0,0 +1,91 @@
+import argparse
+from pathlib import Path
+from http.server import ThreadingHTTPServer
+
+from pipeline import storage
+from recommenders.implicit_models import UserItemRecommender
+from recommenders.popularity import PopularityTable
+from serving.service import RecommendationService, make_request_handler
+
+parser = argparse.ArgumentParser(
+    prog='serve_recommendations',
+    description='Run an HTTP service answering recommendation requests from the saved regional models.'
+)
+
+parser.add_argument(
+    'models_directory',
+    type=str,
+    help='a directory with the models saved by make_recommendations.py -models_directory.'
+)
+
+parser.add_argument(
+    '-host',
+    type=str,
+    default='0.0.0.0',
+    help='a host name the service listens on.',
+    action='store'
+)
+
+parser.add_argument(
+    '-port',
+    type=int,
+    default=8080,
+    help='a port the service listens on.',
+    action='store'
+)
+
+parser.add_argument(
+    '-cache_size',
+    type=int,
+    default=10000,
+    help='a number of recommendation lists kept in the LRU cache.',
+    action='store'
+)
+
+parser.add_argument(
+    '-similar_items',
+    type=int,
+    default=10,
+    help='a number of the most similar events precomputed for every event when the models are loaded, the maximum '
+         'n of /similar requests; 0 disables /similar.',
+    action='store'
+)
+
+parser.add_argument(
+    '-popularity_file',
+    type=str,
+    help='a table saved by create_user_item_dfs.py -popularity_file; the users unknown to the regional models get '
+         'the most clicked events of their region from it.',
+    action='store'
+)
+
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    print('INFO: loading models ...')
+    if not Path(args.models_directory).is_dir():
+        raise OSError(f'Directory {args.models_directory} does not exist.')
+
+    recommenders = dict()
+    for path in sorted(Path(args.models_directory).iterdir()):
+        region_pair = storage.parse_partition_name(str(path))
+        if path.is_dir() and region_pair is not None and region_pair[0] == region_pair[1]:
+            recommender = UserItemRecommender.load(str(path), mmap_mode='r')
+            if args.similar_items > 0:
+                # built before serving, so the handler threads only read the table
+                recommender.build_similar_items(K=args.similar_items)
+            recommenders[region_pair[0]] = recommender
+
+    popularity = None
+    if args.popularity_file is not None:
+        if not Path(args.popularity_file).is_file():
+            raise OSError(f'File {args.popularity_file} was not found.')
+        popularity = PopularityTable(storage.read_table(args.popularity_file))
+
+    service = RecommendationService(recommenders, cache_size=args.cache_size, popularity=popularity)
+    server = ThreadingHTTPServer((args.host, args.port), make_request_handler(service))
+    print(f'INFO: serving {len(recommenders)} regions on {args.host}:{args.port} ...')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
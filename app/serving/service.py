@@ -0,0 +1,236 @@
+import json
+import time
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler
+from typing import Dict, List, Tuple, Optional, Any, Hashable
+from urllib.parse import urlparse, parse_qs
+
+LATENCY_BUCKETS_MS = (0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0)
+
+
+class LRUCache:
+    """
+    A thread-safe mapping of a fixed size, the least recently used entry is evicted first.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class LatencyHistogram:
+    """
+    A thread-safe cumulative histogram of request latencies in milliseconds.
+    """
+
+    def __init__(self, buckets_ms: Tuple[float, ...] = LATENCY_BUCKETS_MS):
+        self.buckets_ms = tuple(sorted(buckets_ms))
+        self.counts = [0] * (len(self.buckets_ms) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, latency_ms: float) -> None:
+        with self._lock:
+            index = len(self.buckets_ms)
+            for bucket_index, bucket_ms in enumerate(self.buckets_ms):
+                if latency_ms <= bucket_ms:
+                    index = bucket_index
+                    break
+            self.counts[index] += 1
+            self.count += 1
+            self.sum_ms += latency_ms
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            cumulative, buckets = 0, dict()
+            for bucket_ms, count in zip(self.buckets_ms + (float('inf'),), self.counts):
+                cumulative += count
+                buckets[str(bucket_ms)] = cumulative
+            return {'buckets_ms': buckets, 'count': self.count, 'sum_ms': round(self.sum_ms, 3)}
+
+
+class RecommendationService:
+    """
+    Answers recommendation requests from in-memory recommenders, one per region, and caches the answers.
+    """
+
+    def __init__(self, recommenders: Dict[int, Any], cache_size: int = 10000, popularity: Optional[Any] = None):
+        """
+        :param recommenders: a mapping of region codes to fitted (or loaded) UserItemRecommender objects
+        :param cache_size: number of cached recommendation lists
+        :param popularity: a recommenders.popularity.PopularityTable answering the requests of unknown users
+        """
+        self.recommenders = recommenders
+        self.popularity = popularity
+        self.cache = LRUCache(cache_size)
+        self.latency = dict()
+        self._latency_lock = threading.Lock()
+
+    def recommend(self, region: int, user_id: str, n: int = 10, age: Optional[int] = None) -> List[Tuple[Any, float]]:
+        """
+        :param age: an age of the user, used to choose the popular events for a user unknown to the region model
+        :return: a list of (item id, score) pairs; the popular events of the region with their numbers of clicks for
+         a user unknown to the region model if the popularity table was passed
+        :raise KeyError: if there is no model for the region or the user is unknown and there are no popular events
+        """
+        key = (region, user_id, n)
+        recommendations = self.cache.get(key)
+        if recommendations is None:
+            recommender = self.recommenders.get(region)
+            if recommender is None or user_id not in recommender.user_encoder:
+                # the popular events are looked up in a dictionary, so they are not cached
+                if self.popularity is not None and region in self.popularity:
+                    return self.popularity.get_popular_items(region, age=age, N=n)
+                if recommender is None:
+                    raise KeyError(f'Unknown region: {region}')
+                raise KeyError(f'Unknown user: {user_id}')
+            recommendations = [
+                (item_id.item() if isinstance(item_id, np.generic) else item_id, float(score))
+                for _, item_id, score in recommender.get_user_recommendation(user_id, N=n, as_pd_dataframe=False)
+            ]
+            self.cache.put(key, recommendations)
+        return recommendations
+
+    def similar_items(self, region: int, item_id: Any, n: int = 10) -> List[Tuple[Any, float]]:
+        """
+        :return: a list of (item id, similarity) pairs from the similar items table of the region model, built when
+         the model was loaded (see UserItemRecommender.build_similar_items)
+        :raise KeyError: if there is no model for the region or the item is unknown
+        :raise ValueError: if the table of the region was not built or n is greater than its K
+        """
+        key = ('similar', region, item_id, n)
+        similar_items = self.cache.get(key)
+        if similar_items is None:
+            if region not in self.recommenders:
+                raise KeyError(f'Unknown region: {region}')
+            recommender = self.recommenders[region]
+            if item_id not in recommender.item_encoder:
+                raise KeyError(f'Unknown item: {item_id}')
+            similar_items = recommender.get_similar_items(item_id, N=n)
+            self.cache.put(key, similar_items)
+        return similar_items
+
+    def observe_latency(self, endpoint: str, latency_ms: float) -> None:
+        with self._latency_lock:
+            if endpoint not in self.latency:
+                self.latency[endpoint] = LatencyHistogram()
+        self.latency[endpoint].observe(latency_ms)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            'latency': {endpoint: histogram.to_dict() for endpoint, histogram in self.latency.items()},
+            'cache': {'size': len(self.cache), 'hits': self.cache.hits, 'misses': self.cache.misses},
+            'regions': sorted(self.recommenders)
+        }
+
+
+def make_request_handler(service: RecommendationService) -> type:
+    """
+    Creates a handler class for http.server with the following endpoints:
+        - GET /recommend?user_id=<user id>&region=<region code>&n=<number of items>&age=<optional user age>
+        - GET /similar?item_id=<integer item id>&region=<region code>&n=<number of items>
+        - GET /metrics: latency histograms and cache statistics
+        - GET /health
+    """
+
+    class RecommendationRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            start = time.perf_counter()
+            url = urlparse(self.path)
+            if url.path == '/recommend':
+                status, body = self._recommend(parse_qs(url.query))
+            elif url.path == '/similar':
+                status, body = self._similar(parse_qs(url.query))
+            elif url.path == '/metrics':
+                status, body = 200, service.get_metrics()
+            elif url.path == '/health':
+                status, body = 200, {'status': 'ok'}
+            else:
+                status, body = 404, {'error': f'Unknown endpoint: {url.path}'}
+            self._send_json(status, body)
+            service.observe_latency(url.path, (time.perf_counter() - start) * 1000)
+
+        @staticmethod
+        def _recommend(query: Dict[str, List[str]]) -> Tuple[int, Dict[str, Any]]:
+            try:
+                user_id = query['user_id'][0]
+                region = int(query['region'][0])
+                n = int(query.get('n', ['10'])[0])
+                age = int(query['age'][0]) if 'age' in query else None
+            except (KeyError, ValueError):
+                return 400, {'error': 'user_id and integer region parameters are required, n and age must be integers'}
+            if n <= 0:
+                return 400, {'error': 'n must be positive'}
+            try:
+                recommendations = service.recommend(region, user_id, n, age)
+            except KeyError as error:
+                return 404, {'error': str(error.args[0])}
+            return 200, {
+                'user_id': user_id,
+                'region': region,
+                'items': [{'item_id': item_id, 'score': round(score, 3)} for item_id, score in recommendations]
+            }
+
+        @staticmethod
+        def _similar(query: Dict[str, List[str]]) -> Tuple[int, Dict[str, Any]]:
+            try:
+                item_id = int(query['item_id'][0])
+                region = int(query['region'][0])
+                n = int(query.get('n', ['10'])[0])
+            except (KeyError, ValueError):
+                return 400, {'error': 'integer item_id and region parameters are required, n must be an integer'}
+            if n <= 0:
+                return 400, {'error': 'n must be positive'}
+            try:
+                similar_items = service.similar_items(region, item_id, n)
+            except KeyError as error:
+                return 404, {'error': str(error.args[0])}
+            except ValueError as error:
+                return 400, {'error': str(error)}
+            return 200, {
+                'item_id': item_id,
+                'region': region,
+                'items': [{'item_id': similar_item_id, 'score': round(score, 3)}
+                          for similar_item_id, score in similar_items]
+            }
+
+        def _send_json(self, status: int, body: Dict[str, Any]) -> None:
+            content = json.dumps(body, default=str).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    return RecommendationRequestHandler
@@ -28,3 +28,51 @@ def test_filtering_user_event_df(
         user_region_code=user_region_code,
         event_region_code=event_region_code
     ), pd.DataFrame)
+
+
+@pytest.mark.parametrize('same_region_only', [True, False])
+def test_partitioning_user_event_df(same_region_only: bool):
+    for (user_region_code, event_region_code), partition in flt.partition_user_event_df(
+            user_event_df,
+            user_df,
+            event_df,
+            same_region_only=same_region_only
+    ):
+        if same_region_only:
+            assert user_region_code == event_region_code
+        expected = flt.filter_user_event_df(
+            user_event_df,
+            user_df,
+            event_df,
+            user_region_code=user_region_code,
+            event_region_code=event_region_code
+        )
+        assert expected.reset_index(drop=True).equals(partition.reset_index(drop=True))
+
+
+@pytest.mark.parametrize('user_region, user_age, event_region', [
+    (77, None, 77),
+    (77, [18, 22], 77),
+    ([77, 50], 30, None),
+    (None, [18, 22], [77, 50])
+])
+def test_user_event_index(user_region, user_age, event_region):
+    index = flt.UserEventIndex(user_event_df, user_df, event_df)
+    expected = user_event_df
+    if user_region is not None:
+        expected = flt.filter_user_event_by_user_region(expected, user_df, user_region)
+    if user_age is not None:
+        expected = flt.filter_user_event_df_by_user_age(expected, user_df, user_age)
+    if event_region is not None:
+        expected = flt.filter_user_event_by_event_region(expected, event_df, event_region)
+    assert index.filter_user_event_df(user_region, user_age, event_region).equals(expected)
+
+
+@pytest.mark.parametrize('user_region, user_age_bucket', [(77, (18, 25)), (None, (0, 18)), ([77, 50], (25, 150))])
+def test_user_event_index_age_buckets(user_region, user_age_bucket):
+    index = flt.UserEventIndex(user_event_df, user_df, event_df, age_bins=(0, 18, 25, 150))
+    age_from, age_to = user_age_bucket
+    expected = flt.filter_user_event_df_by_user_age(user_event_df, user_df, [age_from, age_to - 1])
+    if user_region is not None:
+        expected = flt.filter_user_event_by_user_region(expected, user_df, user_region)
+    assert index.filter_user_event_df(user_region, user_age_bucket=user_age_bucket).equals(expected)
@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from pathlib import Path
+from app.evaluation import cross_validation as cv
+
+
+def test_ranking_metrics():
+    recommended_items = np.array([[3, 1, 2], [0, -1, -1], [5, 6, 7]])
+    relevant = sparse.csr_matrix(([1, 1, 1, 1], ([0, 0, 1, 2], [1, 2, 0, 9])), shape=(3, 10))
+    metrics = cv.ranking_metrics(recommended_items, relevant)
+
+    assert metrics['hit_rate'] == round(2 / 3, 4)
+    assert metrics['recall'] == round(2 / 3, 4)
+    ndcg = (1 / np.log2(3) + 1 / np.log2(4)) / (1 + 1 / np.log2(3))
+    assert metrics['ndcg'] == round((ndcg + 1) / 3, 4)
+    assert metrics['map'] == round(((1 / 2 + 2 / 3) / 2 + 1) / 3, 4)
+
+
+def test_leave_one_out_split():
+    user_item_df = pd.DataFrame({
+        'user_id': ['a', 'a', 'a', 'b', 'b', 'c'],
+        'item_id': [10, 11, 12, 10, 12, 11],
+        'rating': [1, 2, 1, 3, 1, 1],
+        'user_num': [0, 0, 0, 1, 1, 2],
+        'item_num': [0, 1, 2, 0, 2, 1]
+    })
+    train, held_out = cv.leave_one_out_split(user_item_df, min_interactions=2)
+
+    assert held_out['user_id'].tolist() == ['a', 'b']
+    assert len(train) + len(held_out) == len(user_item_df)
+    assert train.merge(held_out, on=['user_num', 'item_num']).empty
+
+
+def test_evaluate_leave_one_out_with_held_out_only_items():
+    from app.recommenders.implicit_models import ALSRecommender
+
+    # items 13 and 14 are clicked only by user c, so one of them is left only in the held-out part
+    user_item_df = pd.DataFrame({
+        'user_id': ['a', 'a', 'a', 'b', 'b', 'c', 'c'],
+        'item_id': [10, 11, 12, 10, 12, 13, 14],
+        'rating': [1, 2, 1, 3, 1, 1, 2],
+        'user_num': [0, 0, 0, 1, 1, 2, 2],
+        'item_num': [0, 1, 2, 0, 2, 3, 4]
+    })
+    recommender = ALSRecommender(confidence='alpha', alpha_value=15, iterations=3)
+    metrics = cv.evaluate_leave_one_out(recommender, user_item_df, K=2)
+    assert set(metrics) == {'hit_rate', 'recall', 'ndcg', 'map'}
+    assert recommender.item_encoder.ids.tolist() == [10, 11, 12, 13, 14]
+
+
+def test_parameter_search_resume(tmp_path):
+    from app.evaluation.search import ParameterSearch
+
+    random_state = np.random.RandomState(0)
+    user_event_df = pd.DataFrame({
+        'user_id': [f'user_{i}' for i in random_state.randint(0, 50, 400)],
+        'event_id': random_state.randint(0, 20, 400),
+        'clicks_count': random_state.randint(1, 5, 400)
+    }).drop_duplicates(['user_id', 'event_id'])
+    user_event_df.to_csv(tmp_path / 'user_1_event_1.csv', index=False)
+
+    search = ParameterSearch(
+        recommender_name='als',
+        parameter_space={'factors': [4, 8], 'confidence': ['alpha'], 'alpha_value': [15], 'iterations': [3]},
+        results_file=str(tmp_path / 'results.csv'),
+        strategy='grid'
+    )
+    best = search.run([str(tmp_path / 'user_1_event_1.csv')])
+    assert len(best) == 1
+    assert len(search.read_results()) == 2
+
+    search.run([str(tmp_path / 'user_1_event_1.csv')])
+    assert len(search.read_results()) == 2
+
+    # the rows of other settings are not comparable and are not reused
+    search.K = 5
+    search.run([str(tmp_path / 'user_1_event_1.csv')])
+    assert len(search.read_results()) == 4
+
+
+def test_time_split_evaluator(tmp_path):
+    from app.evaluation.time_split import TimeSplitEvaluator, summarize
+    from app.recommenders.implicit_models import ALSRecommender, BPRRecommender
+
+    random_state = np.random.RandomState(0)
+    clicks = pd.DataFrame({
+        'user_id': [f'user_{i}' for i in random_state.randint(0, 50, 500)],
+        'event_id': random_state.randint(0, 20, 500),
+        'clicks_count': random_state.randint(1, 5, 500)
+    }).drop_duplicates(['user_id', 'event_id'])
+    (tmp_path / 'train').mkdir()
+    (tmp_path / 'test').mkdir()
+    clicks.iloc[:300].to_csv(tmp_path / 'train' / 'user_1_event_1.csv', index=False)
+    clicks.iloc[300:].to_csv(tmp_path / 'test' / 'user_1_event_1.csv', index=False)
+
+    evaluator = TimeSplitEvaluator(str(tmp_path), K=5)
+    train, test = evaluator.get_region('user_1_event_1')
+    assert train.merge(test, on=['user_num', 'item_num']).empty
+
+    results = evaluator.evaluate_all({
+        'als': ALSRecommender(confidence='alpha', alpha_value=15, iterations=3),
+        'bpr': BPRRecommender(iterations=3)
+    })
+    assert results['recommender'].tolist() == ['als', 'bpr']
+    assert (results['num_of_users'] == test['user_num'].nunique()).all()
+    assert len(summarize(results)) == 2
+
+
+def test_split_clicks_by_time_replaces_previous_split(tmp_path):
+    from app.evaluation.time_split import split_clicks_by_time, TimeSplitEvaluator
+
+    pd.DataFrame({
+        'session_id': [1, 2, 1, 3, 2, 3],
+        'session_name': ['e1', 'e2', 'e1', 'e3', 'e2', 'e3'],
+        'session_identity': ['s'] * 6,
+        'create_time': ['2021-11-01', '2021-11-01', '2021-11-02', '2021-11-02', '2021-11-03', '2021-11-03'],
+        'user_id': ['a', 'a', 'b', 'c', 'b', 'c'],
+        'organization_id': [10, 20, 10, 30, 20, 30]
+    }).to_csv(tmp_path / 'clicks.csv', sep=';', index=False)
+    users_df = pd.DataFrame({'user_id': ['a', 'b', 'c'], 'region_code': [77, 77, 66], 'age': [20, 30, 40]})
+    events_df = pd.DataFrame({'event_id': [1, 2, 3], 'org_id': [10, 20, 30], 'region_code': [77, 77, 66]})
+    split_directory = tmp_path / 'split'
+
+    file_names = split_clicks_by_time(str(tmp_path / 'clicks.csv'), '2021-11-03', users_df, events_df,
+                                      str(split_directory))
+    assert sorted(Path(file_name).name for file_name in file_names) == [
+        'user_66_event_66.parquet', 'user_77_event_77.parquet'
+    ]
+    # user c has no clicks before the new cutoff, so the partition of region 66 must not be left from the old split
+    split_clicks_by_time(str(tmp_path / 'clicks.csv'), '2021-11-02', users_df, events_df, str(split_directory))
+    assert TimeSplitEvaluator(str(split_directory)).get_partitions() == ['user_77_event_77']
+    assert sorted(path.name for path in split_directory.iterdir()) == ['split.json', 'test', 'train']
@@ -0,0 +1,49 @@
+import os
+import json
+import logging
+import pytest
+from app.pipeline import instrumentation as instr
+
+
+@pytest.fixture
+def log_lines(tmp_path):
+    logger = instr.configure_logging(str(tmp_path / 'log.jsonl'))
+    yield lambda: [json.loads(line) for line in (tmp_path / 'log.jsonl').read_text().splitlines()]
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
+
+
+def test_stage_log_line(log_lines):
+    with instr.stage('fit', region=77) as metrics:
+        metrics['iterations'] = 10
+
+    with pytest.raises(ValueError):
+        with instr.stage('recommend', region=77):
+            raise ValueError
+
+    fit, recommend = log_lines()
+    assert fit['message'] == 'fit' and fit['status'] == 'ok' and fit['region'] == 77
+    assert {'wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'iterations_per_second'} <= set(fit)
+    assert recommend['status'] == 'failed' and recommend['level'] == logging.getLevelName(logging.ERROR)
+
+
+def test_tracemalloc_profile(log_lines):
+    with instr.profile('tracemalloc', top=3):
+        data = [list(range(100)) for _ in range(100)]
+    assert len(data) == 100
+
+    line, = log_lines()
+    assert line['mode'] == 'tracemalloc'
+    assert 1 <= len(line['top_allocations']) <= 3
+
+
+def test_worker_pool_restores_environment(monkeypatch):
+    from app.pipeline import parallel
+
+    monkeypatch.setenv('OMP_NUM_THREADS', '8')
+    monkeypatch.delenv('MKL_NUM_THREADS', raising=False)
+    with parallel.worker_pool(1) as executor:
+        assert executor.submit(os.getenv, 'OMP_NUM_THREADS').result() == '1'
+    assert os.environ['OMP_NUM_THREADS'] == '8'
+    assert 'MKL_NUM_THREADS' not in os.environ
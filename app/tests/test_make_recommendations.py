@@ -1,21 +1,38 @@
+import numpy as np
 import pandas as pd
 import pytest
 import json
+import subprocess
+import sys
+import scipy.sparse as sparse
 from pathlib import Path
 from app.pipeline import filtering as ftr
-from app.recommenders.implicit_models import ALSRecommender, BPRRecommender
+from app.recommenders.implicit_models import UserItemRecommender, ALSRecommender, BPRRecommender, build_user_item_matrix
+from app.recommenders.binary_format import RecommendationReader
+from app.recommenders.encoding import IdEncoder
+from app.recommenders.popularity import compute_popularity_table, PopularityTable, ALL_AGES
 
 
-@pytest.mark.parametrize('user_event_df_file_path', ['../../data/user_event_dfs/user_77_event_77.csv'])
-def test_als_recommender(user_event_df_file_path: str):
-    user_event_df = pd.read_csv(user_event_df_file_path)
+@pytest.fixture
+def user_event_df() -> pd.DataFrame:
+    """
+    A numerated user-item dataframe of a small synthetic region in the format of UserItemRecommender.fit.
+    """
+    random_state = np.random.RandomState(0)
+    user_event_df = pd.DataFrame({
+        'user_id': [f'user_{i}' for i in random_state.randint(0, 60, 600)],
+        'event_id': random_state.randint(0, 40, 600) + 1000,
+        'clicks_count': random_state.randint(1, 5, 600)
+    }).drop_duplicates(['user_id', 'event_id'])
     user_event_df = ftr.numerate_user_event_df(user_event_df)
-    user_event_df = user_event_df.rename(columns={
+    return user_event_df.rename(columns={
         'event_id': 'item_id',
         'event_num': 'item_num',
         'clicks_count': 'rating'
-    }
-    )
+    })
+
+
+def test_als_recommender(user_event_df: pd.DataFrame):
     recommender = ALSRecommender(
         confidence='alpha',
         alpha_value=15
@@ -24,16 +41,7 @@ def test_als_recommender(user_event_df_file_path: str):
     assert isinstance(recommender.get_all_recommendation(as_pd_dataframe=True), pd.DataFrame)
 
 
-@pytest.mark.parametrize('user_event_df_file_path', ['../../data/user_event_dfs/user_77_event_77.csv'])
-def test_bpr_recommender(user_event_df_file_path: str):
-    user_event_df = pd.read_csv(user_event_df_file_path)
-    user_event_df = ftr.numerate_user_event_df(user_event_df)
-    user_event_df = user_event_df.rename(columns={
-        'event_id': 'item_id',
-        'event_num': 'item_num',
-        'clicks_count': 'rating'
-    }
-    )
+def test_bpr_recommender(user_event_df: pd.DataFrame):
     recommender = BPRRecommender()
     recommender.fit(user_event_df)
     assert isinstance(recommender.get_all_recommendation(as_pd_dataframe=True), pd.DataFrame)
@@ -60,3 +68,326 @@ def test_recommendation_ids(user_df_filename: str, event_df_filename: str):
 
             assert len(user_ids.intersection(user_in_region_ids)) == len(user_in_region_ids)
             assert len(event_ids.intersection(event_in_region_ids)) == len(event_in_region_ids)
+
+
+@pytest.mark.parametrize('block_size', [1, 64, 4096])
+def test_batched_recommendation(user_event_df: pd.DataFrame, block_size: int):
+    recommender = ALSRecommender(
+        confidence='alpha',
+        alpha_value=15
+    )
+    recommender.fit(user_event_df)
+    expected = recommender.get_all_recommendation(as_pd_dataframe=True)
+    batched = recommender.get_all_recommendation(as_pd_dataframe=True, block_size=block_size)
+
+    key = ['user_id', 'item_id']
+    expected = expected.sort_values(key).reset_index(drop=True)
+    batched = batched.sort_values(key).reset_index(drop=True)
+    assert expected[key].equals(batched[key])
+    assert np.allclose(expected['rating'].astype(float), batched['rating'].astype(float), atol=1e-5)
+
+
+def test_als_warm_refit(user_event_df: pd.DataFrame):
+    recommender = ALSRecommender(
+        confidence='alpha',
+        alpha_value=15
+    )
+    recommender.fit(user_event_df)
+    user_factors = recommender.model.user_factors.copy()
+
+    assert recommender.refit(user_event_df)
+    assert np.array_equal(user_factors, recommender.model.user_factors)
+
+    user_event_df.loc[user_event_df.index[0], 'rating'] += 1
+    assert recommender.refit(user_event_df)
+    changed_user_num = user_event_df.iloc[0].user_num
+    assert not np.array_equal(user_factors[changed_user_num], recommender.model.user_factors[changed_user_num])
+    assert isinstance(recommender.get_all_recommendation(as_pd_dataframe=True), pd.DataFrame)
+
+
+@pytest.mark.parametrize('recommender_class, params', [
+    (ALSRecommender, {'confidence': 'alpha', 'alpha_value': 15}),
+    (BPRRecommender, {})
+])
+def test_save_and_load_recommender(tmp_path, user_event_df: pd.DataFrame, recommender_class, params: dict):
+    recommender = recommender_class(iterations=5, **params)
+    recommender.fit(user_event_df)
+    recommender.save(str(tmp_path))
+
+    loaded_recommender = UserItemRecommender.load(str(tmp_path))
+    assert isinstance(loaded_recommender, recommender_class)
+    assert isinstance(loaded_recommender.model.item_factors, np.memmap)
+    assert recommender.get_all_recommendation(as_pd_dataframe=True, block_size=256).equals(
+        loaded_recommender.get_all_recommendation(as_pd_dataframe=True, block_size=256)
+    )
+
+
+def test_ann_recommendation(user_event_df: pd.DataFrame):
+    recommender = ALSRecommender(
+        confidence='alpha',
+        alpha_value=15
+    )
+    recommender.fit(user_event_df)
+    user_nums = np.arange(recommender.model.user_factors.shape[0])
+    exact_items, _ = recommender.score_users(user_nums)
+
+    # scanning all clusters gives the exact top-N
+    recommender.build_ann_index(n_lists=4, n_probe=4)
+    ann_items, _ = recommender.score_users(user_nums)
+    assert np.array_equal(exact_items, ann_items)
+
+
+def test_streaming_writers(tmp_path, user_event_df: pd.DataFrame):
+    recommender = ALSRecommender(
+        confidence='alpha',
+        alpha_value=15
+    )
+    recommender.fit(user_event_df)
+    recommender.to_json(str(tmp_path / 'rec'), block_size=16)
+    recommender.to_csv(str(tmp_path / 'rec'), block_size=16, compress=True)
+    recommendation_df = recommender.get_all_recommendation(as_pd_dataframe=True, block_size=256)
+
+    with open(tmp_path / 'rec.json', 'r') as json_file:
+        data = json.load(json_file)
+    assert set(data.keys()) == set(map(str, recommendation_df['user_id'].unique()))
+    assert sum(map(len, data.values())) == len(recommendation_df)
+    assert len(pd.read_csv(tmp_path / 'rec.csv.gz', sep=';')) == len(recommendation_df)
+
+    # the cached recommendations of another N are not written
+    recommender.to_csv(str(tmp_path / 'rec_3'), N=3, block_size=16)
+    assert pd.read_csv(tmp_path / 'rec_3.csv', sep=';').groupby('user_id').size().max() == 3
+
+
+def test_binary_recommendation_file(tmp_path, user_event_df: pd.DataFrame):
+    recommender = ALSRecommender(
+        confidence='alpha',
+        alpha_value=15
+    )
+    recommender.fit(user_event_df)
+    recommender.to_binary(str(tmp_path / 'rec'), block_size=16, score_dtype='float32')
+    recommendation_df = recommender.get_all_recommendation(as_pd_dataframe=True, block_size=256)
+
+    reader = RecommendationReader(str(tmp_path / 'rec'))
+    assert len(reader) == recommendation_df['user_id'].nunique()
+    for user_id, user_df in recommendation_df.groupby('user_id', sort=False):
+        items, scores = zip(*reader.get_user_recommendation(user_id))
+        assert list(items) == user_df['item_id'].tolist()
+        assert np.allclose(scores, user_df['rating'])
+    assert 'unknown user' not in reader
+
+
+@pytest.mark.parametrize('ids', [[10, 30, 20], ['b', 'a', 'c'], pd.Categorical(['a', 'b', 'c']).categories])
+def test_id_encoder(ids):
+    encoder = IdEncoder(ids)
+    assert len(encoder) == 3
+    assert encoder.encode(list(ids)).tolist() == [0, 1, 2]
+    assert encoder.decode([2, 0]).tolist() == [ids[2], ids[0]]
+    assert encoder.get_num(ids[1]) == 1
+    assert ids[0] in encoder and 'unknown' not in encoder and -1 not in encoder
+    with pytest.raises(KeyError):
+        encoder.get_num('unknown')
+
+    user_item_df = pd.DataFrame({'id': pd.Categorical(np.asarray(ids)[[1, 0, 1]]), 'num': [1, 0, 1]})
+    encoder = IdEncoder.from_columns(user_item_df['id'], user_item_df['num'])
+    assert encoder.decode([0, 1]).tolist() == [ids[0], ids[1]]
+    with pytest.raises(ValueError):
+        IdEncoder.from_columns(pd.Series(np.asarray(ids)[[0, 2]]), pd.Series([0, 2]))
+
+
+def test_id_encoder_casts_ids():
+    encoder = IdEncoder([10, 30, 20])
+    assert encoder.encode(['30', '10', '15', 'unknown', '20.5']).tolist() == [1, 0, -1, -1, -1]
+    assert '20' in encoder and encoder.get_num('20') == 2
+    encoder = IdEncoder(['5', '7'])
+    assert encoder.encode([7, 5, 6]).tolist() == [1, 0, -1]
+
+
+@pytest.mark.parametrize('recommender_class, params', [
+    (ALSRecommender, {'confidence': 'alpha', 'alpha_value': 15, 'iterations': 3}),
+    (BPRRecommender, {'iterations': 3})
+])
+def test_fit_matrix(recommender_class, params: dict):
+    random_state = np.random.RandomState(0)
+    user_item_df = pd.DataFrame({
+        'user_num': random_state.randint(0, 30, 300),
+        'item_num': random_state.randint(0, 20, 300),
+        'rating': random_state.randint(1, 5, 300)
+    })
+    user_item_df = user_item_df.assign(
+        user_id=user_item_df['user_num'].map('u{}'.format),
+        item_id=user_item_df['item_num'] + 100
+    )
+    matrix = build_user_item_matrix(user_item_df['user_num'], user_item_df['item_num'], user_item_df['rating'])
+    assert matrix.dtype == np.float32
+    assert matrix.sum() == user_item_df['rating'].sum()
+
+    from_df = recommender_class(**params)
+    from_df.fit(user_item_df, show_progress=False)
+    from_matrix = recommender_class(**params)
+    user_ids = ['u{}'.format(num) for num in range(matrix.shape[0])]
+    from_matrix.fit_matrix(matrix, user_ids, np.arange(matrix.shape[1]) + 100)
+    # the confidence is scaled on a copy of the ratings
+    assert (from_matrix.sparse_user_item != matrix).nnz == 0
+    assert np.allclose(from_df.model.user_factors, from_matrix.model.user_factors)
+    assert from_df.get_user_recommendation('u3', as_pd_dataframe=False) == \
+           from_matrix.get_user_recommendation('u3', as_pd_dataframe=False)
+
+    with pytest.raises(ValueError):
+        from_matrix.fit_matrix(matrix, user_ids[1:])
+
+
+def test_region_item_mask():
+    random_state = np.random.RandomState(0)
+    item_regions = random_state.choice([50, 77], 20)
+    user_item_df = pd.DataFrame({
+        'user_num': random_state.randint(0, 30, 300),
+        'item_num': random_state.randint(0, 20, 300),
+        'rating': random_state.randint(1, 5, 300)
+    })
+    region_codes, region_item_mask = ftr.get_region_item_mask(
+        user_item_df['item_num'], item_regions[user_item_df['item_num']], 20
+    )
+    assert region_codes.tolist() == [50, 77]
+    item_mask = region_item_mask[1].toarray().ravel()
+    assert np.array_equal(np.flatnonzero(item_mask), np.intersect1d(np.flatnonzero(item_regions == 77),
+                                                                     user_item_df['item_num']))
+
+    recommender = ALSRecommender(confidence='alpha', alpha_value=15, iterations=3)
+    recommender.fit_matrix(build_user_item_matrix(user_item_df['user_num'], user_item_df['item_num'],
+                                                  user_item_df['rating']))
+    user_nums = np.arange(0, 30, 3)
+    items, scores = recommender.score_users(user_nums, N=5, item_mask=item_mask)
+    all_items, all_scores = recommender.score_users(user_nums, N=20)
+    for user_items, user_all_items in zip(items, all_items):
+        # the masked top items are the best items of the region the user has not seen yet
+        expected = [item for item in user_all_items if item >= 0 and item_mask[item]][:5]
+        assert user_items[user_items >= 0].tolist() == expected
+
+
+def test_similar_items(tmp_path):
+    random_state = np.random.RandomState(0)
+    user_item_df = pd.DataFrame({
+        'user_num': random_state.randint(0, 30, 300),
+        'item_num': random_state.randint(0, 20, 300),
+        'rating': random_state.randint(1, 5, 300)
+    })
+    recommender = ALSRecommender(confidence='alpha', alpha_value=15, iterations=3)
+    recommender.fit_matrix(build_user_item_matrix(user_item_df['user_num'], user_item_df['item_num'],
+                                                  user_item_df['rating']), item_ids=np.arange(20) + 100)
+    with pytest.raises(ValueError):
+        recommender.get_similar_items(103)
+    similar_items, similarities = recommender.build_similar_items(K=5, block_size=3)
+    assert similar_items.shape == similarities.shape == (20, 5)
+
+    item_factors = recommender.model.item_factors / np.linalg.norm(recommender.model.item_factors, axis=1)[:, None]
+    expected = item_factors.dot(item_factors.T)
+    np.fill_diagonal(expected, -np.inf)
+    assert np.array_equal(similar_items, np.argsort(-expected, axis=1, kind='stable')[:, :5])
+    assert np.allclose(similarities, -np.sort(-expected, axis=1)[:, :5], atol=1e-5)
+
+    items, scores = zip(*recommender.get_similar_items(103, N=3))
+    assert list(items) == (similar_items[3, :3] + 100).tolist()
+    with pytest.raises(KeyError):
+        recommender.get_similar_items(3, N=3)
+    with pytest.raises(ValueError):
+        recommender.get_similar_items(103, N=6)
+
+    num_of_rows = recommender.to_similar_items(str(tmp_path / 'similar'), K=5, score_dtype='float32')
+    reader = RecommendationReader(str(tmp_path / 'similar'))
+    assert num_of_rows == 100 and len(reader) == 20
+    items, scores = zip(*reader.get_user_recommendation(103))
+    assert list(items) == (similar_items[3] + 100).tolist()
+    assert np.allclose(scores, similarities[3])
+
+
+def test_popularity_table():
+    user_df = pd.DataFrame({'user_id': ['a', 'b', 'c', 'd'], 'region_code': [77, 77, 77, 50], 'age': [20, 20, 40, 20]})
+    events_df = pd.DataFrame({'event_id': [1, 2, 3, 4], 'region_code': [77, 77, 77, 50],
+                              'category': ['music', 'music', 'cinema', 'music']})
+    user_event_df = pd.DataFrame({
+        'user_id': ['a', 'a', 'b', 'c', 'c', 'd', 'd'],
+        'event_id': [1, 2, 2, 3, 1, 4, 1],
+        'clicks_count': [1, 1, 1, 5, 1, 2, 10]
+    })
+    table = compute_popularity_table(user_event_df, user_df, events_df, N=2, age_bins=(0, 30, 150), by_category=True)
+    region_table = table.loc[(table['region_code'] == 77) & (table['age_from'] == ALL_AGES) &
+                             (table['category'] == '')]
+    # the clicks of the users of other regions are not counted
+    assert region_table['event_id'].tolist() == [3, 1]
+    assert 4 not in table.loc[table['region_code'] == 77, 'event_id'].tolist()
+
+    popularity = PopularityTable(table)
+    assert 77 in popularity and 66 not in popularity
+    assert popularity.get_popular_items(77, N=3) == [(3, 5.0), (1, 2.0)]
+    assert popularity.get_popular_items(77, age=20) == [(2, 2.0), (1, 1.0)]
+    assert popularity.get_popular_items(77, age=20, category='music') == [(2, 2.0), (1, 1.0)]
+    assert popularity.get_popular_items(77, age=40, category='cinema') == [(3, 5.0)]
+    assert popularity.get_popular_items(77, age=200, category='music') == [(1, 2.0), (2, 2.0)]
+    with pytest.raises(KeyError):
+        popularity.get_popular_items(66)
+
+
+def test_past_events_filtering():
+    random_state = np.random.RandomState(0)
+    user_event_df = pd.DataFrame({
+        'user_id': random_state.randint(0, 30, 300).astype(str),
+        'event_id': random_state.randint(0, 20, 300) + 100,
+        'clicks_count': random_state.randint(1, 5, 300)
+    }).drop_duplicates(['user_id', 'event_id'])
+    future_events_df = pd.DataFrame({'ID': np.arange(110, 130)})
+    extra_item_ids = ftr.get_extra_events_ids(user_event_df, future_events_df)
+    assert extra_item_ids == list(range(100, 110))
+    pruned_df = ftr.filter_user_event_by_future_events(user_event_df, future_events_df)
+    assert set(pruned_df['event_id']) == set(range(110, 120))
+
+    user_item_df = ftr.numerate_user_event_df(user_event_df.copy()).rename(columns={
+        'event_id': 'item_id',
+        'event_num': 'item_num',
+        'clicks_count': 'rating'
+    })
+    recommender = ALSRecommender(confidence='alpha', alpha_value=15, iterations=3)
+    recommender.fit(user_item_df, extra_item_ids + [999])
+    assert recommender.extra_item_ids == list(range(10))
+    items, scores = recommender.score_users(np.arange(30), N=20)
+    assert np.all((items >= 10) | (items == -1))
+    assert recommender.get_extra_item_mask() is recommender.extra_item_mask
+
+    recommender.fit(user_item_df)
+    assert recommender.get_extra_item_mask() is None
+
+
+def test_json_writer_without_recommendations(tmp_path):
+    # every user has already seen every item, so there is nothing left to recommend
+    recommender = ALSRecommender(confidence='alpha', alpha_value=15, iterations=3)
+    recommender.fit_matrix(sparse.csr_matrix(np.ones((5, 4), dtype=np.float32)))
+    assert recommender.to_json(str(tmp_path / 'rec'), block_size=2) == 0
+    with open(tmp_path / 'rec.json') as file:
+        assert json.load(file) == dict()
+
+
+@pytest.mark.parametrize('options', [[], ['-prune_past_events'], ['-national'], ['-national', '-prune_past_events']])
+def test_past_only_region_cli(tmp_path, options: list):
+    random_state = np.random.RandomState(0)
+    user_event_dir = tmp_path / 'user_event_dfs'
+    output_dir = tmp_path / 'recommendations'
+    user_event_dir.mkdir()
+    output_dir.mkdir()
+    for region, first_event in (66, 100), (77, 200):
+        pd.DataFrame({
+            'user_id': [f'{region}_{user}' for user in random_state.randint(0, 20, 200)],
+            'event_id': random_state.randint(0, 10, 200) + first_event,
+            'clicks_count': random_state.randint(1, 5, 200)
+        }).drop_duplicates(['user_id', 'event_id']).to_csv(user_event_dir / f'user_{region}_event_{region}.csv',
+                                                           index=False)
+    # all events of the region 77 are over
+    pd.DataFrame({'ID': np.arange(100, 110)}).to_csv(tmp_path / 'future_events_df.csv', index=False)
+
+    app_dir = Path(__file__).resolve().parents[1]
+    subprocess.run([sys.executable, 'make_recommendations.py', 'als', str(user_event_dir), str(output_dir), 'json',
+                    '-future_events_df', str(tmp_path / 'future_events_df.csv'), *options], cwd=app_dir, check=True)
+
+    assert not (output_dir / 'user_77_event_77_rec.json').exists()
+    with open(output_dir / 'user_66_event_66_rec.json') as file:
+        recommendations = json.load(file)
+    assert len(recommendations) != 0
+    assert all(100 <= int(item_id) < 110 for items in recommendations.values() for item_id in items)
@@ -41,3 +41,203 @@ def test_get_event_dataframe(
             organization_file_path
         ), pd.DataFrame
     )
+
+
+@pytest.fixture
+def raw_user_files(tmp_path):
+    pd.DataFrame({
+        'user_id': ['a1', 'b2', 'c3', 'd4', 'b2'],
+        'user_birth': ['2003-11-16', '2000-01-01', '1999-11-15', '2004-02-29', '2001-06-30']
+    }).to_csv(tmp_path / 'users.txt', sep=';', index=False)
+    pd.DataFrame({
+        'user_id': ['a1', 'b2', 'c3', 'e5', 'a1'],
+        'region': ['г. Москва', 'Свердловская область', 'Неизвестный регион', 'г. Москва', 'Свердловская область']
+    }).to_csv(tmp_path / 'region.txt', sep=';', index=False)
+    pd.DataFrame({
+        'Наименование субъекта': ['г. Москва', 'Свердловская область'],
+        'Код ГИБДД': [77, 66]
+    }).to_csv(tmp_path / 'RegionRussia.csv', index=False)
+    return str(tmp_path / 'users.txt'), str(tmp_path / 'region.txt'), str(tmp_path / 'RegionRussia.csv')
+
+
+@pytest.fixture
+def raw_event_files(tmp_path):
+    pd.DataFrame({
+        'entity._id': [1, 2, 3, 4, 5],
+        'entity.name': ['e1', 'e2', 'e3', 'e4', 'e5'],
+        'entity.saleLink': ['l1', 'l2', 'l3', 'l4', 'l5'],
+        'entity.additionalSaleLinks.0': [None, None, 'a3', None, None],
+        'entity.organization._id': [10, 20, None, 30, 40],
+        'entity.organization.name': ['o1', 'o2', 'o3', 'o4', 'o5']
+    }).to_csv(tmp_path / 'events.csv', index=False)
+    pd.DataFrame({
+        'ID': [10, 20, 30, 20],
+        'Учреждение': ['o1', 'o2', 'o4', 'o2'],
+        'Адрес': ['г Москва, ул. Тверская, 1', 'Свердловская обл, г Екатеринбург', 'Неизвестно, 1',
+                  'Свердловская обл, г Нижний Тагил'],
+        'ИНН': [1, 2, 3, 2],
+        'Категория': ['Театр', 'Музей', 'Кино', 'Музей и галерея']
+    }).to_csv(tmp_path / 'organizations.csv', sep=';', index=False)
+    return str(tmp_path / 'events.csv'), str(tmp_path / 'organizations.csv')
+
+
+def test_vectorized_user_dataframe(raw_user_files):
+    user_file_path, regions_file_path, regions_nums_file_path = raw_user_files
+
+    users_age = pd.read_csv(user_file_path, sep=';')
+    users_age['user_age'] = users_age['user_birth'].apply(func=prs.get_user_age_in_years)
+    users_age_dict = dict(zip(users_age.user_id, users_age.user_age))
+    region_nums = pd.read_csv(regions_nums_file_path)
+    region_nums_dict = dict(zip(region_nums['Наименование субъекта'], region_nums['Код ГИБДД']))
+    expected = pd.read_csv(regions_file_path, sep=';')
+    expected['region_code'] = expected['region'].apply(func=prs.get_region_code_for_user,
+                                                       region_numbers=region_nums_dict)
+    expected['age'] = expected['user_id'].apply(func=prs.get_user_age, user_age=users_age_dict)
+    expected = expected.dropna(subset=['age'])
+
+    pd.testing.assert_frame_equal(
+        prs.get_user_dataframe(user_file_path, regions_file_path, regions_nums_file_path),
+        expected
+    )
+
+
+def test_vectorized_events_dataframe(raw_event_files):
+    event_file_path, organization_file_path = raw_event_files
+
+    organizations = pd.read_csv(organization_file_path, sep=';')
+    organizations['region'] = organizations['Адрес'].apply(func=prs.get_region_from_address)
+    org_id_region = dict(zip(organizations['ID'], organizations.region))
+    org_id_category = dict(zip(organizations['ID'], organizations['Категория']))
+    expected = pd.read_csv(event_file_path)
+    expected = expected.rename(columns={
+        'entity._id': 'event_id',
+        'entity.name': 'event_name',
+        'entity.saleLink': 'link',
+        'entity.additionalSaleLinks.0': 'add_link',
+        'entity.organization._id': 'org_id',
+        'entity.organization.name': 'org_name'
+    })
+    expected = expected.dropna(subset=['org_id'])
+    expected = expected.astype({'org_id': int})
+    expected['region_name'] = expected['org_id'].apply(func=prs.get_event_region, regions_dict=org_id_region)
+    expected['category'] = expected['org_id'].apply(func=prs.get_event_category, categories_dict=org_id_category)
+    expected['region_code'] = expected['region_name'].apply(func=prs.get_region_code_for_event)
+    expected = expected.dropna(subset=['region_code'])
+    expected['region_code'] = expected['region_code'].astype(int)
+
+    pd.testing.assert_frame_equal(
+        prs.get_events_dataframe(event_file_path, organization_file_path),
+        expected
+    )
+
+
+@pytest.fixture
+def raw_clicks_file(tmp_path):
+    pd.DataFrame({
+        'session_id': [1, 1, 2, None, 2, 3, 1, 3, 2],
+        'session_name': ['e1', 'e1', 'e2', None, 'e2', 'e3', 'e1', 'e3', 'e2'],
+        'session_identity': ['s'] * 9,
+        'create_time': ['2021-11-01 10:00:00', '2021-11-01 10:00:00', '2021-11-01 10:01:00', '2021-11-01 10:02:00',
+                        '2021-11-01 10:02:00', '2021-11-01 10:03:00', '2021-11-01 10:04:00', '2021-11-01 10:01:00',
+                        '2021-11-01 10:01:00'],
+        'user_id': ['a', 'a', 'a', 'b', 'b', 'b', 'c', 'c', 'a'],
+        'organization_id': [10, 10, 20, 20, 20, None, 10, 30, 20]
+    }).to_csv(tmp_path / 'cliks_add.csv', sep=';', index=False)
+    return str(tmp_path / 'cliks_add.csv')
+
+
+@pytest.mark.parametrize('chunksize', [1, 2, 4, 100])
+def test_chunked_user_event_dataframe(raw_clicks_file: str, chunksize: int):
+    pd.testing.assert_frame_equal(
+        prs.get_user_event_dataframe(raw_clicks_file, chunksize=chunksize),
+        prs.get_user_event_dataframe(raw_clicks_file)
+    )
+
+
+def test_clicks_chunks_exact_keys(tmp_path):
+    # the keys differ, but their concatenations are equal; the user of the last row is missing
+    pd.DataFrame({
+        'session_id': [1, 2, 3, 4],
+        'session_name': ['e1', 'e2', 'e3', 'e4'],
+        'create_time': ['2021-11-01 10:0', '2021-11-01 10:01', '2021-11-01 10:0', '2021-11-01 10:0'],
+        'user_id': ['1a', 'a', '1a', None],
+        'organization_id': [10, 20, 30, 40]
+    }).to_csv(tmp_path / 'clicks.csv', sep=';', index=False)
+    clicks = pd.concat(prs.iter_clicks_chunks(str(tmp_path / 'clicks.csv'), chunksize=1))
+    assert clicks['event_id'].tolist() == [1, 2, 4]
+
+
+@pytest.mark.parametrize('compact_every', [1, 2, 16])
+def test_clicks_counter(raw_clicks_file: str, compact_every: int):
+    counter = prs.ClicksCounter(compact_every=compact_every)
+    for clicks in prs.iter_clicks_chunks(raw_clicks_file, chunksize=1):
+        counter.add(prs.count_clicks(clicks))
+        assert len(counter.user_event_dfs) <= compact_every
+    pd.testing.assert_frame_equal(counter.get_user_event_df(), prs.get_user_event_dataframe(raw_clicks_file))
+    assert len(prs.ClicksCounter().get_user_event_df()) == 0
+
+
+@pytest.mark.parametrize('chunksize', [None, 2])
+def test_user_event_delta(tmp_path, raw_clicks_file: str, chunksize):
+    clicks = pd.read_csv(raw_clicks_file, sep=';')
+    old_clicks_file, delta_clicks_file = str(tmp_path / 'old.csv'), str(tmp_path / 'delta.csv')
+    clicks.loc[clicks.create_time <= '2021-11-01 10:01:00'].to_csv(old_clicks_file, sep=';', index=False)
+    clicks.loc[clicks.create_time >= '2021-11-01 10:01:00'].to_csv(delta_clicks_file, sep=';', index=False)
+
+    user_event_df, cursor = prs.get_user_event_delta(old_clicks_file, chunksize=chunksize)
+    assert cursor == {'high_water_mark': '2021-11-01 10:01:00', 'user_ids': ['a', 'c']}
+    user_event_delta, cursor = prs.get_user_event_delta(delta_clicks_file, cursor, chunksize)
+    assert cursor == {'high_water_mark': '2021-11-01 10:04:00', 'user_ids': ['c']}
+    # the saved user-event table is read back with categorical user ids
+    pd.testing.assert_frame_equal(
+        prs.merge_clicks_counts([user_event_df.astype({'user_id': 'category'}), user_event_delta]),
+        prs.get_user_event_dataframe(raw_clicks_file)
+    )
+
+    user_event_delta, next_cursor = prs.get_user_event_delta(delta_clicks_file, cursor, chunksize)
+    assert len(user_event_delta) == 0
+    assert next_cursor == cursor
+
+    # a click which arrives late with the time of the mark is counted once
+    late_clicks_file = str(tmp_path / 'late.csv')
+    late_clicks = clicks.loc[clicks.create_time == '2021-11-01 10:04:00'].assign(user_id='d')
+    pd.concat([clicks, late_clicks]).to_csv(late_clicks_file, sep=';', index=False)
+    user_event_delta, cursor = prs.get_user_event_delta(late_clicks_file, cursor, chunksize)
+    assert user_event_delta[['user_id', 'clicks_count']].values.tolist() == [['d', 1]]
+    assert cursor == {'high_water_mark': '2021-11-01 10:04:00', 'user_ids': ['c', 'd']}
+    assert len(prs.get_user_event_delta(late_clicks_file, cursor, chunksize)[0]) == 0
+
+
+@pytest.mark.parametrize('chunksize', [None, 2])
+def test_empty_user_event_delta(tmp_path, raw_clicks_file: str, chunksize):
+    header_file, empty_file = str(tmp_path / 'header.csv'), str(tmp_path / 'empty.csv')
+    pd.read_csv(raw_clicks_file, sep=';').iloc[:0].to_csv(header_file, sep=';', index=False)
+    open(empty_file, 'w').close()
+    cursor = {'high_water_mark': '2021-11-01 10:04:00', 'user_ids': ['c']}
+    for file_name in header_file, empty_file:
+        user_event_delta, next_cursor = prs.get_user_event_delta(file_name, cursor, chunksize)
+        assert len(user_event_delta) == 0 and next_cursor == cursor
+
+
+@pytest.mark.parametrize('chunksize', [None, 2])
+def test_time_split_user_event_dataframes(raw_clicks_file: str, chunksize):
+    train, test = prs.get_time_split_user_event_dataframes(raw_clicks_file, '2021-11-01 10:02:00', chunksize)
+    assert set(train['user_id']) == {'a', 'c'}
+    pd.testing.assert_frame_equal(
+        prs.merge_clicks_counts([train, test]),
+        prs.get_user_event_dataframe(raw_clicks_file)
+    )
+
+
+def test_synthetic_raw_data(tmp_path):
+    from app.benchmarks.synthetic_data import generate_raw_data
+
+    file_names = generate_raw_data(str(tmp_path), num_of_clicks=2000, num_of_regions=3, chunksize=700)
+    user_event_df = prs.get_user_event_dataframe(file_names['clicks_file'])
+    users_df = prs.get_user_dataframe(file_names['users_file'], file_names['regions_file'], file_names['regions_codes'])
+    events_df = prs.get_events_dataframe(file_names['all_events_file'], file_names['organizations_file'])
+
+    assert user_event_df['clicks_count'].sum() == len(prs.get_clicks_dataframe(file_names['clicks_file']))
+    assert users_df['region_code'].notna().all()
+    assert events_df['region_code'].nunique() == 3
+    assert user_event_df['event_id'].isin(events_df['event_id']).all()
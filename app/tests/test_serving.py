@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+from app.recommenders.popularity import PopularityTable, POPULARITY_COLUMNS
+from app.serving.service import LRUCache, LatencyHistogram, RecommendationService
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram(buckets_ms=(1.0, 10.0))
+    for latency_ms in 0.5, 1.0, 5.0, 50.0:
+        histogram.observe(latency_ms)
+
+    assert histogram.to_dict() == {
+        'buckets_ms': {'1.0': 2, '10.0': 3, 'inf': 4},
+        'count': 4,
+        'sum_ms': 56.5
+    }
+
+
+def test_popularity_fallback():
+    popularity = PopularityTable(pd.DataFrame([
+        [77, -1, -1, '', 0, 10, 5],
+        [77, -1, -1, '', 1, 11, 3],
+        [77, 18, 25, '', 0, 12, 4]
+    ], columns=POPULARITY_COLUMNS))
+    service = RecommendationService(dict(), popularity=popularity)
+
+    assert service.recommend(77, 'unknown', n=1) == [(10, 5.0)]
+    assert service.recommend(77, 'unknown', n=5, age=20) == [(12, 4.0)]
+    with pytest.raises(KeyError):
+        service.recommend(50, 'unknown')
@@ -0,0 +1,71 @@
+import os
+import pytest
+import pandas as pd
+
+from app.pipeline import storage
+
+
+@pytest.mark.parametrize('storage_format', list(storage.STORAGE_FORMATS))
+def test_table_dtypes_are_kept(tmp_path, storage_format: str):
+    user_df = pd.DataFrame({
+        'user_id': ['a', 'b', 'c'],
+        'region_code': [77.0, None, 78.0],
+        'age': [18.0, 20.0, 22.0]
+    })
+    file_path = storage.write_table(user_df, str(tmp_path / 'user_df'), storage_format, storage.USER_DTYPES)
+    saved_user_df = storage.read_table(file_path, storage.USER_DTYPES)
+
+    assert saved_user_df['user_id'].dtype == 'category'
+    assert saved_user_df['region_code'].dtype == 'Int64'
+    assert saved_user_df['age'].dtype == 'int64'
+    assert list(saved_user_df['user_id']) == ['a', 'b', 'c']
+
+
+@pytest.mark.parametrize('storage_format', list(storage.STORAGE_FORMATS))
+def test_list_partitions(tmp_path, storage_format: str):
+    user_event_df = pd.DataFrame({'user_id': ['a'], 'event_id': [1], 'clicks_count': [1]})
+    for user_region_code, event_region_code in (77, 77), (77, 50), (78, 78):
+        storage.write_table(
+            user_event_df,
+            str(tmp_path / storage.get_partition_name(user_region_code, event_region_code)),
+            storage_format
+        )
+
+    assert len(storage.list_partitions(str(tmp_path))) == 3
+    assert [storage.parse_partition_name(file_path) for file_path in storage.list_partitions(str(tmp_path), [77])] \
+           == [(77, 50), (77, 77)]
+
+
+def test_find_table_prefers_newest_format(tmp_path):
+    user_event_df = pd.DataFrame({'user_id': ['a'], 'event_id': [1], 'clicks_count': [2]})
+    old_file_path = storage.write_table(user_event_df, str(tmp_path / 'user_event_df'), 'csv')
+    new_file_path = storage.write_table(user_event_df, str(tmp_path / 'user_event_df'), 'parquet')
+    os.utime(old_file_path, ns=(0, 0))
+    assert storage.find_table(str(tmp_path), 'user_event_df') == new_file_path
+
+
+def test_interrupted_table_update_is_completed(tmp_path, monkeypatch):
+    state_file = str(tmp_path / 'user_event_state.json')
+    old_df = pd.DataFrame({'user_id': ['a'], 'event_id': [1], 'clicks_count': [2]})
+    new_df = pd.DataFrame({'user_id': ['a', 'b'], 'event_id': [1, 2], 'clicks_count': [3, 1]})
+    old_cursor = {'high_water_mark': '2021-11-01 10:00:00', 'user_ids': ['a']}
+    new_cursor = {'high_water_mark': '2021-11-01 10:05:00', 'user_ids': ['b']}
+    file_path = storage.write_table_with_cursor(old_df, str(tmp_path / 'user_event_df'), 'csv', None, state_file,
+                                                old_cursor)
+
+    def replace(source: str, target: str):
+        if target == file_path:
+            raise OSError('crash')
+        os.rename(source, target)
+
+    # the cursor of the update is saved, but the staged table is not moved in place yet
+    with monkeypatch.context() as patch:
+        patch.setattr(storage.os, 'replace', replace)
+        with pytest.raises(OSError):
+            storage.write_table_with_cursor(new_df, str(tmp_path / 'user_event_df'), 'csv', None, state_file,
+                                            new_cursor)
+    assert storage.read_table(file_path).equals(old_df)
+    assert storage.read_clicks_cursor(state_file) == new_cursor
+    assert storage.read_table(file_path).equals(new_df)
+    assert storage.read_clicks_cursor(state_file) == new_cursor
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['user_event_df.csv', 'user_event_state.json']